@@ -13,11 +13,13 @@ E. Overton, August 2015.
 import FECalibrationUtils
 import FrontEndChannel
 import ExportOnMon
+from HistogramMatrix import HistogramMatrix
 import TrDAQReader
 from ADCCalibrator import ADCCalibration
 import sys
 import os
 import ROOT
+import numpy
 
 # Main function for doing the post processing:
 def main(config):
@@ -59,6 +61,20 @@ def main(config):
         # Noise 2pe Threshold:
         bad_noiselimit = 0.008 # 0.8% Probability.
         
+        # Compute the light yields and noise rates of every channel at
+        # once, using the cumulative integrals of the histogram matrices:
+        lowmemory = config.get("LowMemoryHistograms", False)
+        LEDMatrix = HistogramMatrix.FromTH2(Calibration.IntLEDHist, lowmemory)
+        NoLEDMatrix = HistogramMatrix.FromTH2(Calibration.IntNoLEDHist, lowmemory)
+        LEDMean = LEDMatrix.Mean()
+        NoLEDMean = NoLEDMatrix.Mean()
+        NoLEDEntries = NoLEDMatrix.Entries()
+        Pedestals = Calibration.FEChannels["ADC_Pedestal"]
+        Gains = Calibration.FEChannels["ADC_Gain"]
+        with numpy.errstate(invalid="ignore", divide="ignore"):
+            Noise1pe = NoLEDMatrix.IntegralAbove(Pedestals + Gains, 255)/NoLEDEntries
+            Noise2pe = NoLEDMatrix.IntegralAbove(Pedestals + 2.*Gains, 255)/NoLEDEntries
+        
         
         # Use the files to generate an LYE calibration:
         for FEChannel in Calibration.FEChannels:
@@ -72,21 +88,13 @@ def main(config):
             # Check the channel has good/calibrated peds:
             if (FEChannel.ADC_Pedestal > 1.): 
             
-                PedHist_LED = Calibration.IntLEDHist.ProjectionY("th1d_led",ChannelUID+1,ChannelUID+1,"")
-                PedHist_NoLED = Calibration.IntNoLEDHist.ProjectionY("th1d_noled",ChannelUID+1,ChannelUID+1,"")
-            
                 # Check the light yield:
-                FEChannel.Light_Yield = (PedHist_LED.GetMean()-FEChannel.ADC_Pedestal)/FEChannel.ADC_Gain
-                FEChannel.Dark_Yield = (PedHist_NoLED.GetMean()-FEChannel.ADC_Pedestal)/FEChannel.ADC_Gain
+                FEChannel.Light_Yield = float(LEDMean[ChannelUID]-FEChannel.ADC_Pedestal)/FEChannel.ADC_Gain
+                FEChannel.Dark_Yield = float(NoLEDMean[ChannelUID]-FEChannel.ADC_Pedestal)/FEChannel.ADC_Gain
                 
                 # Check the noise:
-                threshold_1pe = FEChannel.ADC_Pedestal + FEChannel.ADC_Gain
-                FEChannel.noise_1pe_rate = PedHist_NoLED.Integral(\
-                    PedHist_NoLED.FindBin(threshold_1pe), 255)/PedHist_NoLED.GetEntries()
-                    
-                threshold_2pe = FEChannel.ADC_Pedestal + 2.*FEChannel.ADC_Gain
-                FEChannel.noise_2pe_rate = PedHist_NoLED.Integral(\
-                    PedHist_NoLED.FindBin(threshold_2pe), 255)/PedHist_NoLED.GetEntries()
+                FEChannel.noise_1pe_rate = float(Noise1pe[ChannelUID])
+                FEChannel.noise_2pe_rate = float(Noise2pe[ChannelUID])
                     
                 # Check constraints for channel
                 if (FEChannel.noise_2pe_rate > bad_noiselimit) and FEChannel.InTracker:
@@ -111,7 +119,8 @@ def main(config):
         Calibration.status["PostProcessed"] = True
     
     # Save output:
-    FECalibrationUtils.SaveFEChannelList(Calibration.FEChannels, os.path.join(config["path"], config["FECalibrations"]))
+    FECalibrationUtils.SaveFEChannelList(Calibration.FEChannels, os.path.join(config["path"], config["FECalibrations"]),
+                                         config.get("CompactLightYields", False))
     # Save Status:
     FECalibrationUtils.SaveCalibrationStatus(Calibration.status, config["path"])
     # Save Calibration:
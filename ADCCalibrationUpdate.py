@@ -17,7 +17,7 @@ E. Overton, July 2015.
 import ADCCalibrator
 import ADCCalibrationPostProcessor
 import FECalibrationUtils
-import copy
+import CalibrationDiff
 import ROOT
 import sys
 import os
@@ -47,8 +47,9 @@ def UpdateCalibration(old, new):
         print ("Internal LED Data is missing from New Calibration" )
         return False
     
-    # Copy the existing calibration data over:
-    new.FEChannels = copy.deepcopy(old.FEChannels)
+    # Copy the existing calibration data over, as a snapshot sharing the
+    # old calibration's issues and light yields until they are changed:
+    new.FEChannels = old.FEChannels.Snapshot()
     
     # Update the status to reflect what has been copied:
     for key in ["BiasStored", "ExternalLED", "Mapped", "BadFE"]:
@@ -178,13 +179,13 @@ def GeneratePedDifferrences(old, new):
 
     hist = ROOT.TH1D("peddiff", "peddiff", 8192, -0.5, 8191.5)
     
-    for ch_old, ch_new in zip( old.FEChannels, new.FEChannels):
-        
-        if ch_old.ChannelUID != ch_new.ChannelUID:
-            print "Old and New channels do not match UID! Something is badly wrong"
-        
-        bin = hist.FindBin(ch_old.ChannelUID)
-        hist.SetBinContent(bin, ch_old.ADC_Pedestal - ch_new.ADC_Pedestal)
+    diff = CalibrationDiff.CalibrationDiff(old.FEChannels, new.FEChannels, "ChannelUID")
+    if len(diff.Added) or len(diff.Removed):
+        print "Old and New channels do not match UID! Something is badly wrong"
+    
+    # Old - New pedestal:
+    for ChannelUID, delta in zip(diff.Keys, -diff.Delta("ADC_Pedestal")):
+        hist.SetBinContent(hist.FindBin(ChannelUID), delta)
         
     return hist
         
@@ -255,7 +256,8 @@ if __name__ == "__main__":
     CalibrationNew.status["Checked"] = True
     
     # Store the new calibration:
-    FECalibrationUtils.SaveFEChannelList(CalibrationNew.FEChannels, os.path.join(newconfig["path"], newconfig["FECalibrations"]))
+    FECalibrationUtils.SaveFEChannelList(CalibrationNew.FEChannels, os.path.join(newconfig["path"], newconfig["FECalibrations"]),
+                                         newconfig.get("CompactLightYields", False))
     FECalibrationUtils.SaveCalibrationStatus(CalibrationNew.status, newconfig["path"])
     
     # Post Process calibration/on-mon plots:
@@ -18,11 +18,30 @@ import ROOT
 
 # Objects for ADC Calibrations:
 import FECalibrationUtils
+import CalibrationContext
 import FrontEndChannel
 import TrDAQReader
 from LightYieldEstimator import LightYieldEstimator
+import LightYieldEstimator as LightYieldSteps
 import ConfigParser
 import PoissonPeakFitter
+import BatchPeakFitter
+import BatchEstimators
+from HistogramMatrix import HistogramMatrix
+
+# Fractional difference allowed between the peak and FFT gains:
+GainCrossCheckTolerance = 0.25
+
+# Compare the peak gain of a channel with its FFT gain (when the FFT
+# estimate is valid), adding an informational issue if they disagree -
+# it is only a cross-check, so should not flag the channel as bad.
+def GainCrossCheck(FEChannel, FFTValid):
+    
+    if FFTValid and \
+       abs(FEChannel.ADC_Gain - FEChannel.ADC_Gain_FFT) > GainCrossCheckTolerance*FEChannel.ADC_Gain_FFT:
+        FEChannel.Issues.append({"ChannelUID":FEChannel.ChannelUID, "Severity":2,\
+                                 "Issue":"GainCrossCheck","Comment":"Peak gain %.2f does not match FFT gain %.2f"%
+                                 (FEChannel.ADC_Gain, FEChannel.ADC_Gain_FFT)})
 
 
 # Copy of all data needed for adc calibrations:
@@ -48,6 +67,9 @@ class ADCCalibration:
         
         # Store of the config:
         self.config = None
+        
+        # Compiled mapping, biases and bad channels (CalibrationContext):
+        self.context = None
 
 
     def Load(self,config):
@@ -68,6 +90,12 @@ class ADCCalibration:
             print ("No existing FECalibrations found... Generated some empty data")
 
    
+    def Context(self):
+        # Load (or compile) the calibration context, once:
+        if self.context is None:
+            self.context = CalibrationContext.LoadOrCompile(self.config)
+        return self.context
+    
     def LoadExtras(self):
         # Load and apply bias settings:    
         if not ("BiasStored" in  self.status) or ( self.status["BiasStored"] == False):
@@ -85,7 +113,7 @@ class ADCCalibration:
     def ApplyBiases(self):
         try:
             bias_path = os.path.join(self.config["path"], self.config["Biases_Filename"])
-            FECalibrationUtils.ApplyBiasData(self.FEChannels, bias_path)
+            self.Context().ApplyBiases(self.FEChannels)
             self.status["BiasStored"] = True
             print ("Loaded Biases from file: %s"%bias_path)
         except:
@@ -94,8 +122,8 @@ class ADCCalibration:
             
     def ApplyBadFrontEnds(self):    
         try:
-            badfe_filename = os.path.join(config["path"], config["BadFE_Filename"])
-            FECalibrationUtils.ApplyBadChannels(self.FEChannels, badfe_filename)
+            badfe_filename = os.path.join(self.config["path"], self.config["BadFE_Filename"])
+            self.Context().ApplyBadFrontEnds(self.FEChannels)
             self.status["BadFE"] = True
             print ("Loaded Bad FE channels from: %s"%badfe_filename)
         except:
@@ -105,8 +133,7 @@ class ADCCalibration:
     def ApplyMapping(self):    
         try:
             mapping_filename = os.path.join(self.config["path"], self.config["Mapping_Filename"])
-            TrackerMap = FECalibrationUtils.LoadMappingFile (mapping_filename)
-            FECalibrationUtils.UpdateTrackerMapping(self.FEChannels, TrackerMap)
+            self.Context().ApplyMapping(self.FEChannels)
             self.status["Mapped"] = True
             print ("Loaded Mapping from: %s"%mapping_filename)
         except:
@@ -194,7 +221,22 @@ class ADCCalibration:
             return
         
         try:
+            # Peak spacing gain estimate for every channel (with the
+            # pedestals from the no LED data), used as a cross-check of
+            # the peak based gains:
+            lowmemory = self.config.get("LowMemoryHistograms", False)
+            ExtLEDMatrix = HistogramMatrix.FromTH2(self.ExtLEDHist, lowmemory)
+            ExtLEDMatrix.ZeroBins(15)
+            ExtNoLEDMatrix = HistogramMatrix.FromTH2(self.ExtNoLEDHist, lowmemory)
+            ExtNoLEDMatrix.ZeroBins(15)
+            FFTGains, FFTValid = BatchEstimators.FFTGains(ExtLEDMatrix, pedestals=ExtNoLEDMatrix)
+            
+            # LED vs no LED compatibility of every channel:
+            chi2, ndf, PValues = BatchEstimators.Chi2Test(ExtNoLEDMatrix, ExtLEDMatrix)
+            
             # Use the files to generate an LYE calibration:
+            # First pass, find the peaks in the LED data of every channel:
+            LEDResults = {}
             for FEChannel in self.FEChannels:
                 
                 # Channel to process:
@@ -202,9 +244,7 @@ class ADCCalibration:
             
                 # Get single channel hisrogram, and nuke all channels below 15,
                 # to stop peaks being found there in the event there is hits there.
-                PedHist_LED = self.ExtLEDHist.ProjectionY("th1d_led",ChannelUID+1,ChannelUID+1,"")
-                for i in range (15):
-                    PedHist_LED.SetBinContent(i, 0.0)
+                PedHist_LED = ProjectChannel(self.ExtLEDHist, "th1d_led", ChannelUID, 15)
                 
                 # Check for data, if no data then flag it in the "Issues" array.
                 if (PedHist_LED.GetEntries() < 1):
@@ -223,31 +263,41 @@ class ADCCalibration:
                                              "Issue":"ExternalLED","Comment":"Failed to find LED Peaks"})
                     continue
                 
-                # Fit each peak, and try to improve location:
-                for p in range(len(LightYield_LED.Peaks)):
-                    PeakFitResults = LightYield_LED.fitPeak(PedHist_LED, p)
-                    # Check each result, and copy only if good:
-                    if (abs(PeakFitResults[1] - LightYield_LED.Peaks[p]) < 3.0) \
-                        and (not math.isnan(PeakFitResults[1])):
-                        LightYield_LED.Peaks[p] = PeakFitResults[1]
-                    else:
-                        print "Warning - Bad LED Fit..."
+                LEDResults[ChannelUID] = (LightYield_LED, PedHist_LED)
+            
+            # Fit each peak, and try to improve location, for all the
+            # channels in one batch (the matrix has the same bins cleared):
+            PeakLYEs = [None]*ExtLEDMatrix.counts.shape[0]
+            for ChannelUID, (LightYield_LED, PedHist_LED) in LEDResults.items():
+                PeakLYEs[ChannelUID] = LightYield_LED
+            BadFits = BatchPeakFitter.RefinePeaks(PeakLYEs, ExtLEDMatrix)
+            if BadFits > 0:
+                print ("Warning - %i Bad LED Fits..."%BadFits)
+            
+            # Second pass, compute the gains and process the no LED data:
+            for FEChannel in self.FEChannels:
+                
+                ChannelUID = FEChannel.ChannelUID
+                if not ChannelUID in LEDResults:
+                    continue
+                LightYield_LED, PedHist_LED = LEDResults.pop(ChannelUID)
                         
                 # Compute the gain from the peaks, and store object to
                 # main FE channel Data structure...
                 LightYield_LED.gain = LightYield_LED.gainEstimator()
                 FEChannel.ADC_Pedestal = LightYield_LED.offset
                 FEChannel.ADC_Gain = LightYield_LED.gain
+                FEChannel.ADC_Gain_FFT = float(FFTGains[ChannelUID])
+                
+                GainCrossCheck(FEChannel, FFTValid[ChannelUID])
                 
                 std_peaks = [LightYield_LED.offset + i*LightYield_LED.gain for i in range(5)]
                 LightYield_LED.peakIntegrals(PedHist_LED, std_peaks)
                 
-                FEChannel.LightYieldExtLED = LightYield_LED.getMap()
+                FEChannel.LightYieldExtLED = LightYield_LED.getRecord()
 
                 # Generate and process the NOLED Data:
-                PedHist_NoLED = Calibration.ExtNoLEDHist.ProjectionY("th1d_noled",ChannelUID+1,ChannelUID+1,"")
-                for i in range (15):
-                    PedHist_NoLED.SetBinContent(i, 0.0)
+                PedHist_NoLED = ProjectChannel(Calibration.ExtNoLEDHist, "th1d_noled", ChannelUID, 15)
                 
                 # Check for data, if no data then flag it in the "Issues" array.
                 if (PedHist_NoLED.GetEntries() < 1):
@@ -263,11 +313,11 @@ class ADCCalibration:
                 LightYield_NoLED.peakIntegrals(PedHist_NoLED, std_peaks)
                 
                 # Done - save map!
-                FEChannel.LightYieldExtNoLED = LightYield_NoLED.getMap()
+                FEChannel.LightYieldExtNoLED = LightYield_NoLED.getRecord()
                 
                 # Finally compare two histograms to identify defunct channels
                 # (ie. those not connected).
-                p_value =  PedHist_NoLED.Chi2Test(PedHist_LED, "UUP")
+                p_value = PValues[ChannelUID]
                 
             # Done with external LED, update statuses:
             Calibration.status["ExternalLED"] = True
@@ -281,6 +331,28 @@ class ADCCalibration:
     # TODO: It may be possible to include the external LED stuff in here also,
     # but there is no motivation for this at this time.
 
+# Project a single channel of a histogram, with the low bins cleared to
+# stop peaks being found there. Each channel gets its own histogram (not
+# attached to a directory, and deleted with the python object), so the
+# projections can be kept between the passes over the channels.
+def ProjectChannel(Hist, name, ChannelUID, clearbins):
+    
+    PedHist = Hist.ProjectionY("%s_%i"%(name, ChannelUID),ChannelUID+1,ChannelUID+1,"")
+    PedHist.SetDirectory(0)
+    ROOT.SetOwnership(PedHist, True)
+    for i in range (clearbins):
+        PedHist.SetBinContent(i, 0.0)
+    
+    return PedHist
+
+# Project the internal LED and no LED histograms of a single channel.
+def ProjectInternalLED(Calibration, ChannelUID):
+    
+    PedHist_LED = ProjectChannel(Calibration.IntLEDHist, "th1d_led", ChannelUID, 10)
+    PedHist_NoLED = ProjectChannel(Calibration.IntNoLEDHist, "th1d_noled", ChannelUID, 15)
+    
+    return PedHist_LED, PedHist_NoLED
+
 # Main function for running the ADC Calibrations,
 # requires a configuration file loaded.
 def main(config, ForceIntLEDLoad=True):
@@ -291,6 +363,7 @@ def main(config, ForceIntLEDLoad=True):
     
     # Load the basic calibration (status and channel) data from a specified config:
     Calibration.Load(config)
+    LightYieldSteps.ConfigureSteps(config)
     
     # Apply Bias, Bad channels and Mapping
     Calibration.LoadExtras()
@@ -315,41 +388,66 @@ def main(config, ForceIntLEDLoad=True):
     # Next task, process internal LED:
     if not ("InternalLED" in Calibration.status) or (Calibration.status["InternalLED"] == False):        
           
+        # Pre-screen every channel on the whole matrices, with the low bins
+        # cleared as in ProjectInternalLED, so the empty, breakdown and
+        # single peak channels are flagged in bulk and dropped from the
+        # fitting:
+        lowmemory = config.get("LowMemoryHistograms", False)
+        LEDMatrix = HistogramMatrix.FromTH2(Calibration.IntLEDHist, lowmemory)
+        LEDMatrix.ZeroBins(10)
+        NoLEDMatrix = HistogramMatrix.FromTH2(Calibration.IntNoLEDHist, lowmemory)
+        NoLEDMatrix.ZeroBins(15)
+        
+        # Peak spacing gain estimate for every channel (with the pedestals
+        # from the no LED data), used to find the single peak channels and
+        # as a cross-check of the peak based gains:
+        FFTGains, FFTValid = BatchEstimators.FFTGains(LEDMatrix, pedestals=NoLEDMatrix)
+        
+        LEDScreen = BatchEstimators.PreScreenChannels(LEDMatrix, fftvalid=FFTValid)
+        NoLEDScreen = BatchEstimators.PreScreenChannels(NoLEDMatrix, findpeaks=False)
+        
+        # Issues, in order of priority (one per channel), for the channels
+        # with no data to fit:
+        ScreenIssues = BatchEstimators.PreScreenIssues(LEDScreen, "InternalLED",
+                                   {BatchEstimators.SCREEN_BREAKDOWN:"Breakdown detected in LED data"})
+        ScreenIssues.update(BatchEstimators.PreScreenIssues(NoLEDScreen, "InternalLED",
+                                   {BatchEstimators.SCREEN_EMPTY:"Missing internal NoLED data"}))
+        ScreenIssues.update(BatchEstimators.PreScreenIssues(LEDScreen, "InternalLED",
+                                   {BatchEstimators.SCREEN_EMPTY:"Failed to find LED Data"}))
+        for ChannelUID, Issue in ScreenIssues.items():
+            Calibration.FEChannels[ChannelUID].Issues.append(Issue)
+        
+        # The single peak channels are still fitted (the peak search decides
+        # if they are bad), just flagged as probably under biased:
+        SinglePeakIssues = BatchEstimators.PreScreenIssues(LEDScreen, "InternalLED",
+                                   {BatchEstimators.SCREEN_SINGLEPEAK:"Single LED peak, probably under biased"},
+                                   severity=2)
+        for ChannelUID, Issue in SinglePeakIssues.items():
+            if not ChannelUID in ScreenIssues:
+                Calibration.FEChannels[ChannelUID].Issues.append(Issue)
+        
+        for state in range(len(BatchEstimators.ScreenStates)):
+            print ("Pre-screen: %i channels %s"%((LEDScreen == state).sum(), BatchEstimators.ScreenStates[state]))
+        
         # Use the files to generate an LYE calibration:
+        # First pass, find the peaks in the LED data of every channel:
         poisson_ipar = None
+        LEDResults = {}
         for FEChannel in Calibration.FEChannels:
             
-            # Channel to process:
+            # Channel to process, skipping those flagged by the pre-screen:
             ChannelUID = FEChannel.ChannelUID
+            if ChannelUID in ScreenIssues:
+                continue
             print "Processing channel: ", ChannelUID
             
             # Wrap in a try loop to catch and skip errors...
             try:
                 # Get single channel hisrogram, and nuke all channels below 15,
                 # to stop peaks being found there in the event there is hits there.
-                PedHist_LED = Calibration.IntLEDHist.ProjectionY("th1d_led",ChannelUID+1,ChannelUID+1,"")
-                for i in range (10):
-                    PedHist_LED.SetBinContent(i, 0.0)
-                
-                # Check for data, if no data then flag it in the "Issues" array.
-                if (PedHist_LED.GetEntries() < 1):
-                        FEChannel.Issues.append({"ChannelUID":ChannelUID, "Severity":4,\
-                                             "Issue":"InternalLED","Comment":"Failed to find LED Data"})
-                        continue
-                    
-                # Generate and process the NOLED Data:
-                PedHist_NoLED = Calibration.IntNoLEDHist.ProjectionY("th1d_noled",ChannelUID+1,ChannelUID+1,"")
-                for i in range (15):
-                    PedHist_NoLED.SetBinContent(i, 0.0)
-                    
-                # Check for data, if no data then flag it in the "Issues" array.
-                if (PedHist_NoLED.GetEntries() < 1):
-                        FEChannel.Issues.append({"ChannelUID":ChannelUID, "Severity":4,\
-                                             "Issue":"InternalLED","Comment":"Missing internal NoLED data"})
-                        continue
+                PedHist_LED, PedHist_NoLED = ProjectInternalLED(Calibration, ChannelUID)
                 
                 LightYield_LED = LightYieldEstimator()
-                LightYield_NoLED = LightYieldEstimator()
                 
                 # Attempt Poisson fitting of data:
                 dopoissonfit = True
@@ -386,19 +484,43 @@ def main(config, ForceIntLEDLoad=True):
                 # Data Available, do the fitting processes:
                 # Run std processing on the pedestal histagram.
                 # Use the poisson result(if available), and skip peak finding.
-                LightYield_LED.process(PedHist_LED, poissonfit=poissonfit)
+                LightYield_LED.process(PedHist_LED, poissonfit=poissonfit, screen=LEDScreen[ChannelUID])
                 
-                # Fit each peak, and try to improve location:
-                if poissonfit is None:
-                    for p in range(len(LightYield_LED.Peaks)):
-                        PeakFitResults = LightYield_LED.fitPeak(PedHist_LED, p)
-                        # Check each result, and copy only if good:
-                        if (abs(PeakFitResults[1] - LightYield_LED.Peaks[p]) < 3.0) \
-                            and (not math.isnan(PeakFitResults[1])):
-                            LightYield_LED.Peaks[p] = PeakFitResults[1]
-                        else:
-                            print "Warning - Bad LED Fit..."
-                        
+                LEDResults[ChannelUID] = (LightYield_LED, poissonfit, PedHist_LED, PedHist_NoLED)
+                
+            except KeyboardInterrupt:
+                raise
+            except:
+                FEChannel.Issues.append({"ChannelUID":ChannelUID, "Severity":10,\
+                                             "Issue":"Data","Comment":"Failed to process channel"})
+        
+        # Fit each peak, and try to improve location, for all the channels
+        # without a poisson fit in one batch:
+        PeakLYEs = [None]*LEDMatrix.counts.shape[0]
+        for ChannelUID, (LightYield_LED, poissonfit, PedHist_LED, PedHist_NoLED) in LEDResults.items():
+            if poissonfit is None:
+                PeakLYEs[ChannelUID] = LightYield_LED
+        BadFits = BatchPeakFitter.RefinePeaks(PeakLYEs, LEDMatrix)
+        if BadFits > 0:
+            print ("Warning - %i Bad LED Fits..."%BadFits)
+        
+        for FEChannel in Calibration.FEChannels:
+            FEChannel.ADC_Gain_FFT = float(FFTGains[FEChannel.ChannelUID])
+        
+        # LED vs no LED compatibility of every channel (chisquare, as
+        # Chi2Test "UU"), to find the channels which are not connected:
+        chi2, ndf, PValues = BatchEstimators.Chi2Test(NoLEDMatrix, LEDMatrix)
+        
+        # Second pass, compute the gains and process the no LED data:
+        for FEChannel in Calibration.FEChannels:
+            
+            ChannelUID = FEChannel.ChannelUID
+            if not ChannelUID in LEDResults:
+                continue
+            # The projections of the first pass (released once done):
+            LightYield_LED, poissonfit, PedHist_LED, PedHist_NoLED = LEDResults.pop(ChannelUID)
+            
+            try:
                 # Check the state of the output:
                 if LightYield_LED.ChannelState != "PEPeaks":
                     FEChannel.Issues.append({"ChannelUID":ChannelUID, "Severity":4,\
@@ -410,15 +532,19 @@ def main(config, ForceIntLEDLoad=True):
                 LightYield_LED.gain = LightYield_LED.gainEstimator()
                 LightYield_LED.offset = LightYield_LED.Peaks[0]
                     
-                LightYield_NoLED.process(PedHist_NoLED, LightYield_LED, poissonfit=poissonfit)
+                LightYield_NoLED = LightYieldEstimator()
+                LightYield_NoLED.process(PedHist_NoLED, LightYield_LED, poissonfit=poissonfit,
+                                         screen=NoLEDScreen[ChannelUID])
                 
                 FEChannel.ADC_Pedestal = LightYield_LED.offset
                 FEChannel.ADC_Gain = LightYield_LED.gain
                 
+                GainCrossCheck(FEChannel, FFTValid[ChannelUID])
+                
                 std_peaks = [LightYield_LED.offset + i*LightYield_LED.gain for i in range(5)]
                 LightYield_LED.peakIntegrals(PedHist_LED, std_peaks)
             
-                FEChannel.LightYieldIntLED = LightYield_LED.getMap()
+                FEChannel.LightYieldIntLED = LightYield_LED.getRecord()
                 
                 # Finally generate some estimates on noises:
                 # note that the peaks are generated from the calibration for
@@ -426,11 +552,9 @@ def main(config, ForceIntLEDLoad=True):
                 LightYield_NoLED.peakIntegrals(PedHist_NoLED, std_peaks)
                 
                 # Done - save map!
-                FEChannel.LightYieldIntNoLED = LightYield_NoLED.getMap()
-                
-                p_value =  PedHist_NoLED.Chi2Test(PedHist_LED, "UUP")
+                FEChannel.LightYieldIntNoLED = LightYield_NoLED.getRecord()
                 
-                if (p_value > 0.03):
+                if (PValues[ChannelUID] > 0.03):
                     FEChannel.Issues.append({"ChannelUID":ChannelUID, "Severity":6,\
                                              "Issue":"InternalLED","Comment":"LED pedestal matches no LED pedestal."})
             except KeyboardInterrupt:
@@ -450,6 +574,9 @@ def main(config, ForceIntLEDLoad=True):
             except:
                 continue
         
+    # Timings of the light yield processing:
+    LightYieldSteps.PrintStepReport()
+    
     # Final Task, return Calibration:
     return Calibration
 
@@ -478,7 +605,8 @@ if __name__ == "__main__":
     Calibration = main (config)
     
     # Save output:
-    FECalibrationUtils.SaveFEChannelList(Calibration.FEChannels, os.path.join(config["path"], config["FECalibrations"]))
+    FECalibrationUtils.SaveFEChannelList(Calibration.FEChannels, os.path.join(config["path"], config["FECalibrations"]),
+                                         config.get("CompactLightYields", False))
     # Save Status:
     FECalibrationUtils.SaveCalibrationStatus(Calibration.status, config["path"])
     
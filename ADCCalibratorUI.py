@@ -14,6 +14,7 @@ module_description = \
 import os
 import sys
 import ROOT
+import numpy
 
 import ADCCalibrator
 import FECalibrationUtils
@@ -319,25 +320,25 @@ class ADCUIMainFrame( ROOT.TGMainFrame ):
             if (self.bg_datasel_extled.IsDown()):
                 LED=True
                 SourceHist = self.Calibration.ExtLEDHist.ProjectionY("th1d_projecty",ChannelID+1,ChannelID+1,"")
-                SourceLYE = LightYieldEstimator.LightYieldEstimator(FEChannel.LightYieldExtLED)
+                SourceLYE = LightYieldEstimator.LightYieldRecord.Load(FEChannel.LightYieldExtLED)
                 
             # External NoLED
             elif (self.bg_datasel_extnoled.IsDown()):
                 LED=False
                 SourceHist = self.Calibration.ExtNoLEDHist.ProjectionY("th1d_projecty",ChannelID+1,ChannelID+1,"")
-                SourceLYE = LightYieldEstimator.LightYieldEstimator(FEChannel.LightYieldExtNoLED)
+                SourceLYE = LightYieldEstimator.LightYieldRecord.Load(FEChannel.LightYieldExtNoLED)
             
             # Internal LED:    
             elif (self.bg_datasel_intled.IsDown()):
                 LED=True
                 SourceHist = self.Calibration.IntLEDHist.ProjectionY("th1d_projecty",ChannelID+1,ChannelID+1,"")
-                SourceLYE = LightYieldEstimator.LightYieldEstimator(FEChannel.LightYieldIntLED)
+                SourceLYE = LightYieldEstimator.LightYieldRecord.Load(FEChannel.LightYieldIntLED)
             
             # Internal NoLED    
             elif (self.bg_datasel_intnoled.IsDown()):
                 LED=False
                 SourceHist = self.Calibration.IntNoLEDHist.ProjectionY("th1d_projecty",ChannelID+1,ChannelID+1,"")
-                SourceLYE = LightYieldEstimator.LightYieldEstimator(FEChannel.LightYieldIntNoLED)
+                SourceLYE = LightYieldEstimator.LightYieldRecord.Load(FEChannel.LightYieldIntNoLED)
             
             else:
                 raise Exception ("No Button Selected")
@@ -363,7 +364,7 @@ class ADCUIMainFrame( ROOT.TGMainFrame ):
                 (FEChannel.InternalPoissonFitResult, led=LED)
                 self.poissfunc.Draw("same")
             except:
-                for p in SourceLYE.Peaks:
+                for p in SourceLYE["Peaks"]:
                     tl = ROOT.TLine(p,0, p, max_h)
                     tl.SetLineColor(ROOT.kRed)
                     tl.Draw("l")
@@ -548,16 +549,16 @@ class ADCUIMainFrame( ROOT.TGMainFrame ):
                 SourceLYE = None
                 
                 if (self.bg_datasel_extled.IsDown()):
-                    SourceLYE = LightYieldEstimator.LightYieldEstimator(FEChannel.LightYieldExtLED)
+                    SourceLYE = LightYieldEstimator.LightYieldRecord.Load(FEChannel.LightYieldExtLED)
                 elif (self.bg_datasel_extnoled.IsDown()):
-                    SourceLYE = LightYieldEstimator.LightYieldEstimator(FEChannel.LightYieldExtNoLED)
+                    SourceLYE = LightYieldEstimator.LightYieldRecord.Load(FEChannel.LightYieldExtNoLED)
                 elif (self.bg_datasel_intled.IsDown()):
-                    SourceLYE = LightYieldEstimator.LightYieldEstimator(FEChannel.LightYieldIntLED)
+                    SourceLYE = LightYieldEstimator.LightYieldRecord.Load(FEChannel.LightYieldIntLED)
                 elif (self.bg_datasel_intnoled.IsDown()):
-                    SourceLYE = LightYieldEstimator.LightYieldEstimator(FEChannel.LightYieldIntNoLED)
+                    SourceLYE = LightYieldEstimator.LightYieldRecord.Load(FEChannel.LightYieldIntNoLED)
                 
                 if not SourceLYE is None:
-                    integrals = SourceLYE.Integrals
+                    integrals = SourceLYE["Integrals"]
                     self.th.SetBinContent(FEChannel.ChannelUID+1, sum(integrals[2:])/sum(integrals))
                     self.th2.SetBinContent(FEChannel.ChannelUID+1, sum(integrals[3:])/sum(integrals))
             
@@ -603,6 +604,7 @@ class ADCUIMainFrame( ROOT.TGMainFrame ):
             
             channel.ADC_Pedestal = pedestal
             channel.ADC_Gain = gain
+            self.Calibration.FEChannels.MarkDirty(ChannelID)
             
             # Update issues:
             for issue in channel.Issues:
@@ -638,21 +640,21 @@ class ADCUIMainFrame( ROOT.TGMainFrame ):
         print ("Editing Channel: %i"%ChannelID)
         
         self.Calibration.FEChannels = FECalibrationUtils.EditChannelData(self.Calibration.FEChannels, ChannelID)
+        self.Calibration.FEChannels.MarkDirty(ChannelID)
         
     def FindNextBadChannel(self):
         
         ChannelID = int(self.sUniqueChannel.GetNumberEntry().GetIntNumber())
-        for ChannelUID in range(ChannelID+1, FECalibrationUtils.NUM_CHANS):
-            stop = False
-            accepted = False
-            if self.Calibration.FEChannels[ChannelUID].InTracker:
-                for Issue in self.Calibration.FEChannels[ChannelUID].Issues:
-                    if (Issue["Issue"] == "AcceptedBad"):
-                        accepted = True
-                    if (Issue["Severity"] > 2):
-                        stop = True
-            if not accepted and stop:
-                break
+        
+        # In tracker channels with a severe issue, not yet accepted:
+        FEChannels = self.Calibration.FEChannels
+        Issues = FEChannels.IssueIndex()
+        bad = (FEChannels["InTracker"] != 0) & (Issues.MaxSeverity > 2) & ~Issues.Accepted
+        bad[:ChannelID+1] = False
+        
+        ChannelUID = FECalibrationUtils.NUM_CHANS - 1
+        if bad.any():
+            ChannelUID = int(numpy.argmax(bad))
             
         self.sUniqueChannel.GetNumberEntry().SetIntNumber(ChannelUID)
         self.UpdateUniqueCounter()
@@ -668,6 +670,7 @@ class ADCUIMainFrame( ROOT.TGMainFrame ):
         
         channel.Issues.append({"ChannelUID":channel.ChannelUID, "Severity":10,\
                                  "Issue":"AcceptedBad","Comment":"Channel Flagged as Bad. Masked out in ped/gain"})
+        self.Calibration.FEChannels.MarkDirty(ChannelID)
         
         self.PlotChannelHist(0)
         
@@ -679,13 +682,16 @@ class ADCUIMainFrame( ROOT.TGMainFrame ):
         
         channel.Issues.append({"ChannelUID":channel.ChannelUID, "Severity":0,\
                                  "Issue":"AcceptedBad","Comment":"Channel Flagged as OK."})
+        self.Calibration.FEChannels.MarkDirty(ChannelID)
         
         self.PlotChannelHist(0)
         
+    # Save the edited channels to the write ahead log of the channel file:
     def SaveAll(self):
         
-        FECalibrationUtils.SaveFEChannelList(self.Calibration.FEChannels,\
-                                             os.path.join(self.config["path"],self.config["FECalibrations"]))
+        FECalibrationUtils.SaveFEChannelChanges(self.Calibration.FEChannels,\
+                                             os.path.join(self.config["path"],self.config["FECalibrations"]),\
+                                             self.config.get("CompactLightYields", False))
         
 if __name__ == "__main__":
     
@@ -724,4 +730,8 @@ if __name__ == "__main__":
     
     raw_input("Script complete, press enter to continue")
     
+    # Compact the saved changes into the channel file:
+    FECalibrationUtils.CompactFEChannelLog(os.path.join(config["path"], config["FECalibrations"]),
+                                           config.get("CompactLightYields", False))
+    
     print ("Exiting.")
@@ -7,8 +7,9 @@ E. Overton, Feb 2016.
 """
 
 import sys
+import numpy
 import FECalibrationUtils
-import FrontEndChannel
+import CalibrationDiff
 import ADCCalibrator
 import ROOT
 import math
@@ -16,8 +17,8 @@ import os
 
 def ADCCheckStability(OldCalibration, NewCalibration):
     """
-    This function should loop over each channel to compare
-    against and monitor stability.
+    This function should compare each channel (matched by ChannelUID)
+    to monitor stability.
     """
     
     # Plots to return:
@@ -25,36 +26,34 @@ def ADCCheckStability(OldCalibration, NewCalibration):
     h_ly_res = ROOT.TH1D("h_ly_res", "h_ly_res", 500,-0.25,0.25)
     h_pdiff = ROOT.TH1D("h_pdiff", "h_piff", 8192,-0.55,8191.5)
     
-    # Try to find the Old Calibration UID:
-    skipped_channels = 0
-    for newc in NewCalibration.FEChannels:
-        assert isinstance(newc, FrontEndChannel.FrontEndChannel)
-        
-        # Skip channels not in detector, or bad.
-        if (newc.InTracker == 0) or (newc.ADC_Gain < 1) or (newc.ADC_Pedestal < 1):
-            skipped_channels += 1
-            continue
-        
-        oldc = OldCalibration.FEChannels[newc.ChannelUID]
-        assert isinstance(oldc, FrontEndChannel.FrontEndChannel)
-        assert newc.ChannelUID == oldc.ChannelUID
-        
-        # Fill the plots (Light_Yield also includes dark counts):
-        h_dy_res.Fill(newc.Dark_Yield - oldc.Dark_Yield)
-        h_ly_res.Fill(newc.Light_Yield - newc.Dark_Yield - oldc.Light_Yield + oldc.Dark_Yield)
-        h_pdiff.SetBinContent(h_pdiff.FindBin(newc.ChannelUID), newc.ADC_Pedestal - oldc.ADC_Pedestal)
-          
-    # Distribution Checks:
-    status_dy = (h_dy_res.GetRMS() < 0.01) and (abs(h_dy_res.GetMean()) < 0.01)
-    status_ly = (h_ly_res.GetRMS() < 0.04) and (abs(h_ly_res.GetMean()) < 0.01) 
+    # Match the channels by ChannelUID:
+    diff = CalibrationDiff.CalibrationDiff(OldCalibration.FEChannels, NewCalibration.FEChannels, "ChannelUID")
+    
+    # Skip channels not in detector, or bad.
+    good = (diff.New("InTracker") != 0) & (diff.New("ADC_Gain") >= 1) & (diff.New("ADC_Pedestal") >= 1)
+    
+    # Fill the plots (Light_Yield also includes dark counts):
+    dy_res = diff.Delta("Dark_Yield")[good]
+    ly_res = (diff.Delta("Light_Yield") - diff.Delta("Dark_Yield"))[good]
+    peddiff = diff.Delta("ADC_Pedestal")[good]
+    if len(dy_res) > 0:
+        h_dy_res.FillN(len(dy_res), dy_res, numpy.ones(len(dy_res)))
+        h_ly_res.FillN(len(ly_res), ly_res, numpy.ones(len(ly_res)))
+    for ChannelUID, delta in zip(diff.Keys[good], peddiff):
+        h_pdiff.SetBinContent(h_pdiff.FindBin(ChannelUID), delta)
+    
+    # Distribution Checks (over the plotted range), and outliers
+    # outside a specific range:
+    summary_dy = CalibrationDiff.Summarise(dy_res, tolerance=0.05, window=0.25)
+    summary_ly = CalibrationDiff.Summarise(ly_res, tolerance=0.15, window=0.25)
+    status_dy = (summary_dy["RMS"] < 0.01) and (abs(summary_dy["Mean"]) < 0.01)
+    status_ly = (summary_ly["RMS"] < 0.04) and (abs(summary_ly["Mean"]) < 0.01) 
     
     # Outlier Checks (more than 32 channels ourside specific range):
-    if (h_dy_res.GetEntries() - h_dy_res.Integral(h_dy_res.FindBin(-0.05), 
-                                                  h_dy_res.FindBin(+0.05))) > 32:
+    if summary_dy["Outliers"] > 32:
         status_dy = False
 
-    if (h_ly_res.GetEntries() - h_ly_res.Integral(h_ly_res.FindBin(-0.15), 
-                                                  h_ly_res.FindBin(+0.15))) > 32:
+    if summary_ly["Outliers"] > 32:
         status_ly = False
     
     
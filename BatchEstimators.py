@@ -0,0 +1,823 @@
+#!/usr/bin/env python
+module_description=\
+"""
+Batched estimators operating on a HistogramMatrix, replacing the
+per channel ROOT fits of the LightYieldEstimator where a closed form
+is good enough.
+
+Arguments (test script): DAQ file(optional), tolerance(optional), DAQ file(optional)
+    Checks the batched dark count estimate against a numpy emulation
+    of LightYieldEstimator.estimateDarkCount on synthetic spectra (no
+    ROOT needed). Given a DAQ file, also compares it with
+    LightYieldEstimator.estimateDarkCount, checks the accuracy of the
+    low memory (uint32/float32) matrices, and if a second file is
+    given the batched chisquare and KS tests with TH1::Chi2Test and
+    TH1::KolmogorovTest.
+"""
+
+import math
+import numpy
+
+# Limits used by LightYieldEstimator.estimateDarkCount:
+DARK_MINBIN = 2
+DARK_MAXBIN = 128
+DARK_NSIGMA = 2.2
+DARK_FLOOR = 1E-9
+# Pedestal fit range, in ADC counts below and above the peak, and the
+# chisquare iterations to match the ROOT fit:
+DARK_FIT_LOW = 14.0
+DARK_FIT_HIGH = 3.0
+DARK_FIT_ITERATIONS = 5
+
+# Pedestal search: the lowest local maximum (over +-PEDESTAL_HALFWIDTH
+# bins of the 3 bin sums) with at least PEDESTAL_FRACTION of the
+# maximum and PEDESTAL_MINCOUNTS entries:
+PEDESTAL_HALFWIDTH = 2
+PEDESTAL_FRACTION = 0.02
+PEDESTAL_MINCOUNTS = 10
+
+# CountPeaks significance of a peak over the lowest point between it
+# and the pedestal (in poisson sigmas):
+PEAK_SIGNIFICANCE = 5.0
+
+# FFTGains significance of the autocorrelation peak (height, and
+# prominence, over the poisson noise of the autocorrelation):
+FFT_SIGNIFICANCE = 5.0
+
+# Pre-screen channel classes:
+SCREEN_NORMAL = 0
+SCREEN_EMPTY = 1
+SCREEN_BREAKDOWN = 2
+SCREEN_SINGLEPEAK = 3
+ScreenStates = ["Normal", "Empty", "Breakdown", "SinglePeak"]
+
+# LightYieldEstimator.detectBreakdown limit:
+BREAKDOWN_RATIO = 0.01
+
+# Iterations for the incomplete gamma function:
+GAMMA_ITERATIONS = 500
+GAMMA_EPS = 1E-15
+
+_erf = numpy.vectorize(math.erf, otypes=[numpy.float64])
+_lgamma = numpy.vectorize(math.lgamma, otypes=[numpy.float64])
+
+
+####################################################################
+def FitPedestals(matrix, centres=None, window=2, iterations=0):
+    """
+    Fit a gaussian to the pedestal of every channel at once, by fitting
+    a parabola to the log of the bin contents in the bins around
+    the pedestal maximum. The fit is a weighted linear least squares
+    (weight = bin content), solved for all channels as one batch.
+    It can then be refined to the chisquare fit of TH1::Fit (errors
+    sqrt(n), empty bins left out) with Gauss-Newton iterations.
+
+    matrix - HistogramMatrix
+    centres - bin of the pedestal for each channel (default:
+              PedestalCentres)
+    window - number of bins either side of the centre to use (1-2 gives
+             the three to five bins around the peak), or a pair of the
+             number of bins below and above it. Bins outside the ADC
+             axis are left out of the fit.
+    iterations - number of chisquare iterations (0 for the log fit).
+
+    returns: dict of "constant", "mean", "sigma" arrays and a "valid" mask.
+    """
+    counts = matrix.counts
+    nchan = counts.shape[0]
+    rows = numpy.arange(nchan)
+
+    if centres is None:
+        centres = PedestalCentres(matrix)
+    centres = numpy.asarray(centres, dtype=numpy.int64)
+
+    # Gather the window of bins about each centre:
+    if numpy.ndim(window) == 0:
+        window = (window, window)
+    offsets = numpy.arange(-window[0], window[1]+1)
+    bins = centres[:, None] + offsets[None, :]
+    inside = (bins >= 1) & (bins <= matrix.nbins)
+    bins = numpy.clip(bins, 1, matrix.nbins)
+    # (the gathered windows are small, so are fitted in float64)
+    n = numpy.where(inside, counts[rows[:, None], bins], 0).astype(numpy.float64)
+    x = matrix.BinCenter(bins) - matrix.BinCenter(centres)[:, None]
+
+    # Log of contents, masking empty bins out of the fit:
+    w = numpy.where(n > 0, n, 0.0)
+    y = numpy.log(numpy.where(n > 0, n, 1.0))
+
+    # Normal equations for y = a + b x + c x^2:
+    S = [(w*x**k).sum(axis=1) for k in range(5)]
+    T = [(w*y*x**k).sum(axis=1) for k in range(3)]
+    A = numpy.empty((nchan, 3, 3))
+    for i in range(3):
+        for j in range(3):
+            A[:, i, j] = S[i+j]
+    B = numpy.stack(T, axis=1)
+
+    valid = ((n > 0).sum(axis=1) >= 3)
+    det = numpy.linalg.det(A)
+    valid &= numpy.abs(det) > 1E-12
+    A[~valid] = numpy.eye(3)
+    B[~valid] = 0.0
+    a, b, c = numpy.linalg.solve(A, B[:, :, None])[:, :, 0].T
+
+    # A downward parabola is needed for a gaussian:
+    valid &= c < 0
+    c = numpy.where(valid, c, -1.0)
+
+    sigma = numpy.sqrt(-1.0/(2.0*c))
+    shift = -b/(2.0*c)
+    mean = matrix.BinCenter(centres) + shift
+    constant = numpy.exp(a - b*b/(4.0*c))
+
+    # Chisquare iterations, in x relative to the centre, only keeping
+    # steps which lower the chisquare of a channel:
+    weight = numpy.where(n > 0, 1.0/numpy.where(n > 0, n, 1.0), 0.0)
+    params = numpy.stack([constant, shift, sigma], axis=1)
+
+    def Chisquare(params):
+        f = params[:, 0:1]*numpy.exp(-0.5*((x - params[:, 1:2])/params[:, 2:3])**2)
+        return (weight*(n - f)**2).sum(axis=1), f
+
+    chisquare, f = Chisquare(params)
+    for iteration in range(iterations):
+        u = (x - params[:, 1:2])/params[:, 2:3]
+        J = numpy.stack([f/params[:, 0:1], f*u/params[:, 2:3], f*u*u/params[:, 2:3]], axis=2)
+        H = numpy.einsum("cbi,cb,cbj->cij", J, weight, J)
+        G = numpy.einsum("cbi,cb,cb->ci", J, weight, n - f)
+        H[~valid] = numpy.eye(3)
+        G[~valid] = 0.0
+        with numpy.errstate(invalid="ignore", over="ignore"):
+            try:
+                step = numpy.linalg.solve(H, G[:, :, None])[:, :, 0]
+            except numpy.linalg.LinAlgError:
+                break
+            trial = params + step
+            trial_chisquare, trial_f = Chisquare(trial)
+        better = valid & (trial[:, 2] > 0) & (trial_chisquare < chisquare)
+        params = numpy.where(better[:, None], trial, params)
+        chisquare = numpy.where(better, trial_chisquare, chisquare)
+        f = numpy.where(better[:, None], trial_f, f)
+
+    constant, shift, sigma = params.T
+    mean = matrix.BinCenter(centres) + shift
+
+    return {"constant": numpy.where(valid, constant, 0.0),
+            "mean": numpy.where(valid, mean, 0.0),
+            "sigma": numpy.where(valid, sigma, 0.0),
+            "valid": valid}
+
+
+def PedestalCentres(matrix):
+    """
+    The pedestal bin of every channel: the lowest significant peak,
+    rather than the maximum bin, which is a photo peak in LED data
+    with more than about one photo electron. A peak is a local maximum
+    of the 3 bin sums over +-PEDESTAL_HALFWIDTH bins, significant with
+    at least PEDESTAL_FRACTION of the largest sum and PEDESTAL_MINCOUNTS
+    entries, and its bin is the largest bin within +-PEDESTAL_HALFWIDTH.
+    Channels without one (eg. empty) get the maximum bin.
+
+    returns: array of the pedestal bin of each channel.
+    """
+    nbins = matrix.nbins
+    sums, maxima = LocalMaxima(matrix)
+    peaks = maxima & (sums >= numpy.maximum(PEDESTAL_FRACTION*sums.max(axis=1), PEDESTAL_MINCOUNTS)[:, None])
+
+    contents = matrix.counts[:, 1:nbins+1]
+    centres = numpy.where(peaks.any(axis=1), numpy.argmax(peaks, axis=1), numpy.argmax(contents, axis=1))
+
+    # Largest bin about the peak:
+    offsets = numpy.arange(-PEDESTAL_HALFWIDTH, PEDESTAL_HALFWIDTH+1)
+    around = numpy.clip(centres[:, None] + offsets[None, :], 0, nbins-1)
+    rows = numpy.arange(contents.shape[0])[:, None]
+    return around[rows[:, 0], numpy.argmax(contents[rows, around], axis=1)] + 1
+
+
+def LocalMaxima(matrix):
+    """
+    The 3 bin sums centred on each ADC bin of every channel, and the mask
+    of the local maxima of the sums over +-PEDESTAL_HALFWIDTH bins.
+
+    returns: (sums, maxima) - arrays [channel, bin-1].
+    """
+    nbins = matrix.nbins
+    C = matrix.Cumulative()
+    low = numpy.clip(numpy.arange(0, nbins), 1, nbins)
+    high = numpy.clip(numpy.arange(2, nbins+2), 1, nbins)
+    sums = (C[:, high+1] - C[:, low]).astype(numpy.float64)
+
+    maxima = numpy.ones(sums.shape, dtype=bool)
+    padded = numpy.pad(sums, ((0, 0), (PEDESTAL_HALFWIDTH, PEDESTAL_HALFWIDTH)), mode="constant",
+                       constant_values=-1.0)
+    for offset in range(-PEDESTAL_HALFWIDTH, PEDESTAL_HALFWIDTH+1):
+        if offset != 0:
+            maxima &= sums >= padded[:, PEDESTAL_HALFWIDTH+offset:PEDESTAL_HALFWIDTH+offset+nbins]
+    return sums, maxima
+
+
+def CountPeaks(matrix, centres=None):
+    """
+    Count the significant peaks of every channel: the pedestal, plus
+    each local maximum above it (see LocalMaxima) which stands out from
+    the lowest point between it and the pedestal by PEAK_SIGNIFICANCE
+    poisson sigmas (of the 3 bin sums). A single peak channel has no
+    photo peaks resolved, as when TSpectrum finds one peak.
+
+    centres - pedestal bin of each channel (default: PedestalCentres)
+
+    returns: array of the number of peaks (zero for empty channels).
+    """
+    if centres is None:
+        centres = PedestalCentres(matrix)
+    sums, maxima = LocalMaxima(matrix)
+    index = numpy.arange(matrix.nbins)[None, :]
+    pedestal = numpy.asarray(centres)[:, None] - 1
+
+    # Lowest sum between the pedestal and each bin:
+    valley = numpy.minimum.accumulate(numpy.where(index >= pedestal, sums, numpy.inf), axis=1)
+    significant = maxima & (index > pedestal + PEDESTAL_HALFWIDTH) & \
+                  (sums - valley > PEAK_SIGNIFICANCE*numpy.sqrt(sums + valley))
+
+    return numpy.where(matrix.Entries() > 0, 1 + significant.sum(axis=1), 0)
+
+
+def GaussianIntegral(constant, mean, sigma, low, high):
+    """
+    Vectorised integral of constant*exp(-0.5((x-mean)/sigma)^2) between
+    low and high, as TF1::Integral for a "gaus".
+    """
+    root2sig = math.sqrt(2.0)*numpy.where(sigma > 0, sigma, 1.0)
+    integral = constant*sigma*math.sqrt(math.pi/2.0)*\
+        (_erf((high - mean)/root2sig) - _erf((low - mean)/root2sig))
+    return numpy.where(sigma > 0, integral, 0.0)
+
+
+def DarkFitWindow(matrix):
+    """
+    The FitPedestals window of the estimateDarkCount fit range, in bins
+    below and above the peak.
+    """
+    binwidth = (matrix.xmax - matrix.xmin)/matrix.nbins
+    return (int(math.floor(DARK_FIT_LOW/binwidth + 1E-9)), int(math.floor(DARK_FIT_HIGH/binwidth + 1E-9)))
+
+
+####################################################################
+def EstimateDarkCounts(matrix, centres=None, window=None):
+    """
+    Batched LightYieldEstimator.estimateDarkCount. The pedestal gaussian
+    is taken from FitPedestals, over the same range as the ROOT fit
+    (14 ADC below to 3 ADC above the peak, unless a window is given),
+    then the dark count is the fraction of entries over mean + 2.2
+    sigma, after subtracting the pedestal tail.
+
+    returns: (darkcounts, valid) - channels which are not valid
+             should fall back to the ROOT fit.
+    """
+    if window is None:
+        window = DarkFitWindow(matrix)
+    fit = FitPedestals(matrix, centres, window, DARK_FIT_ITERATIONS)
+
+    threshold_bin = matrix.FindBin(fit["mean"] + DARK_NSIGMA*fit["sigma"])
+    counts_over_threshold = matrix.Integral(threshold_bin, DARK_MAXBIN)
+    counts = matrix.Integral(DARK_MINBIN, DARK_MAXBIN)
+
+    threshold = matrix.BinCenter(threshold_bin)
+    ped_over_threshold = GaussianIntegral(fit["constant"], fit["mean"], fit["sigma"],
+                                          threshold, matrix.BinCenter(DARK_MAXBIN))
+
+    with numpy.errstate(invalid="ignore", divide="ignore"):
+        dc = (counts_over_threshold - ped_over_threshold)/counts/2.
+    dc = numpy.where((counts > 0.5) & (dc > DARK_FLOOR), dc, DARK_FLOOR)
+
+    return dc, fit["valid"]
+
+
+####################################################################
+def FFTGains(matrix, mingain=3.0, maxgain=35.0, window=None, pedestals=None):
+    """
+    Estimate the gain of every channel from the spacing of the photo
+    peaks, without a peak search. The autocorrelation of each spectrum
+    is computed with one batched FFT, and the autocorrelation of the
+    fitted pedestal alone is subtracted, leaving the correlation of
+    the pedestal subtracted spectrum with the pedestal and itself.
+    The dominant lag in the allowed gain range is the peak spacing.
+
+    The gain is only valid if the peak stands out: both its height and
+    its prominence over the lowest correlation between half its lag
+    and its lag must be FFT_SIGNIFICANCE times the poisson noise of
+    the autocorrelation, var C(L) = sum n_i n_i+L (1 + n_i + n_i+L)
+    (at least one pair of entries). Channels without photo peaks, or
+    with peaks too wide to be resolved, are then not given a gain from
+    the pedestal fluctuations.
+
+    window - pedestal fit window (default: the chisquare fit over the
+             estimateDarkCount range, see EstimateDarkCounts).
+    pedestals - optional no LED HistogramMatrix of the same channels, to
+                seed the pedestal fit (default: PedestalCentres of the
+                matrix).
+
+    returns: (gains, valid) - gains in ADC counts, zero when not valid.
+    """
+    centres = PedestalCentres(matrix)
+    if not (pedestals is None):
+        centres = numpy.where(pedestals.Entries() > 0, PedestalCentres(pedestals), centres)
+    if window is None:
+        fit = FitPedestals(matrix, centres, DarkFitWindow(matrix), DARK_FIT_ITERATIONS)
+    else:
+        fit = FitPedestals(matrix, centres, window)
+    nbins = matrix.nbins
+    binwidth = (matrix.xmax - matrix.xmin)/nbins
+
+    spectrum = matrix.Weights()
+    x = matrix.BinCenter(numpy.arange(1, nbins+1)).astype(matrix.dtype)
+    sigma = numpy.where(fit["sigma"] > 0, fit["sigma"], 1.0)[:, None].astype(matrix.dtype)
+    mean = fit["mean"][:, None].astype(matrix.dtype)
+    pedestal = fit["constant"][:, None].astype(matrix.dtype)*numpy.exp(-0.5*((x[None, :] - mean)/sigma)**2)
+
+    # Zero padded FFTs, so the correlation is not circular:
+    nfft = 1
+    while nfft < 2*nbins:
+        nfft *= 2
+    transform = numpy.fft.rfft(spectrum, nfft, axis=1)
+    power = numpy.abs(transform)**2
+    correlation = numpy.fft.irfft(power - numpy.abs(numpy.fft.rfft(pedestal, nfft, axis=1))**2, nfft, axis=1)
+
+    # Poisson variance of the autocorrelation at each lag:
+    cross = numpy.conj(transform)*numpy.fft.rfft(spectrum*spectrum, nfft, axis=1)
+    variance = numpy.fft.irfft(power + 2.0*cross.real, nfft, axis=1)
+
+    # Dominant lag in the gain range, refined with a parabola through
+    # the neighbouring lags:
+    lowlag = max(int(math.floor(mingain/binwidth)), 1)
+    highlag = min(int(math.ceil(maxgain/binwidth)), nbins-2)
+    lags = numpy.arange(lowlag, highlag+1)
+    best = lags[numpy.argmax(correlation[:, lowlag:highlag+1], axis=1)]
+    rows = numpy.arange(matrix.counts.shape[0])
+    y0 = correlation[rows, best-1]
+    y1 = correlation[rows, best]
+    y2 = correlation[rows, best+1]
+    curvature = y0 - 2.0*y1 + y2
+
+    # Prominence over the valley between half the lag and the lag:
+    lag = numpy.arange(correlation.shape[1])[None, :]
+    between = (lag >= (best//2)[:, None]) & (lag <= best[:, None])
+    valley = numpy.where(between, correlation, numpy.inf).min(axis=1)
+    noise = numpy.sqrt(numpy.maximum(variance[rows, best], 0.0) + 1.0)
+
+    valid = fit["valid"] & (y1 > 0) & (y1 >= y0) & (y1 >= y2) & (curvature < 0)
+    valid &= (best > lowlag) & (best < highlag)
+    valid &= (y1 > FFT_SIGNIFICANCE*noise) & ((y1 - valley) > FFT_SIGNIFICANCE*noise)
+    with numpy.errstate(invalid="ignore", divide="ignore"):
+        shift = numpy.where(valid, 0.5*(y0 - y2)/curvature, 0.0)
+    gains = (best + shift)*binwidth
+
+    return numpy.where(valid, gains, 0.0), valid
+
+
+####################################################################
+def PreScreenChannels(matrix, findpeaks=True, fftvalid=None):
+    """
+    Classify every channel in one pass over the matrix, before any
+    fitting is done:
+      SCREEN_EMPTY - no entries.
+      SCREEN_BREAKDOWN - more than 1% of entries above ADC 240 or
+                         below bin 5 (as detectBreakdown).
+      SCREEN_SINGLEPEAK - only the pedestal is found (CountPeaks), and
+                          no photo peak spacing either (FFTGains), so
+                          the channel is probably under biased.
+      SCREEN_NORMAL - everything else.
+
+    findpeaks - look for single peak channels (False for no LED data).
+    fftvalid - FFTGains valid mask, if it has already been computed.
+
+    returns: array of the screen state for each channel.
+    """
+    codes = numpy.full(matrix.counts.shape[0], SCREEN_NORMAL, dtype=numpy.int8)
+
+    if findpeaks:
+        if fftvalid is None:
+            gains, fftvalid = FFTGains(matrix)
+        codes[(CountPeaks(matrix) < 2) & ~fftvalid] = SCREEN_SINGLEPEAK
+
+    codes[matrix.BreakdownRatios() > BREAKDOWN_RATIO] = SCREEN_BREAKDOWN
+    codes[matrix.Entries() < 1] = SCREEN_EMPTY
+
+    return codes
+
+
+def PreScreenIssues(codes, issue, comments, severity=4):
+    """
+    Generate the Issues for a pre-screen, comments is a dictionary of
+    screen state to comment, states not in comments get no issue.
+
+    returns: dictionary of ChannelUID to Issue.
+    """
+    issues = {}
+    for state, comment in comments.items():
+        for ChannelUID in numpy.nonzero(codes == state)[0]:
+            issues[int(ChannelUID)] = {"ChannelUID":int(ChannelUID), "Severity":severity,
+                                       "Issue":issue, "Comment":comment}
+    return issues
+
+
+####################################################################
+def Chi2Test(matrix1, matrix2):
+    """
+    Batched TH1::Chi2Test(h2, "UU"), the two sample chisquare test of
+    unweighted histograms, for every channel (row) of two matrices:
+
+      chi2 = sum (N2 n1 - N1 n2)^2/(n1 + n2) / (N1 N2)
+
+    over ADC bins 1..nbins with n1 + n2 > 0, where N1, N2 are the
+    totals. ndf is the number of non empty bins - 1.
+
+    The sums are always done in float64, as the differences of large
+    products lose too much precision in float32.
+
+    returns: (chi2, ndf, p-value) arrays, the p-value is zero where
+             either histogram is empty (as ROOT).
+    """
+    nbins = matrix1.nbins
+    n1 = matrix1.counts[:, 1:nbins+1].astype(numpy.float64)
+    n2 = matrix2.counts[:, 1:nbins+1].astype(numpy.float64)
+    sum1 = n1.sum(axis=1)
+    sum2 = n2.sum(axis=1)
+
+    nonempty = (n1 + n2) > 0
+    ndf = nonempty.sum(axis=1) - 1
+    diff = sum2[:, None]*n1 - sum1[:, None]*n2
+    with numpy.errstate(invalid="ignore", divide="ignore"):
+        chi2 = numpy.where(nonempty, diff*diff/numpy.where(nonempty, n1 + n2, 1.0), 0.0).sum(axis=1)
+        chi2 = numpy.where((sum1 > 0) & (sum2 > 0), chi2/(sum1*sum2), 0.0)
+
+    p = numpy.where((sum1 > 0) & (sum2 > 0), Prob(chi2, ndf), 0.0)
+    return chi2, ndf, p
+
+
+def KolmogorovTest(matrix1, matrix2):
+    """
+    Batched TH1::KolmogorovTest(h2, ""), over ADC bins 1..nbins of
+    every channel.
+
+    returns: (maximum distance, p-value) arrays, the p-value is zero
+             where either histogram is empty (as ROOT).
+    """
+    nbins = matrix1.nbins
+    n1 = matrix1.counts[:, 1:nbins+1].astype(numpy.float64)
+    n2 = matrix2.counts[:, 1:nbins+1].astype(numpy.float64)
+    sum1 = n1.sum(axis=1)
+    sum2 = n2.sum(axis=1)
+    valid = (sum1 > 0) & (sum2 > 0)
+
+    s1 = numpy.where(valid, sum1, 1.0)
+    s2 = numpy.where(valid, sum2, 1.0)
+    distance = numpy.abs(numpy.cumsum(n1, axis=1)/s1[:, None] - \
+                         numpy.cumsum(n2, axis=1)/s2[:, None]).max(axis=1)
+    z = distance*numpy.sqrt(s1*s2/(s1 + s2))
+
+    return numpy.where(valid, distance, 0.0), numpy.where(valid, KolmogorovProb(z), 0.0)
+
+
+####################################################################
+def Prob(chi2, ndf):
+    """
+    Vectorised TMath::Prob, the probability of exceeding chi2 with ndf
+    degrees of freedom.
+    """
+    chi2 = numpy.asarray(chi2, dtype=numpy.float64)
+    ndf = numpy.asarray(ndf, dtype=numpy.float64)
+    chi2, ndf = numpy.broadcast_arrays(chi2, ndf)
+
+    valid = (ndf > 0) & (chi2 > 0)
+    p = GammaQ(numpy.where(valid, 0.5*ndf, 1.0), numpy.where(valid, 0.5*chi2, 1.0))
+    p = numpy.where(valid, p, 0.0)
+    return numpy.where((ndf > 0) & (chi2 == 0), 1.0, p)
+
+
+def GammaQ(a, x):
+    """
+    Vectorised regularised upper incomplete gamma function Q(a, x), for
+    a > 0 and x > 0. Uses the series for x < a+1 and the continued
+    fraction otherwise (Numerical Recipes 6.2).
+    """
+    a, x = numpy.broadcast_arrays(numpy.asarray(a, dtype=numpy.float64),
+                                  numpy.asarray(x, dtype=numpy.float64))
+    prefactor = numpy.exp(-x + a*numpy.log(x) - _lgamma(a))
+    series = x < a + 1.0
+
+    # Series for P(a, x):
+    ap = a.copy()
+    term = 1.0/a
+    total = term.copy()
+    for n in range(GAMMA_ITERATIONS):
+        ap += 1.0
+        term = term*x/ap
+        total += term
+        if numpy.all(numpy.abs(term) < numpy.abs(total)*GAMMA_EPS):
+            break
+    p_series = total*prefactor
+
+    # Continued fraction for Q(a, x), modified Lentz:
+    tiny = 1E-300
+    b = x + 1.0 - a
+    c = numpy.full(x.shape, 1.0/tiny)
+    d = 1.0/numpy.where(b == 0, tiny, b)
+    h = d.copy()
+    for i in range(1, GAMMA_ITERATIONS+1):
+        an = -i*(i - a)
+        b = b + 2.0
+        d = an*d + b
+        d = numpy.where(numpy.abs(d) < tiny, tiny, d)
+        c = b + an/c
+        c = numpy.where(numpy.abs(c) < tiny, tiny, c)
+        d = 1.0/d
+        delta = d*c
+        h = h*delta
+        if numpy.all(numpy.abs(delta - 1.0) < GAMMA_EPS):
+            break
+    q_fraction = h*prefactor
+
+    return numpy.clip(numpy.where(series, 1.0 - p_series, q_fraction), 0.0, 1.0)
+
+
+def KolmogorovProb(z):
+    """
+    Vectorised TMath::KolmogorovProb.
+    """
+    z = numpy.asarray(z, dtype=numpy.float64)
+    w = 2.50662827
+    c1 = -math.pi**2/8.0
+    fj = [-2.0, -8.0, -18.0, -32.0]
+
+    with numpy.errstate(over="ignore", divide="ignore", invalid="ignore"):
+        # Small z:
+        v = 1.0/(z*z)
+        small = 1.0 - w*(numpy.exp(c1*v) + numpy.exp(9*c1*v) + numpy.exp(25*c1*v))/z
+
+        # Large z, using up to four terms of the series:
+        maxj = numpy.maximum(1, numpy.rint(3.0/numpy.where(z > 0, z, 1.0)))
+        v = z*z
+        large = numpy.zeros(z.shape)
+        for j in range(4):
+            large += numpy.where(j < maxj, (-1)**j*numpy.exp(fj[j]*v), 0.0)
+        large *= 2.0
+
+    return numpy.where(z < 0.2, 1.0,
+           numpy.where(z < 0.755, small,
+           numpy.where(z < 6.8116, large, 0.0)))
+
+
+####################################################################
+def CompareHistogramTests(hist1, hist2, channels=None, tolerance=1E-6):
+    """
+    Check the batched chisquare and KS tests against TH1::Chi2Test and
+    TH1::KolmogorovTest, for channels with data in both histograms.
+
+    returns: True if every p-value agrees within the tolerance.
+    """
+    from HistogramMatrix import HistogramMatrix
+
+    matrix1 = HistogramMatrix.FromTH2(hist1)
+    matrix2 = HistogramMatrix.FromTH2(hist2)
+    chi2, ndf, chi2_p = Chi2Test(matrix1, matrix2)
+    distance, ks_p = KolmogorovTest(matrix1, matrix2)
+
+    if channels is None:
+        channels = range(0, matrix1.counts.shape[0], 64)
+
+    failed = 0
+    checked = 0
+    for channel in channels:
+        h1 = hist1.ProjectionY("th1d_test1", channel+1, channel+1, "")
+        h2 = hist2.ProjectionY("th1d_test2", channel+1, channel+1, "")
+        if h1.GetEntries() < 1 or h2.GetEntries() < 1:
+            continue
+        reference_chi2 = h1.Chi2Test(h2, "UU")
+        reference_ks = h1.KolmogorovTest(h2, "")
+        checked += 1
+        if abs(reference_chi2 - chi2_p[channel]) > tolerance or \
+           abs(reference_ks - ks_p[channel]) > tolerance:
+            failed += 1
+            print ("channel: %i, chi2 ROOT: %.6f, batched: %.6f, KS ROOT: %.6f, batched: %.6f"%\
+                   (channel, reference_chi2, chi2_p[channel], reference_ks, ks_p[channel]))
+
+    print ("Histogram test check: %i of %i channels outside tolerance %g"%(failed, checked, tolerance))
+    return failed == 0
+
+
+####################################################################
+def CompareLowMemory(counts, xmin=-0.5, xmax=255.5):
+    """
+    Accuracy check of the low memory (uint32/float32) matrices against
+    the float64 path, on the same counts. Prints the largest differences
+    of each estimate over all the channels.
+
+    returns: True if every estimate is within its tolerance.
+    """
+    from HistogramMatrix import HistogramMatrix
+
+    full = HistogramMatrix(counts, xmin, xmax)
+    low = HistogramMatrix(counts, xmin, xmax, lowmemory=True)
+
+    # name: (float64, float32, absolute tolerance)
+    checks = {}
+    checks["Entries"] = (full.Entries(), low.Entries(), 0.5)
+    checks["Mean"] = (full.Mean(), low.Mean(), 1E-3)
+    checks["RMS"] = (full.RMS(), low.RMS(), 1E-3)
+    checks["BreakdownRatios"] = (full.BreakdownRatios(), low.BreakdownRatios(), 1E-6)
+    checks["DarkCounts"] = (EstimateDarkCounts(full)[0], EstimateDarkCounts(low)[0], 1E-5)
+    checks["FFTGains"] = (FFTGains(full)[0], FFTGains(low)[0], 0.01)
+    checks["Chi2Test"] = (Chi2Test(full, full)[2], Chi2Test(low, low)[2], 1E-9)
+
+    passed = True
+    for name in sorted(checks):
+        reference, test, tolerance = checks[name]
+        difference = numpy.abs(numpy.asarray(reference, dtype=numpy.float64) - test).max()
+        print ("%-16s max difference: %.3g (tolerance %.3g)"%(name, difference, tolerance))
+        passed = passed and (difference <= tolerance)
+
+    print ("Memory: float64 %.1f MB, low memory %.1f MB"%\
+           (full.counts.nbytes/1E6, low.counts.nbytes/1E6))
+    return passed
+
+
+####################################################################
+def CompareDarkCounts(allpeds, channels=None, tolerance=0.002):
+    """
+    Check the batched dark counts against the ROOT fit of
+    LightYieldEstimator.estimateDarkCount, for channels with data.
+
+    returns: True if every channel agrees within the (absolute) tolerance.
+    """
+    from HistogramMatrix import HistogramMatrix
+    from LightYieldEstimator import LightYieldEstimator
+
+    matrix = HistogramMatrix.FromTH2(allpeds)
+    batched, valid = EstimateDarkCounts(matrix)
+
+    if channels is None:
+        channels = range(0, matrix.counts.shape[0], 64)
+
+    lye = LightYieldEstimator()
+    failed = 0
+    checked = 0
+    for channel in channels:
+        if not valid[channel]:
+            continue
+        ch = allpeds.ProjectionY("th1d_projecty", channel+1, channel+1, "")
+        if ch.GetEntries() < 1:
+            continue
+        reference = lye.estimateDarkCount(ch, [ch.GetBinCenter(ch.GetMaximumBin())])
+        checked += 1
+        if abs(reference - batched[channel]) > tolerance:
+            failed += 1
+            print ("channel: %i, fit: %.5f, batched: %.5f"%(channel, reference, batched[channel]))
+
+    print ("Dark count check: %i of %i channels outside tolerance %.4f"%(failed, checked, tolerance))
+    return failed == 0
+
+
+####################################################################
+def SyntheticSpectra(nchannels, seed=1, mu=(0.002, 0.05), nbins=256):
+    """
+    Random pedestal and photo peak spectra (poisson number of photo
+    electrons, mean uniform in the mu range) with the layout of a
+    HistogramMatrix on the default ADC axis, for checks which need no
+    DAQ file.
+
+    returns: (counts, parameters) - parameters is an array of the
+             pedestal mean, pedestal sigma, gain and mu of each channel.
+    """
+    random = numpy.random.RandomState(seed)
+    x = numpy.arange(nbins, dtype=numpy.float64)
+    npe = numpy.arange(12)
+    factorial = numpy.cumprod(numpy.maximum(npe, 1)).astype(numpy.float64)
+
+    counts = numpy.zeros((nchannels, nbins+2))
+    parameters = numpy.zeros((nchannels, 4))
+    for channel in range(nchannels):
+        mean = random.uniform(20, 45)
+        sigma = random.uniform(1.5, 4)
+        gain = random.uniform(6, 20)
+        spread = random.uniform(0.5, 2)
+        lam = random.uniform(mu[0], mu[1])
+        entries = random.randint(5000, 60000)
+
+        widths = numpy.hypot(sigma, spread*numpy.sqrt(npe))
+        weights = numpy.exp(-lam)*lam**npe/factorial/widths
+        shape = (weights[:, None]*numpy.exp(-0.5*((x[None, :] - mean - npe[:, None]*gain)/widths[:, None])**2)).sum(axis=0)
+        counts[channel, 1:nbins+1] = random.poisson(entries*shape/shape.sum())
+        parameters[channel] = (mean, sigma, gain, lam)
+    return counts, parameters
+
+
+def ReferenceDarkCount(counts, xmin=-0.5, xmax=255.5, maxiterations=200):
+    """
+    Numpy emulation of LightYieldEstimator.estimateDarkCount (with the
+    peak at the maximum bin) for one channel, counts including the
+    under/overflow bins. The gaussian is fitted by Levenberg-Marquardt
+    minimisation of the TH1::Fit chisquare, independently of the
+    batched FitPedestals.
+    """
+    nbins = len(counts) - 2
+    width = (xmax - xmin)/nbins
+    centres = xmin + (numpy.arange(1, nbins+1) - 0.5)*width
+    contents = numpy.asarray(counts[1:nbins+1], dtype=numpy.float64)
+
+    peak = centres[numpy.argmax(contents)]
+    used = (centres >= peak - DARK_FIT_LOW) & (centres <= peak + DARK_FIT_HIGH) & (contents > 0)
+    x = centres[used]
+    y = contents[used]
+
+    def Chisquare(p):
+        return ((y - p[0]*numpy.exp(-0.5*((x - p[1])/p[2])**2))**2/y).sum()
+
+    p = numpy.array([y.max(), peak, 2.0])
+    chisquare = Chisquare(p)
+    damping = 1E-3
+    for iteration in range(maxiterations):
+        u = (x - p[1])/p[2]
+        f = p[0]*numpy.exp(-0.5*u*u)
+        J = numpy.stack([f/p[0], f*u/p[2], f*u*u/p[2]], axis=1)/numpy.sqrt(y)[:, None]
+        H = numpy.dot(J.T, J)
+        G = numpy.dot(J.T, (y - f)/numpy.sqrt(y))
+        while damping < 1E10:
+            step = numpy.linalg.solve(H + damping*numpy.diag(numpy.diag(H)), G)
+            trial = p + step
+            trial_chisquare = Chisquare(trial) if trial[2] > 0 else numpy.inf
+            if trial_chisquare < chisquare:
+                p, chisquare, damping = trial, trial_chisquare, damping*0.3
+                break
+            damping *= 10.
+        if damping >= 1E10 or numpy.abs(step).max() < 1E-9:
+            break
+    constant, mean, sigma = p
+
+    threshold_bin = int(math.floor((mean + DARK_NSIGMA*sigma - xmin)/width)) + 1
+    counts_over_threshold = counts[threshold_bin:DARK_MAXBIN+1].sum()
+    total = counts[DARK_MINBIN:DARK_MAXBIN+1].sum()
+    threshold = xmin + (threshold_bin - 0.5)*width
+    ped_over_threshold = GaussianIntegral(constant, mean, sigma, threshold, xmin + (DARK_MAXBIN - 0.5)*width)
+
+    if total > 0.5:
+        dc = (counts_over_threshold - ped_over_threshold)/total/2.
+        return dc if dc > DARK_FLOOR else DARK_FLOOR
+    return DARK_FLOOR
+
+
+def CheckDarkCounts(nchannels=200, tolerance=0.002, seed=1):
+    """
+    Check the batched dark counts against ReferenceDarkCount on
+    synthetic spectra (SyntheticSpectra), needing no ROOT or DAQ file.
+
+    returns: True if every channel agrees within the (absolute) tolerance.
+    """
+    from HistogramMatrix import HistogramMatrix
+
+    counts, parameters = SyntheticSpectra(nchannels, seed)
+    batched, valid = EstimateDarkCounts(HistogramMatrix(counts))
+
+    failed = 0
+    worst = 0.
+    for channel in range(nchannels):
+        reference = ReferenceDarkCount(counts[channel])
+        difference = abs(reference - batched[channel])
+        worst = max(worst, difference)
+        if not valid[channel] or difference > tolerance:
+            failed += 1
+            print ("channel: %i, reference: %.5f, batched: %.5f"%(channel, reference, batched[channel]))
+
+    print ("Synthetic dark count check: %i of %i channels outside tolerance %.4f (largest difference %.2g)"%\
+           (failed, nchannels, tolerance, worst))
+    return failed == 0
+
+
+####################################################################
+if __name__ == "__main__":
+
+    import sys
+    from HistogramMatrix import HistogramMatrix
+
+    print (module_description)
+
+    tolerance = float(sys.argv[2]) if len(sys.argv) > 2 else 0.002
+    passed = CheckDarkCounts(tolerance=tolerance)
+    if len(sys.argv) < 2:
+        sys.exit(0 if passed else 1)
+
+    import TrDAQReader
+    allpeds = TrDAQReader.TrDAQRead(sys.argv[1])["RawADCs"]
+
+    passed = CompareDarkCounts(allpeds, tolerance=tolerance) and passed
+
+    matrix = HistogramMatrix.FromTH2(allpeds)
+    passed = CompareLowMemory(matrix.counts, matrix.xmin, matrix.xmax) and passed
+
+    if len(sys.argv) > 3:
+        otherpeds = TrDAQReader.TrDAQRead(sys.argv[3])["RawADCs"]
+        passed = CompareHistogramTests(allpeds, otherpeds) and passed
+
+    if not passed:
+        sys.exit(1)
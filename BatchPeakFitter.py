@@ -0,0 +1,160 @@
+#!/usr/bin/env python
+module_description=\
+"""
+Batched gaussian peak fitter.
+
+Refines the position of every photo peak in every channel at once,
+replacing the per peak ROOT fits of LightYieldEstimator.fitPeak. Each
+peak is fitted with a gaussian in a window of +- gain/3 about the
+initial peak position (as fitPeak), by a damped Gauss-Newton
+(Levenberg-Marquardt) minimisation of the chisquare, vectorised
+over all the peaks.
+"""
+
+import math
+import numpy
+
+# Fit settings:
+N_ITERATIONS = 20
+LAMBDA_START = 1E-3
+
+
+def _gaus(x, par):
+    return par[..., 0:1]*numpy.exp(-0.5*((x - par[..., 1:2])/par[..., 2:3])**2)
+
+
+def _chisq(x, n, w, par):
+    return (w*(n - _gaus(x, par))**2).sum(axis=-1)
+
+
+####################################################################
+def FitPeaks(matrix, peaks, gains, halfwidth=1.0/3.0):
+    """
+    Fit a gaussian to each peak of each channel.
+
+    matrix - HistogramMatrix
+    peaks - array [channel, npeaks] of initial peak positions,
+            NaN where there is no peak.
+    gains - array [channel], the fit window is +- gain*halfwidth.
+
+    returns: array [channel, npeaks, 6] of
+             [constant, mean, sigma, e_constant, e_mean, e_sigma],
+             the same ordering as LightYieldEstimator.fitPeak. Failed
+             fits are NaN.
+    """
+    peaks = numpy.asarray(peaks, dtype=numpy.float64)
+    gains = numpy.asarray(gains, dtype=numpy.float64)
+    nchan, npeaks = peaks.shape
+    rows = numpy.repeat(numpy.arange(nchan), npeaks)
+    centres = peaks.reshape(-1)
+    widths = numpy.repeat(gains*halfwidth, npeaks)
+    ok = numpy.isfinite(centres) & (widths > 0)
+    centres = numpy.where(ok, centres, 0.0)
+    widths = numpy.where(ok, widths, 0.0)
+
+    # Gather the bins of each window, ROOT fits the bins whose centre
+    # is inside the fit range:
+    binwidth = (matrix.xmax - matrix.xmin)/matrix.nbins
+    nwin = int(math.ceil(2.0*(widths.max() if len(widths) else 0.0)/binwidth)) + 2
+    first = matrix.FindBin(centres - widths)
+    bins = numpy.clip(first[:, None] + numpy.arange(nwin)[None, :], 1, matrix.nbins)
+    x = matrix.BinCenter(bins)
+    n = matrix.counts[rows[:, None], bins].astype(numpy.float64)
+    inside = (numpy.abs(x - centres[:, None]) <= widths[:, None]) & \
+             (bins == first[:, None] + numpy.arange(nwin)[None, :])
+
+    # Chisquare weights (1/error^2 with sqrt(n) errors, empty bins skipped):
+    w = numpy.where(inside & (n > 0), 1.0/numpy.where(n > 0, n, 1.0), 0.0)
+    ok &= (w > 0).sum(axis=1) >= 3
+
+    # Starting values:
+    centrebins = numpy.clip(matrix.FindBin(centres), 1, matrix.nbins)
+    par = numpy.empty((len(centres), 3))
+    par[:, 0] = numpy.maximum(matrix.counts[rows, centrebins], 1.0)
+    par[:, 1] = centres
+    par[:, 2] = numpy.maximum(widths/2.0, binwidth)
+
+    lam = numpy.full(len(centres), LAMBDA_START)
+    chisq = _chisq(x, n, w, par)
+    for iteration in range(N_ITERATIONS):
+        J = _jacobian(x, par)
+        residual = n - _gaus(x, par)
+        JTW = J*w[:, None, :]
+        H = numpy.einsum("kiw,kjw->kij", JTW, J)
+        g = numpy.einsum("kiw,kw->ki", JTW, residual)
+
+        # Damped normal equations:
+        Hd = H + lam[:, None, None]*H*numpy.eye(3)[None, :, :]
+        Hd[~ok] = numpy.eye(3)
+        step = numpy.linalg.solve(Hd, g[:, :, None])[:, :, 0]
+        trial = par + step
+        trial[:, 2] = numpy.abs(trial[:, 2])
+        trial_chisq = _chisq(x, n, w, trial)
+
+        # Accept improvements which keep the mean inside the window:
+        better = ok & (trial_chisq < chisq) & numpy.all(numpy.isfinite(trial), axis=1) & \
+                 (numpy.abs(trial[:, 1] - centres) <= widths)
+        par[better] = trial[better]
+        chisq = numpy.where(better, trial_chisq, chisq)
+        lam = numpy.where(better, lam*0.1, lam*10.0)
+
+    # Parameter errors from the covariance matrix (inverse of the
+    # chisquare hessian / 2):
+    J = _jacobian(x, par)
+    H = numpy.einsum("kiw,kjw->kij", J*w[:, None, :], J)
+    H[~ok] = numpy.eye(3)
+    singular = numpy.abs(numpy.linalg.det(H)) < 1E-300
+    H[singular] = numpy.eye(3)
+    errors = numpy.sqrt(numpy.abs(numpy.diagonal(numpy.linalg.inv(H), axis1=1, axis2=2)))
+
+    ok &= ~singular
+    results = numpy.concatenate([par, errors], axis=1)
+    results[~ok] = numpy.nan
+    return results.reshape(nchan, npeaks, 6)
+
+
+def _jacobian(x, par):
+    """
+    Derivatives of the gaussian wrt [constant, mean, sigma], shape
+    [peak, 3, bin].
+    """
+    N = par[:, 0:1]
+    mu = par[:, 1:2]
+    sig = par[:, 2:3]
+    d = (x - mu)/sig
+    e = numpy.exp(-0.5*d*d)
+    return numpy.stack([e, N*e*d/sig, N*e*d*d/sig], axis=1)
+
+
+####################################################################
+def RefinePeaks(LYEs, matrix, tolerance=3.0):
+    """
+    Fit the peaks of a list of LightYieldEstimators (one per row of the
+    matrix, None to skip), and copy the fitted means back to the peaks
+    where they moved less than the tolerance - as the fitPeak loops in
+    ADCCalibrator.
+
+    returns: number of peak fits rejected.
+    """
+    npeaks = max([len(lye.Peaks) for lye in LYEs if lye is not None] + [1])
+    peaks = numpy.full((len(LYEs), npeaks), numpy.nan)
+    gains = numpy.zeros(len(LYEs))
+    for i, lye in enumerate(LYEs):
+        if lye is None:
+            continue
+        peaks[i, :len(lye.Peaks)] = lye.Peaks
+        gains[i] = lye.gain
+
+    results = FitPeaks(matrix, peaks, gains)
+
+    rejected = 0
+    for i, lye in enumerate(LYEs):
+        if lye is None:
+            continue
+        for p in range(len(lye.Peaks)):
+            mean = results[i, p, 1]
+            if (abs(mean - lye.Peaks[p]) < tolerance) and (not math.isnan(mean)):
+                lye.Peaks[p] = float(mean)
+            else:
+                rejected += 1
+    return rejected
@@ -14,15 +14,18 @@ module_description = \
 # Modules
 import sys
 import ROOT
-from _abcoll import Iterable
 #sys.path.insert(0, '/home/daq/tracker/analysis')
 sys.path.insert(0,'/home/ed/MICE/tracker/analysis')
 from TrDAQReader import TrDAQRead
 import os
 import json
 import math
+import multiprocessing
 import LightYieldEstimator
 import numpy
+from HistogramMatrix import HistogramMatrix
+import BatchEstimators
+import CampaignResults
 
 # Channel Definitions:
 CHAN_PER_MOD = 64
@@ -34,6 +37,16 @@ NUM_CHANS = NUM_BOARDS*MOD_PER_BOARD*CHAN_PER_MOD
 valid_dataset_keys = ['LEDState', 'bias', 'filename', 'filepath']
 cmp_tol = 1E-6
 
+# Module calibration: the bias scan points (between 4-8v 0.05v incremenets),
+# the number of low bias points the dark counts are zeroed over, and the
+# target dark count fraction.
+# Note: david uses a 2% target for the noise in Lab7. This was a 140ns integration
+# gate, in the hall we are using a 165ns integration gate, so this has been
+# scaled accordingly.
+BiasPoints = numpy.arange(4,8,0.05)
+ZeroPoints = 8
+DarkCountTarget = 0.023
+
 
 ####################################################################
 def main ():
@@ -60,7 +73,16 @@ def main ():
     campaign = None
     ChannelIDs = range(0,8*1024) # +  range(7*512,8*512)
     ModuleIDs = GenerateModules(ChannelIDs)
-    tempfilename = "stage1.json"
+    tempfilename = "stage1.json" # and stage1.npz, see CampaignResults.SaveCampaign
+    
+    # Optional configuration of the light yield processing steps and
+    # histogram matrices:
+    config = {}
+    config_file = os.path.join(calibration_dir, "config.json")
+    if os.path.exists(config_file):
+        with open(config_file, "r") as f:
+            config = json.load(f)
+    LightYieldEstimator.ConfigureSteps(config)
     
     if not skip:
         calibration_file = os.path.join(calibration_dir, "campaign.json")
@@ -74,30 +96,23 @@ def main ():
             SetupDatasetChannels(dataset)
     
         print ("Processing Channels")
-        ProcessChannels(campaign, ChannelIDs)
-        
-        print ("Storing JSON dunp of module processing:")
-        #Strip the junk:
-        for dataset in campaign:
-            dataset.pop("allpeds",None)
-        #Write:
+        ProcessChannels(campaign, ChannelIDs, config.get("LowMemoryHistograms", False),
+                        config.get("Processes", None))
+        LightYieldEstimator.PrintStepReport()
         
-        with open( os.path.join(calibration_dir, tempfilename), 'w') as outfile:
-            json.dump(campaign, outfile)
+        print ("Storing checkpoint of module processing:")
+        CampaignResults.SaveCampaign(campaign, os.path.join(calibration_dir, tempfilename))
         
     else:
         calibration_file = os.path.join(calibration_dir, tempfilename)
-        campaign = GetCampaignFromJSON (calibration_file)
+        campaign = CampaignResults.LoadCampaign(calibration_file)
     
     # Perform Modules Calibration:     
     # Orignal code used "Highest.." now using by weight:
     #CalibrateModules_Highest(campaign, ModuleIDs, 0.02)
     
-    CalibrateModules_Weight(campaign, ModuleIDs, LinearWeight, {"target":0.023})
-    #CalibrateModules_Weight(campaign, ModuleIDs, LinearWeightLimit, {"target":0.023, "limit":0.015})
-    # Note: david uses a 2% target for the noise in Lab7. This was a 140ns integration
-    # gate, in the hall we are using a 165ns integration gate, so this has been
-    # scaled accordingly.
+    CalibrateModules_Weight(campaign, ModuleIDs, LinearWeight, {"target":DarkCountTarget})
+    #CalibrateModules_Weight(campaign, ModuleIDs, LinearWeightLimit, {"target":DarkCountTarget, "limit":0.015})
     
     # Dump output:
     for m in ModuleIDs:
@@ -152,113 +167,150 @@ def SetupDatasetChannels(dataset, biases=None, LEDIntensity=None ):
         
     """
     
-    # Check Bias Length..
-    # Note this is either a scalar, reresenting the entire bias state, or
-    # an array, with a bias for each ChannelID
+    # Note the bias is either a scalar, reresenting the entire bias state,
+    # or an array, with a bias for each ChannelID
     if biases is None:
         biases = dataset['bias']    
-    if biases is Iterable:
-        if len(biases) != NUM_CHANS:
-            print "ERROR: Invalid bias list"
             
     # Setup the LED Intensity:
     # Note this is either a scalar, reresenting the entire LED state, or
     # an array, with an intensity for each ChannelID
     if LEDIntensity is None:
         LEDIntensity = dataset["LEDIntensity"] if "LEDIntensity" in dataset else 1.0    
-    if LEDIntensity is Iterable:
-        if len(LEDIntensity) != NUM_CHANS:
-            print "ERROR: Invalid ledIntensity list"
     # If LED Is off, turn off led:
     if dataset["LEDState"] == "OFF":
             LEDIntensity = 0.0
     
-    
-    # Setup the channel entry:
-    dataset["channels"] = []
-    for ChannelID in range(NUM_CHANS):
-        
-        channel_dict = GenerateModuleData (ChannelID)
-        channel_dict["ChannelID"] = ChannelID
-        channel_dict["OK"] = True
-        
-        # Removed, replaced by GenerateModuleData.
-        # Fill in data for each module:
-        #ModuleID = ChannelID/CHAN_PER_MOD
-        #Board = ModuleID/MOD_PER_BOARD
-        #Module = ModuleID%MOD_PER_BOARD
-        #Channel = ChannelID%(CHAN_PER_MOD*MOD_PER_BOARD)
-        #channel_dict = {"ChannelID":ChannelID, "ModuleID":ModuleID,\
-        #                "Channel":Channel, "Module":Module, "Board":Board,\
-        #                "OK":True}
-                        
-        # Get Bias:
-        if biases is Iterable:
-            channel_dict["bias"] = biases[ChannelID]
-        else:
-            channel_dict["bias"] = biases
-            
-        # Get LED Intensity:
-        if LEDIntensity is Iterable:
-            channel_dict["LEDIntensity"] = LEDIntensity[ChannelID]
-        else:
-            channel_dict["LEDIntensity"] = LEDIntensity
-            
-        # Append to the list:
-        dataset["channels"].append(channel_dict)
+    # Setup the channel results, as arrays over the channels:
+    results = CampaignResults.CampaignResults(NUM_CHANS)
+    try:
+        results.columns["bias"][:] = biases
+    except ValueError:
+        print "ERROR: Invalid bias list"
+    try:
+        results.columns["LEDIntensity"][:] = LEDIntensity
+    except ValueError:
+        print "ERROR: Invalid ledIntensity list"
+    dataset["channels"] = results
         
     return dataset
         
 ####################################################################
-def ProcessChannels(campaign, channel_list=None):
+def ProcessChannels(campaign, channel_list=None, lowmemory=False, processes=None):
     """
     Take a dataset and process each channel in the list (if it is available).
     Does the LED data first, and looks to this for the peak locations on
     no LED data.
+    
+    The datasets are processed in two phases: the LED channels of every
+    dataset, then the no LED channels (using the matched LED results of
+    the first phase). The datasets of a phase are independent, so are
+    processed in a pool of worker processes, and their results merged
+    into the campaign in dataset order (the same results as processing
+    them one by one).
+    
+    lowmemory - use uint32/float32 histogram matrices (see HistogramMatrix).
+    processes - number of worker processes (default, the number of
+                CPUs), 1 processes the datasets in this process.
     """
 
     if channel_list is None:
         channel_list = range (NUM_CHANS)
+    if processes is None:
+        processes = multiprocessing.cpu_count()
+    channel_list = numpy.array(channel_list, dtype=int)
     
-    # Iterate over each channel which requires processing, doing the
-    # LED Data first:
-    for ChannelID in channel_list:
+    for led_state in [True, False]:
         
-        # Ordered list for processing campaign data:
-        DatasetIDOrdered = []
-        for state in [True, False]:
-            for DatasetID in range(len(campaign)):
-                if state == (False if campaign[DatasetID]["channels"][ChannelID]["LEDIntensity"] < 1E-6 else True):
-                    DatasetIDOrdered.append(DatasetID)
-    
-        # Loop over the ordered campaign IDs
-        for DatasetID in DatasetIDOrdered:
-            
-            # Load histogram of channel:
-            ped = campaign[DatasetID]["allpeds"].ProjectionY("th1d_projecty",ChannelID+1,ChannelID+1,"")
-            if (ped.GetEntries() < 1):
-                print ("Skipping channel with no data...")
-                continue
-            
-            # Load Channel into Light Yield Estimator:
-            channel_LYE = LightYieldEstimator.LightYieldEstimator(campaign[DatasetID]["channels"][ChannelID])
-            
-            # Look for LED Data:
-            led_state = False if campaign[DatasetID]["channels"][ChannelID]["LEDIntensity"] < 1E-6 else True
-            led_channel_run = None
-            if not led_state:
-                led_channel_run = GetMatchedChannel(campaign, channel_LYE.ChannelID, channel_LYE.bias, True)
-            if (led_channel_run is campaign[DatasetID]["channels"][ChannelID]):
-                print ("overlapping led detected...")
+        # Channels of each dataset in this phase:
+        tasks = []
+        for DatasetID in range(len(campaign)):
+            led = campaign[DatasetID]["channels"].columns["LEDIntensity"][channel_list] >= 1E-6
+            ChannelIDs = channel_list[led == led_state]
+            if len(ChannelIDs) > 0:
+                tasks.append((DatasetID, ChannelIDs, lowmemory))
+        
+        print ("Processing %i %s datasets"%(len(tasks), "LED" if led_state else "no LED"))
+        if processes <= 1 or len(tasks) <= 1:
+            for DatasetID, ChannelIDs, lowmemory in tasks:
+                ProcessDataset(campaign, DatasetID, ChannelIDs, lowmemory)
+            continue
+        
+        # Workers are forked with the campaign as it is now (histograms
+        # and the results of the earlier phase), and return their
+        # dataset's results:
+        global _worker_campaign
+        _worker_campaign = campaign
+        pool = multiprocessing.Pool(min(processes, len(tasks)))
+        try:
+            outputs = pool.map(_ProcessDatasetWorker, tasks, 1)
+        finally:
+            pool.close()
+            pool.join()
+            _worker_campaign = None
             
-            #print ("Running channel: %i, bias: %.2f, led: %s, ledrun: %r"%\
-            #       (channel_LYE.ChannelID, channel_LYE.bias, led_state, not (led_channel_run is None) ) )
-            led_lye = None if led_channel_run is None else LightYieldEstimator.LightYieldEstimator(led_channel_run)
-            try:
-                channel_LYE.process(ped, led_lye)
-            except:
-                print "Error processing channel data.. Dataset:", DatasetID, "Channel:", ChannelID
-            campaign[DatasetID]["channels"][ChannelID] = channel_LYE.getMap()
+        for (DatasetID, ChannelIDs, lowmemory), (results, stats) in zip(tasks, outputs):
+            campaign[DatasetID]["channels"].Merge(results, ChannelIDs)
+            LightYieldEstimator.chain.merge(stats)
+
+####################################################################
+def ProcessDataset(campaign, DatasetID, ChannelIDs, lowmemory=False):
+    """
+    Process a list of channels of one dataset (see ProcessChannels), the
+    LED channels they are matched to must already be processed.
+    """
+    
+    # Batched pedestal fit dark count estimates, used in place of the
+    # per channel fit where the estimate is valid, and a pre-screen of
+    # the empty and breakdown channels:
+    matrix = HistogramMatrix.FromTH2(campaign[DatasetID]["allpeds"], lowmemory)
+    estimates, valid = BatchEstimators.EstimateDarkCounts(matrix)
+    darkcount_estimates = [float(e) if v else None for e, v in zip(estimates, valid)]
+    screens = BatchEstimators.PreScreenChannels(matrix, findpeaks=False)
+    del matrix
+    
+    for ChannelID in ChannelIDs:
+        
+        # Load histogram of channel:
+        if screens[ChannelID] == BatchEstimators.SCREEN_EMPTY:
+            print ("Skipping channel with no data...")
+            continue
+        ped = campaign[DatasetID]["allpeds"].ProjectionY("th1d_projecty",ChannelID+1,ChannelID+1,"")
+        
+        # Load Channel into Light Yield Estimator:
+        channel_LYE = LightYieldEstimator.LightYieldEstimator(campaign[DatasetID]["channels"][ChannelID])
+        
+        # Look for LED Data:
+        led_state = False if campaign[DatasetID]["channels"][ChannelID]["LEDIntensity"] < 1E-6 else True
+        led_channel_run = None
+        if not led_state:
+            led_channel_run = GetMatchedChannel(campaign, channel_LYE.ChannelID, channel_LYE.bias, True)
+        if (led_channel_run is not None) and (led_channel_run.results is campaign[DatasetID]["channels"]):
+            print ("overlapping led detected...")
+        
+        #print ("Running channel: %i, bias: %.2f, led: %s, ledrun: %r"%\
+        #       (channel_LYE.ChannelID, channel_LYE.bias, led_state, not (led_channel_run is None) ) )
+        led_lye = None if led_channel_run is None else LightYieldEstimator.LightYieldEstimator(led_channel_run)
+        try:
+            channel_LYE.process(ped, led_lye, darkcount=darkcount_estimates[ChannelID],
+                                screen=screens[ChannelID])
+        except:
+            print "Error processing channel data.. Dataset:", DatasetID, "Channel:", ChannelID
+        campaign[DatasetID]["channels"].Store(ChannelID, channel_LYE.getMap())
+
+# Campaign of the ProcessChannels worker processes (inherited when they
+# are forked):
+_worker_campaign = None
+
+def _ProcessDatasetWorker(task):
+    """
+    Process a dataset in a worker process, returning its results and the
+    light yield step counters.
+    """
+    DatasetID, ChannelIDs, lowmemory = task
+    LightYieldEstimator.chain.reset()
+    ProcessDataset(_worker_campaign, DatasetID, ChannelIDs, lowmemory)
+    return _worker_campaign[DatasetID]["channels"], LightYieldEstimator.chain.stats()
             
 
 def CheckChannelQuality(campaign, channel_list=None):
@@ -377,50 +429,55 @@ def CalibrateModules_Highest(campaign, Modules, GoodRatio):
         #Module["bestRatio"] = bestRatio
 
 ####################################################################
-def CalibrateModules_Weight(campaign, Modules, DarkWeightFunc, FuncArgs, DefunctChannels = []):
+def CalibrateModules_Weight(campaign, Modules, DarkWeightFunc, FuncArgs, DefunctChannels = [], verbose=True):
     """
     Use a wrighting function to obtain the optimum biases,
     the function will return a low value when close to optimum..
+    
+    The dark count scans of every channel are interpolated onto the
+    bias scan points as one [channel, bias] array, weighted with an
+    array DarkWeightFunc (LinearWeight, LinearWeightLimit or
+    LinerAsyWeight), then combined per module (see CombineModuleWeights).
+    The module's re-zeroed dark counts, combined in the same way, are
+    kept as Module["DarkCounts"] (see BracketModules).
     """
     
     # Bias Scan points:
-    Biases = numpy.arange(4,8,0.05) # between 4-8v 0.05v incremenets,
+    Biases = BiasPoints
     # NB: numpy useses linear interpolation to find optimums...
     
-    # Iterate over all modules and channels in the selected list:
-    for Module in Modules:
-        
-        ModuleWeights = [0 for i in range(len(Biases))]
-        
-        Module["ChannelWeights"] = []
-        
+    # Channels of the selected modules (skipping defunct channels), and
+    # the module of each:
+    defunct = set(DefunctChannels)
+    ChannelIDs = []
+    ModuleRows = []
+    for row, Module in enumerate(Modules):
         for ChannelID in Module["ChannelIDs"]:
-            
-            # Skip defunct channels:
-            if ChannelID in DefunctChannels:
-                continue
-            
-            # Lookup the bis and darkcount scans:
-            scan_bias, scan_darkcounts = GetBiasScan(campaign, ChannelID, "darkcounts", False)
-            
-            if len(scan_bias) == 0:
-                print "No data in scan"
-                continue
-            
-            # The darkcounts should never decrease as a function of
-            # applied bias, so enforce that it does not:
-            for i in range (1, len(scan_darkcounts)):
-                if scan_darkcounts[i] < scan_darkcounts[i-1]:
-                    scan_darkcounts[i] = scan_darkcounts[i-1]
-            
-            # The dark counts, using numpys interpolate functionality:
-            # Added zero_counts to rezero the measurement!
-            DarkCounts = numpy.interp(Biases, scan_bias, scan_darkcounts)
-            zero_counts = min(DarkCounts[0:8])
-            ChannelWeights = [DarkWeightFunc(c-zero_counts, FuncArgs) for c in DarkCounts]
-            
-            # Using an actual fit to the data to estimate the darkcounts...
-            # Not used... Did noy work.
+            if not ChannelID in defunct:
+                ChannelIDs.append(ChannelID)
+                ModuleRows.append(row)
+    ChannelIDs = numpy.array(ChannelIDs, dtype=int)
+    ModuleRows = numpy.array(ModuleRows, dtype=int)
+    
+    # Lookup the bias and darkcount scans:
+    scan_bias, scan_darkcounts, present = GetDarkCountScans(campaign, ChannelIDs)
+    
+    scanned = present.any(axis=0)
+    if not scanned.all():
+        print ("No data in scan for %i channels"%numpy.count_nonzero(~scanned))
+    
+    # The darkcounts should never decrease as a function of
+    # applied bias, so enforce that it does not:
+    scan_darkcounts = numpy.maximum.accumulate(numpy.where(present, scan_darkcounts, -numpy.inf), axis=0)
+    
+    # The dark counts, interpolated as numpy.interp of each channel:
+    # Added zero_counts to rezero the measurement!
+    DarkCounts = InterpolateScans(scan_bias[:,scanned], scan_darkcounts[:,scanned], present[:,scanned], Biases)
+    zero_counts = DarkCounts[:,0:ZeroPoints].min(axis=1)
+    ChannelWeights = DarkWeightFunc(DarkCounts - zero_counts[:,numpy.newaxis], FuncArgs)
+    
+    # Using an actual fit to the data to estimate the darkcounts...
+    # Not used... Did noy work.
 #             TG = ROOT.TGraph()
 #             for i in range(len(scan_bias)):
 #                 if (i>0):
@@ -438,51 +495,173 @@ def CalibrateModules_Weight(campaign, Modules, DarkWeightFunc, FuncArgs, Defunct
 #             offset = TF.GetParameter(2)
 #             DarkCounts = [TF.Eval(Bias) - offset for Bias in Biases]
 #             ChannelWeights = [DarkWeightFunc(c, FuncArgs) for c in DarkCounts]
-        
-            # Add the determined channel weights to the module:
-            Module["ChannelWeights"].append(ChannelWeights)
-                
-        # Combine the ModuleWeights - but with some outlier rejection:
-        for w in range(len(ModuleWeights)):
-            weights = [Module["ChannelWeights"][i][w] for i in range(len(Module["ChannelWeights"]))]
-            weights.sort()
-            
-            weights_chopped = weights[10:-10]
-            mean = numpy.mean(weights_chopped)
-            stddev = numpy.std(weights_chopped)
-            
-            weights_filtered = [v for v in weights if (math.fabs(v-mean) < 1.5*stddev)]
-            ModuleWeights[w] = numpy.mean(weights_filtered)
-                
-        # The lowest weight is the optimum module configuration:
-        Module["ModuleWeights"] = ModuleWeights
+    
+    # Combine the ModuleWeights - but with some outlier rejection:
+    ModuleRows = ModuleRows[scanned]
+    ModuleWeights = CombineModuleWeights(ChannelWeights, ModuleRows, len(Modules))
+    ModuleDarkCounts = CombineModuleWeights(DarkCounts - zero_counts[:,numpy.newaxis], ModuleRows, len(Modules))
+    
+    # The lowest weight is the optimum module configuration:
+    for row, Module in enumerate(Modules):
+        Module["ChannelWeights"] = ChannelWeights[ModuleRows == row]
+        Module["ModuleWeights"] = ModuleWeights[row]
+        Module["DarkCounts"] = ModuleDarkCounts[row]
         Module["Biases"] = Biases
-        OptimumBiasID = numpy.argmin(ModuleWeights)
+        OptimumBiasID = numpy.argmin(ModuleWeights[row])
         OptimumBias = Biases[OptimumBiasID]
-        print ("Optimum Bias: %f"%OptimumBias)
+        if verbose:
+            print ("Optimum Bias: %f"%OptimumBias)
         Module["OptimumBias"] = OptimumBias
-        
-           
+    
+####################################################################
+def BracketModules(campaign, Modules, target=DarkCountTarget):
+    """
+    Find the no LED scan points of the campaign so far which bracket the
+    target crossing of each module's dark counts (Module["DarkCounts"],
+    from CalibrateModules_Weight):
+        Module["Bracket"] - [lower, upper], the last scan point below
+                            the target and the first at or above it, or
+                            None if the dark counts have not crossed the
+                            target in the scan (or the scan does not
+                            cover the bias points they are zeroed over).
+        Module["Bracketed"] - True if there is a Bracket, so further
+                            points at higher biases are not expected to
+                            move the optimum.
+    """
+    scanned = CampaignResults.Index(campaign).SortedBias[False]
+    covered = len(scanned) > 0 and scanned[0] <= BiasPoints[ZeroPoints-1] + cmp_tol
+    for Module in Modules:
+        Bracket = None
+        if covered and numpy.isfinite(Module["DarkCounts"]).all():
+            darkcounts = numpy.interp(scanned, BiasPoints, Module["DarkCounts"])
+            above = numpy.nonzero(darkcounts >= target)[0]
+            if len(above) > 0:
+                lower = scanned[above[0]-1] if above[0] > 0 else BiasPoints[0]
+                Bracket = [float(lower), float(scanned[above[0]])]
+        Module["Bracket"] = Bracket
+        Module["Bracketed"] = Bracket is not None
 
 ####################################################################
+def GetDarkCountScans(campaign, ChannelIDs):
+    """
+    The no LED dark count scans of a list of channels, as arrays indexed
+    [scan point, channel] of the bias, dark counts and the points each
+    channel has, in bias order (as GetBiasScan, ties in bias ordered by
+    dark count).
+    """
+    index = CampaignResults.Index(campaign)
+    
+    if index.Uniform:
+        bias, darkcounts, present = index.Scan("darkcounts", False)
+        darkcounts = darkcounts[:,ChannelIDs]
+        present = present[:,ChannelIDs]
+        bias = numpy.repeat(bias[:,numpy.newaxis], len(ChannelIDs), axis=1)
+        if index.Ties[False]:
+            order = numpy.lexsort((darkcounts, bias), axis=0)
+            darkcounts = numpy.take_along_axis(darkcounts, order, axis=0)
+            present = numpy.take_along_axis(present, order, axis=0)
+        return bias, darkcounts, present
+    
+    # Scan channel by channel, padded to the longest scan:
+    scans = [GetBiasScan(campaign, ChannelID, "darkcounts", False) for ChannelID in ChannelIDs]
+    npoints = max([len(scan_bias) for scan_bias, scan_darkcounts in scans] + [1])
+    bias = numpy.full((npoints, len(scans)), numpy.inf)
+    darkcounts = numpy.zeros((npoints, len(scans)))
+    present = numpy.zeros((npoints, len(scans)), dtype=bool)
+    for column, (scan_bias, scan_darkcounts) in enumerate(scans):
+        bias[:len(scan_bias),column] = scan_bias
+        darkcounts[:len(scan_bias),column] = scan_darkcounts
+        present[:len(scan_bias),column] = True
+    return bias, darkcounts, present
+
+####################################################################
+def InterpolateScans(bias, values, present, points):
+    """
+    Interpolate the scans of many channels (arrays indexed [scan point,
+    channel], in bias order, each channel has at least one point) onto
+    the bias points, as numpy.interp of each channel's present points.
+    Returns an array indexed [channel, bias point].
+    """
+    npoints, nchannels = values.shape
+    rows = numpy.arange(npoints)[:,numpy.newaxis]
+    channels = numpy.arange(nchannels)[:,numpy.newaxis]
+    
+    # Last present point at or before, and first at or after, each point:
+    last = numpy.maximum.accumulate(numpy.where(present, rows, -1), axis=0)
+    after = numpy.minimum.accumulate(numpy.where(present, rows, npoints)[::-1], axis=0)[::-1]
+    
+    # Last scan point at or below each bias point, then the present
+    # points either side:
+    below = (bias[:,:,numpy.newaxis] <= points).sum(axis=0) - 1
+    left = numpy.where(below >= 0, last[numpy.maximum(below, 0), channels], -1)
+    right = numpy.where(below + 1 < npoints, after[numpy.minimum(below + 1, npoints - 1), channels], npoints)
+    
+    # Outside the present points the end values are used:
+    outside = (left < 0) | (right >= npoints)
+    left = numpy.where(left < 0, after[0][:,numpy.newaxis], left)
+    right = numpy.where(right >= npoints, left, right)
+    
+    x_left = bias[left, channels]
+    y_left = values[left, channels]
+    with numpy.errstate(divide="ignore", invalid="ignore"):
+        slope = (values[right, channels] - y_left)/(bias[right, channels] - x_left)
+        interpolated = slope*(points - x_left) + y_left
+    return numpy.where(outside | (points == x_left), y_left, interpolated)
+
+####################################################################
+def CombineModuleWeights(ChannelWeights, ModuleRows, nmodules):
+    """
+    Combine the channel weights (indexed [channel, bias point]) of each
+    module (ModuleRows, the module of each channel) with outlier
+    rejection: at each bias point the mean and RMS of the channels, less
+    the 10 lowest and 10 highest, select the channels within 1.5 RMS,
+    whose mean is the module weight. Returns an array indexed [module,
+    bias point].
+    
+    Where the RMS is 0 (eg. at the low bias points, where the re-zeroed
+    dark counts of every channel are 0) the channels equal to the mean
+    are selected. The loop this replaced selected none there, so gave a
+    NaN weight, and the optimum (argmin) was always the first bias point.
+    """
+    nchannels, nbiases = ChannelWeights.shape
+    counts = numpy.bincount(ModuleRows, minlength=nmodules)
+    
+    # Pad the channels of each module, the padding (NaN) is sorted last:
+    order = numpy.argsort(ModuleRows, kind="mergesort")
+    position = numpy.empty(nchannels, dtype=int)
+    position[order] = numpy.arange(nchannels) - (numpy.cumsum(counts) - counts)[ModuleRows[order]]
+    weights = numpy.full((nmodules, max(counts.max() if nmodules > 0 else 0, 1), nbiases), numpy.nan)
+    weights[ModuleRows, position] = ChannelWeights
+    weights.sort(axis=1)
+    
+    rank = numpy.arange(weights.shape[1])[numpy.newaxis,:,numpy.newaxis]
+    count = counts[:,numpy.newaxis,numpy.newaxis]
+    chopped = (rank >= 10) & (rank < count - 10)
+    
+    with numpy.errstate(divide="ignore", invalid="ignore"):
+        mean = numpy.where(chopped, weights, 0.).sum(axis=1)/chopped.sum(axis=1)
+        deviation = numpy.abs(weights - mean[:,numpy.newaxis,:])
+        stddev = numpy.sqrt(numpy.where(chopped, deviation**2, 0.).sum(axis=1)/chopped.sum(axis=1))
+        stddev = stddev[:,numpy.newaxis,:]
+        filtered = (rank < count) & numpy.where(stddev == 0, deviation == 0, deviation < 1.5*stddev)
+        return numpy.where(filtered, weights, 0.).sum(axis=1)/filtered.sum(axis=1)
+
+
+####################################################################
+# Weight functions, of arrays of dark counts:
 def LinearWeight(darkcounts, FuncArgs):
     target = FuncArgs["target"]
-    return math.fabs(target-darkcounts)
+    return numpy.abs(target-darkcounts)
 
 def LinearWeightLimit(darkcounts, FuncArgs):
     target = FuncArgs["target"]
     limit = FuncArgs["limit"]
-    value = math.fabs(target-darkcounts)
-    if value > limit:
-        return limit
-    return value
+    value = numpy.abs(target-darkcounts)
+    return numpy.where(value > limit, limit, value)
 
 def LinerAsyWeight(darkcounts, FuncArgs):
     target = FuncArgs["target"]
-    if (target>darkcounts):
-        return math.fabs(target-darkcounts)
-    else:
-        return 2.0*math.fabs(target+darkcounts)
+    return numpy.where(target > darkcounts, numpy.abs(target-darkcounts), 2.0*numpy.abs(target+darkcounts))
 
 
 ####################################################################
@@ -506,8 +685,15 @@ def GetMatchedChannel(campaign, ChannelID, bias, LEDAvail):
     """
     Scan through a data campaign, to find a mactching channel ID
     configuration. LEDState is a bool, indicating if the LED is on or not...
+    Looked up in the campaign index, where every channel of a dataset
+    shares its bias (see CampaignResults.CampaignIndex).
     """
 
+    index = CampaignResults.Index(campaign)
+    if index.Uniform:
+        DatasetID = index.Match(bias, LEDAvail)
+        return None if DatasetID is None else campaign[DatasetID]["channels"][ChannelID]
+
     for dataset in campaign:
         
         channel = dataset["channels"][ChannelID]
@@ -523,8 +709,14 @@ def GetBiasScan(campaign, ChannelID, ChannelKey ,LEDAvail=None):
     Return a zipped list, containing both a bias points and
     the value of the "channel" key entry in the channel dictionary
     only for LEDAvail...
+    Read from the campaign index, where every channel of a dataset
+    shares its bias (see CampaignResults.CampaignIndex).
     """
     
+    index = CampaignResults.Index(campaign)
+    if index.Uniform and ChannelKey in CampaignResults.ScanKeys:
+        return index.ChannelScan(ChannelID, ChannelKey, LEDAvail)
+    
     bias_points = []
     key_points = []
 
@@ -13,6 +13,8 @@ from TrDAQReader import TrDAQRead
 import BiasCalibrator
 import LightYieldEstimator
 import ROOT
+from HistogramMatrix import HistogramMatrix
+import BatchPeakFitter
 
 #############################################################
 
@@ -35,7 +37,7 @@ def ProcessLED(Channels, PedHist):
     Function to process each LED's 
     """
     
-    output_list = []
+    LYEs = []
 
     for c in Channels:
         channel_LYE = LightYieldEstimator.LightYieldEstimator(c)
@@ -43,12 +45,21 @@ def ProcessLED(Channels, PedHist):
         ped = PedHist.ProjectionY("th1d_projecty",ChannelID+1,ChannelID+1,"")
         if (ped.GetEntries() < 1):
             print ("Skipping channel with no data...")
+            LYEs.append((channel_LYE, False))
         else:
             channel_LYE.process(ped)
-            for p in range(len(channel_LYE.Peaks)):
-                PeakFitResults = channel_LYE.fitPeak(ped, p)
-                channel_LYE.Peaks[p] = PeakFitResults[1]
-                #channel_LYE.PeakErrors[p] = PeakFitResults[4]
+            LYEs.append((channel_LYE, True))
+    
+    # Fit the peaks of every channel in one batch, keeping the peaks
+    # found by process() wherever the fit fails or wanders off:
+    matrix = HistogramMatrix.FromTH2(PedHist)
+    rows = [c["ChannelID"] for c in Channels]
+    sub = HistogramMatrix(matrix.counts[rows], matrix.xmin, matrix.xmax, matrix.lowmemory)
+    BatchPeakFitter.RefinePeaks([lye if processed else None for lye, processed in LYEs], sub)
+    
+    output_list = []
+    for channel_LYE, processed in LYEs:
+        if processed:
             channel_LYE.gainEstimator()
              
         output_list.append(channel_LYE.getMap())
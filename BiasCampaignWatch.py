@@ -0,0 +1,277 @@
+#!/usr/bin/env python
+module_description=\
+"""
+ === Bias Campaign Watch Script =================================
+
+    Process a bias calibration campaign while the data is being taken.
+
+    The campaign directory is polled for new datasets (entries of the
+    campaign.json whose file has stopped changing), each is processed as
+    soon as it is complete, and the module calibration is updated after
+    every no LED dataset. The provisional optimum bias of each module is
+    written to provisional_biases.json in the campaign directory, with
+    whether the scan brackets its target crossing yet (see
+    BiasCalibrator.BracketModules) and its scan state, and the next bias
+    points to take to next_biases.json (see BiasScanPlanner).
+
+    No LED datasets wait for the LED dataset at the same bias (as the
+    peak locations come from the LED data), and are processed without
+    one at the end if it never arrives.
+
+    The watch finishes when no data has changed for WatchIdleTimeout
+    seconds (or on Ctrl-C), then the campaign is checkpointed as
+    stage1.json/stage1.npz, so BiasCalibrator (with the skip argument)
+    or the BiasCalibratorUI can use it.
+
+    Options (campaign config.json): WatchInterval (poll period, s),
+    WatchSettleSeconds (age of a complete file, s), WatchIdleTimeout (s),
+    DarkCountTarget, LowMemoryHistograms, and the BiasScanPlanner
+    options.
+
+    Arguments: Campaign directory
+
+"""
+####################################################################
+# Modules
+import os
+import sys
+import json
+import time
+
+import BiasCalibrator
+import BiasScanPlanner
+import CampaignResults
+import LightYieldEstimator
+
+tempfilename = "stage1.json"
+provisionalfilename = "provisional_biases.json"
+
+# Loading attempts of a complete file before it is abandoned:
+MAX_ATTEMPTS = 3
+
+
+####################################################################
+class CampaignWatch(object):
+    """
+    State of a watched campaign: the datasets processed so far (in
+    campaign.json order), the loaded no LED datasets waiting for their
+    LED dataset, and the file stamps of the runs seen at the last poll.
+    """
+
+    def __init__(self, calibration_dir, config=None):
+
+        if config is None:
+            config = {}
+        self.calibration_dir = calibration_dir
+        self.interval = config.get("WatchInterval", 30.0)
+        self.settle = config.get("WatchSettleSeconds", 60.0)
+        self.idle = config.get("WatchIdleTimeout", 1800.0)
+        self.target = config.get("DarkCountTarget", BiasCalibrator.DarkCountTarget)
+        self.config = config
+        self.lowmemory = config.get("LowMemoryHistograms", False)
+
+        self.campaign = []
+        self.deferred = []
+        self.positions = {}
+        self.stamps = {}
+        self.attempts = {}
+        self.done = set()
+        self.pending = []
+        self.Modules = BiasCalibrator.GenerateModules(range(BiasCalibrator.NUM_CHANS))
+        self.last_change = time.time()
+
+    def Poll(self):
+        """
+        Read the campaign.json, returning the runs whose file is complete
+        (unchanged since the last poll, and older than the settle time).
+        """
+        try:
+            runs = BiasCalibrator.GetCampaignFromJSON(os.path.join(self.calibration_dir, "campaign.json"),
+                                                      self.calibration_dir)
+        except (IOError, ValueError):
+            # Not yet written, or being written:
+            return []
+
+        ready = []
+        self.pending = []
+        for position, run in enumerate(runs):
+            if not all(key in run for key in BiasCalibrator.valid_dataset_keys):
+                continue
+            name = run["filename"]
+            if name in self.done:
+                continue
+            if run["LEDState"] != "ON":
+                self.pending.append(run["bias"])
+            try:
+                stat = os.stat(run["filepath"])
+            except OSError:
+                continue
+
+            stamp = (stat.st_size, stat.st_mtime)
+            if self.stamps.get(name) != stamp:
+                self.stamps[name] = stamp
+                self.last_change = time.time()
+            elif time.time() - stat.st_mtime >= self.settle:
+                self.positions[name] = position
+                ready.append(run)
+        return ready
+
+    def Insert(self, run):
+        """
+        Add a run to the processed datasets, in campaign.json order,
+        returning its DatasetID.
+        """
+        position = self.positions[run["filename"]]
+        DatasetID = len(self.campaign)
+        while DatasetID > 0 and self.positions[self.campaign[DatasetID-1]["filename"]] > position:
+            DatasetID -= 1
+        self.campaign.insert(DatasetID, run)
+        return DatasetID
+
+    def Process(self, run):
+        """
+        Load a complete run, and process it (or defer a no LED run until
+        its LED run is processed).
+        """
+        name = run["filename"]
+        print ("Loading dataset: %s (bias %.3f, LED %s)"%(name, run["bias"], run["LEDState"]))
+        try:
+            BiasCalibrator.LoadCampaign([run])
+        except Exception as e:
+            print ("ERROR: Unable to load dataset %s: %s"%(name, e))
+        if not "allpeds" in run:
+            self.attempts[name] = self.attempts.get(name, 0) + 1
+            if self.attempts[name] >= MAX_ATTEMPTS:
+                print ("Abandoning dataset after %i attempts: %s"%(self.attempts[name], name))
+                self.done.add(name)
+            return
+        self.done.add(name)
+        BiasCalibrator.SetupDatasetChannels(run)
+
+        if not IsLED(run) and not self.HasLED(run):
+            print ("Waiting for the LED dataset at bias %.3f"%run["bias"])
+            self.deferred.append(run)
+            return
+        self.ProcessDataset(run)
+
+        # No LED datasets now matched:
+        if IsLED(run):
+            for waiting in [w for w in self.deferred if self.HasLED(w)]:
+                self.deferred.remove(waiting)
+                self.ProcessDataset(waiting)
+
+    def HasLED(self, run):
+        return CampaignResults.Index(self.campaign).Match(run["bias"], True) is not None
+
+    def ProcessDataset(self, run):
+        """
+        Process every channel of a loaded run, then update the module
+        calibration if it is a no LED run.
+        """
+        DatasetID = self.Insert(run)
+        print ("Processing dataset %i: %s"%(DatasetID, run["filename"]))
+        BiasCalibrator.ProcessDataset(self.campaign, DatasetID, range(BiasCalibrator.NUM_CHANS), self.lowmemory)
+        # The histograms are no longer needed (the UI reloads them):
+        run.pop("allpeds", None)
+        if not IsLED(run):
+            self.Update()
+
+    def Update(self):
+        """
+        Calibrate the modules with the no LED datasets so far, and write
+        the provisional biases and the plan of the next bias points (not
+        proposing the no LED runs taken but not yet processed).
+        """
+        BiasCalibrator.CalibrateModules_Weight(self.campaign, self.Modules, BiasCalibrator.LinearWeight,
+                                               {"target":self.target}, verbose=False)
+        BiasCalibrator.BracketModules(self.campaign, self.Modules, self.target)
+
+        taken = self.pending + [run["bias"] for run in self.deferred]
+        plan = BiasScanPlanner.PlanBiasScan(self.campaign, self.Modules, self.config, taken)
+        BiasScanPlanner.SavePlan(plan, os.path.join(self.calibration_dir, BiasScanPlanner.planfilename))
+
+        provisional = [{"ModuleID":m["ModuleID"], "Board":m["Board"], "Module":m["Module"],
+                        "OptimumBias":float(m["OptimumBias"]), "Bracketed":m["Bracketed"],
+                        "ScanState":m["ScanState"]}
+                       for m in self.Modules]
+        filename = os.path.join(self.calibration_dir, provisionalfilename)
+        with open(filename + ".tmp", "w") as f:
+            json.dump(provisional, f)
+        os.rename(filename + ".tmp", filename)
+
+        nscan = len(CampaignResults.Index(self.campaign).SortedBias[False])
+        print ("%i no LED datasets processed: %i of %i modules bracketed, %i resolved"%\
+               (nscan, sum(m["Bracketed"] for m in self.Modules), len(self.Modules),
+                sum(m["ScanState"] == "Resolved" for m in self.Modules)))
+        print ("Next bias points: %s"%BiasScanPlanner.NextPoints(plan))
+
+    def Watch(self):
+        """
+        Poll and process the campaign until it is idle (or interrupted),
+        then Finish.
+        """
+        try:
+            while True:
+                ready = self.Poll()
+                for run in ready:
+                    self.Process(run)
+                if len(ready) > 0:
+                    self.last_change = time.time()
+                elif time.time() - self.last_change > self.idle:
+                    print ("No new data for %i s, finishing"%self.idle)
+                    break
+                time.sleep(self.interval)
+        except KeyboardInterrupt:
+            print ("Watch interrupted, finishing with the datasets so far")
+        return self.Finish()
+
+    def Finish(self):
+        """
+        Process any no LED datasets without their LED dataset, calibrate
+        the modules and checkpoint the campaign.
+        """
+        for run in self.deferred:
+            print ("No LED dataset at bias %.3f, processing without"%run["bias"])
+            self.ProcessDataset(run)
+        self.deferred = []
+
+        if len(self.campaign) > 0:
+            if len(CampaignResults.Index(self.campaign).SortedBias[False]) > 0:
+                self.Update()
+            LightYieldEstimator.PrintStepReport()
+            CampaignResults.SaveCampaign(self.campaign, os.path.join(self.calibration_dir, tempfilename))
+
+        for m in self.Modules:
+            if "OptimumBias" in m:
+                print ("board: %i, bank: %i, bias: %f%s"%(m["ModuleID"]/BiasCalibrator.MOD_PER_BOARD,
+                       m["ModuleID"]%BiasCalibrator.MOD_PER_BOARD, m["OptimumBias"],
+                       "" if m["ScanState"] == "Resolved" else " (%s)"%m["ScanState"]))
+
+        return {"Campaign":self.campaign, "Modules":self.Modules}
+
+
+def IsLED(run):
+    """
+    True if the LED is on for a set up run (see ProcessChannels).
+    """
+    return bool((run["channels"].columns["LEDIntensity"] >= 1E-6).any())
+
+
+####################################################################
+if __name__ == "__main__":
+
+    print (module_description)
+
+    if (len(sys.argv) < 2):
+        print ("usage: [calibration_dir]")
+        sys.exit (1)
+    calibration_dir = sys.argv[1]
+
+    config = {}
+    config_file = os.path.join(calibration_dir, "config.json")
+    if os.path.exists(config_file):
+        with open(config_file, "r") as f:
+            config = json.load(f)
+    LightYieldEstimator.ConfigureSteps(config)
+
+    CampaignWatch(calibration_dir, config).Watch()
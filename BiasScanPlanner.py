@@ -0,0 +1,205 @@
+#!/usr/bin/env python
+module_description=\
+"""
+ === Bias Scan Planner Script ===================================
+
+    Propose the next bias points of a bias calibration campaign from
+    the datasets processed so far, rather than sweeping every point.
+
+    Each module (calibrated with CalibrateModules_Weight) is in one of
+    the scan states:
+        Zero     - the scan does not yet cover the low bias points the
+                   dark counts are zeroed over.
+        Search   - the dark counts have not crossed the target yet, the
+                   next point is a search step above the scan.
+        Refine   - the target crossing is bracketed by scan points (see
+                   BiasCalibrator.BracketModules), the next point
+                   bisects the bracket (on the bias points grid of
+                   CalibrateModules_Weight).
+        Resolved - no grid point is left inside the bracket, the module
+                   needs no more points.
+        Limit    - the scan reached the top of the bias range without
+                   crossing the target.
+        NoData   - no dark count data for the module.
+        Waiting  - the module's next point is already taken, but not yet
+                   processed.
+
+    The scan is complete once every module is in one of the stopped
+    states (Resolved, Limit or NoData); while modules are Waiting there
+    may be no new points to propose, but the scan is not complete.
+
+    The points are collected per board, and the PlannerMaxPoints points
+    needed by the most modules are proposed for the campaign (each to
+    be taken with the LED on and off).
+
+    Options (campaign config.json): PlannerSearchStep (V),
+    PlannerMaxPoints, DarkCountTarget.
+
+    Arguments: Campaign directory (with a stage1 checkpoint)
+
+"""
+####################################################################
+# Modules
+import os
+import sys
+import json
+import numpy
+
+import BiasCalibrator
+import CampaignResults
+
+tempfilename = "stage1.json"
+planfilename = "next_biases.json"
+
+# Scan states which need no more points:
+StoppedStates = ["Resolved", "Limit", "NoData"]
+
+
+####################################################################
+def PlanModules(campaign, Modules, SearchStep=0.25, taken=[]):
+    """
+    Set the scan state (Module["ScanState"]) and next bias point
+    (Module["NextBias"], None if none is needed now) of each module, from
+    the no LED datasets of the campaign. The modules must be calibrated
+    (CalibrateModules_Weight and BracketModules) with the same campaign.
+    taken - biases already taken, but not yet processed, which are not
+            proposed again (the modules needing them are Waiting).
+    """
+    Biases = BiasCalibrator.BiasPoints
+    tol = BiasCalibrator.cmp_tol
+    scanned = CampaignResults.Index(campaign).SortedBias[False]
+    taken = numpy.array(taken, dtype=float)
+
+    def Grid(bias):
+        # Nearest point of the bias points grid:
+        return Biases[numpy.argmin(numpy.abs(Biases - bias))]
+
+    def Free(bias):
+        return not (numpy.abs(taken - bias) < tol).any()
+
+    for Module in Modules:
+        NextBias = None
+        if len(scanned) > 0 and not numpy.isfinite(Module["ModuleWeights"]).any():
+            State = "NoData"
+        elif len(scanned) == 0 or scanned[0] > Biases[BiasCalibrator.ZeroPoints-1] + tol:
+            State = "Zero"
+            NextBias = Biases[0]
+        elif Module["Bracketed"]:
+            # Bisect the scan points either side of the target crossing:
+            lower, upper = Module["Bracket"]
+            inside = Biases[(Biases > lower + tol) & (Biases < upper - tol)]
+            if len(inside) == 0:
+                State = "Resolved"
+            else:
+                State = "Refine"
+                NextBias = inside[numpy.argmin(numpy.abs(inside - 0.5*(lower + upper)))]
+        elif scanned[-1] >= Biases[-1] - tol:
+            State = "Limit"
+        else:
+            State = "Search"
+            NextBias = Grid(min(scanned[-1] + SearchStep, Biases[-1]))
+
+        if not (NextBias is None):
+            NextBias = round(float(NextBias), 3)
+            if not Free(NextBias):
+                State = "Waiting"
+                NextBias = None
+        Module["ScanState"] = State
+        Module["NextBias"] = NextBias
+
+
+def PlanBiasScan(campaign, Modules, config=None, taken=[]):
+    """
+    Plan the next bias points of the campaign (see PlanModules), returning
+    the plan:
+        {"Biases":[next points of the campaign],
+         "Complete":True once every module is in a StoppedState,
+         "Boards":[{"Board", "Biases", "States":{state:modules}}],
+         "Modules":[{"ModuleID", "Board", "Module", "ScanState",
+                     "NextBias", "OptimumBias"}]}
+    Biases may be empty before the scan is complete, while modules are
+    Waiting for the points taken to be processed.
+    """
+    if config is None:
+        config = {}
+    PlanModules(campaign, Modules, config.get("PlannerSearchStep", 0.25), taken)
+
+    boards = {}
+    requests = {}
+    for Module in Modules:
+        board = boards.setdefault(Module["Board"], {"Board":Module["Board"], "Biases":[], "States":{}})
+        board["States"][Module["ScanState"]] = board["States"].get(Module["ScanState"], 0) + 1
+        if not (Module["NextBias"] is None):
+            requests[Module["NextBias"]] = requests.get(Module["NextBias"], 0) + 1
+            if not Module["NextBias"] in board["Biases"]:
+                board["Biases"].append(Module["NextBias"])
+    for board in boards.values():
+        board["Biases"].sort()
+
+    # The points needed by the most modules (then the lowest):
+    ranked = sorted(requests, key=lambda bias: (-requests[bias], bias))
+    Biases = sorted(ranked[:config.get("PlannerMaxPoints", 4)])
+
+    return {"Biases":Biases,
+            "Complete":all(Module["ScanState"] in StoppedStates for Module in Modules),
+            "Boards":[boards[b] for b in sorted(boards)],
+            "Modules":[{"ModuleID":m["ModuleID"], "Board":m["Board"], "Module":m["Module"],
+                        "ScanState":m["ScanState"], "NextBias":m["NextBias"],
+                        "OptimumBias":float(m["OptimumBias"])} for m in Modules]}
+
+
+def SavePlan(plan, filename):
+    """
+    Write a plan (written to a temporary file, then replaced so the data
+    taking never reads a partial plan).
+    """
+    with open(filename + ".tmp", "w") as f:
+        json.dump(plan, f, indent=1)
+    os.rename(filename + ".tmp", filename)
+
+
+def PrintPlan(plan):
+    for board in plan["Boards"]:
+        print ("board: %i, next biases: %s, modules: %s"%(board["Board"],
+               " ".join("%.2f"%bias for bias in board["Biases"]) if len(board["Biases"]) > 0 else "none",
+               ", ".join("%i %s"%(board["States"][state], state) for state in sorted(board["States"]))))
+    print ("Next bias points: %s"%NextPoints(plan))
+
+
+def NextPoints(plan):
+    """
+    The next points of a plan as text, or whether the scan is complete.
+    """
+    if len(plan["Biases"]) > 0:
+        return " ".join("%.2f"%bias for bias in plan["Biases"])
+    if plan["Complete"]:
+        return "none, the scan is complete"
+    return "none until the points taken are processed"
+
+
+####################################################################
+if __name__ == "__main__":
+
+    print (module_description)
+
+    if (len(sys.argv) < 2):
+        print ("usage: [calibration_dir]")
+        sys.exit (1)
+    calibration_dir = sys.argv[1]
+
+    config = {}
+    config_file = os.path.join(calibration_dir, "config.json")
+    if os.path.exists(config_file):
+        with open(config_file, "r") as f:
+            config = json.load(f)
+
+    campaign = CampaignResults.LoadCampaign(os.path.join(calibration_dir, tempfilename))
+    Modules = BiasCalibrator.GenerateModules(range(BiasCalibrator.NUM_CHANS))
+    BiasCalibrator.CalibrateModules_Weight(campaign, Modules, BiasCalibrator.LinearWeight,
+                                           {"target":config.get("DarkCountTarget", BiasCalibrator.DarkCountTarget)},
+                                           verbose=False)
+    BiasCalibrator.BracketModules(campaign, Modules, config.get("DarkCountTarget", BiasCalibrator.DarkCountTarget))
+
+    plan = PlanBiasScan(campaign, Modules, config)
+    PrintPlan(plan)
+    SavePlan(plan, os.path.join(calibration_dir, planfilename))
@@ -0,0 +1,204 @@
+#!/usr/bin/env python
+module_description=\
+"""
+Compiled calibration context.
+
+The tracker mapping, module biases and bad front end list of a
+calibration folder are resolved, with the electronics identifiers, to
+per channel arrays and stored in one versioned binary file (by default
+context.npz in the calibration folder). Calibrations load this in a
+single read, rather than reparsing the mapping file, Biases.csv and
+BadFE.csv.
+
+The file records the path, size and modification time of each source
+file (and the config.json), and is compiled again automatically when
+any of them change; it is a local cache, so is not tracked by git (see
+.gitignore):
+
+    context = CalibrationContext.LoadOrCompile(config)
+    context.ApplyMapping(FEChannels)
+
+Arguments (test script): calibration folder
+    Compiles the context (if out of date) and prints a summary.
+"""
+
+import os
+import sys
+import json
+import numpy
+
+import FECalibrationUtils
+import FEChannelTable
+
+ContextVersion = 1
+
+# Parts of the context, and the config entry of their source file:
+Parts = [("Mapping", "Mapping_Filename"),
+         ("Biases", "Biases_Filename"),
+         ("BadFE", "BadFE_Filename")]
+
+# Columns resolved by the context:
+ElectronicsColumns = ["ChannelUID", "Module", "ModuleUID", "Bank", "BankUID", "Board",
+                      "ModuleChannel", "BankChannel"]
+MappingColumns = ["InTracker", "Tracker", "Station", "Plane", "PlaneChannel"]
+ContextColumns = ElectronicsColumns + MappingColumns + ["Bias"]
+
+
+def ContextFilename(config):
+    return os.path.join(config["path"], config.get("Context_Filename", "context.npz"))
+
+
+def SourceStamp(filename):
+    """
+    Size and modification time of a source file, None if missing.
+    """
+    try:
+        stat = os.stat(filename)
+    except OSError:
+        return None
+    return {"filename":os.path.abspath(filename), "size":stat.st_size, "mtime":stat.st_mtime}
+
+
+def Sources(config):
+    """
+    Stamps of the source files of a calibration folder's context.
+    """
+    sources = {"config":SourceStamp(config["config_filename"]) if "config_filename" in config else None}
+    for part, key in Parts:
+        sources[part] = SourceStamp(os.path.join(config["path"], config[key])) if key in config else None
+    return sources
+
+
+########################################################################
+class CalibrationContext(object):
+    """
+    The compiled context: Columns (structured array, one row per
+    ChannelUID, Bias NaN for modules without a bias), BadFE (list of
+    the bad channel Issues), Parts (which parts compiled) and the
+    Sources they were compiled from.
+    """
+
+    def __init__(self, columns, badfe, parts, sources):
+        self.Columns = columns
+        self.BadFE = badfe
+        self.Parts = parts
+        self.Sources = sources
+
+    @staticmethod
+    def Compile(config):
+        """
+        Resolve the sources of a calibration folder. Parts whose source is
+        missing, or fails to load, are left out.
+        """
+        sources = Sources(config)
+        FEChannels = FECalibrationUtils.GenerateFEChannelList()
+        parts = {}
+
+        for part, key in Parts:
+            parts[part] = False
+            if sources[part] is None:
+                continue
+            filename = sources[part]["filename"]
+            try:
+                if part == "Mapping":
+                    FECalibrationUtils.UpdateTrackerMapping(FEChannels, FECalibrationUtils.LoadMappingFile(filename))
+                elif part == "Biases":
+                    FECalibrationUtils.ApplyBiasData(FEChannels, filename)
+                else:
+                    FECalibrationUtils.ApplyBadChannels(FEChannels, filename)
+            except Exception as e:
+                print ("Failed to compile %s from %s: %s"%(part, filename, e))
+            else:
+                parts[part] = True
+
+        columns = numpy.zeros(len(FEChannels), dtype=[(name, FEChannelTable.ColumnDType[name]) for name in ContextColumns])
+        for name in ContextColumns:
+            columns[name] = FEChannels[name]
+        badfe = [issue for issues in FEChannels.issues for issue in issues]
+
+        return CalibrationContext(columns, badfe, parts, sources)
+
+    @staticmethod
+    def Load(config):
+        """
+        Load the context of a calibration folder, None if there is no
+        context file or it is out of date.
+        """
+        filename = ContextFilename(config)
+        if not os.path.exists(filename):
+            return None
+
+        with open(filename, "rb") as f:
+            stored = numpy.load(f)
+            header = json.loads(stored["Header"].tobytes().decode("utf-8"))
+            if header["Version"] != ContextVersion or header["Sources"] != Sources(config):
+                return None
+            return CalibrationContext(stored["Columns"], header["BadFE"], header["Parts"], header["Sources"])
+
+    def Save(self, config):
+        """
+        Save to the context file of the calibration folder (written to a
+        temporary file, then replaced).
+        """
+        filename = ContextFilename(config)
+        header = {"Version":ContextVersion, "Sources":self.Sources, "Parts":self.Parts, "BadFE":self.BadFE}
+        header = numpy.frombuffer(json.dumps(header).encode("utf-8"), dtype=numpy.uint8)
+        with open(filename + ".tmp", "wb") as f:
+            numpy.savez(f, Columns=self.Columns, Header=header)
+        os.rename(filename + ".tmp", filename)
+
+    ####################################################################
+    # Apply the parts of the context to a table of the channels (indexed
+    # by ChannelUID), raising an Exception if the part is missing:
+    ####################################################################
+    def Require(self, part):
+        if not self.Parts.get(part, False):
+            raise Exception ("No %s in the calibration context"%part)
+
+    def ApplyMapping(self, FEChannels):
+        self.Require("Mapping")
+        for name in ElectronicsColumns + MappingColumns:
+            FEChannels[name] = self.Columns[name]
+        FEChannels.MarkDirty(slice(None))
+
+    def ApplyBiases(self, FEChannels):
+        self.Require("Biases")
+        biased = ~numpy.isnan(self.Columns["Bias"])
+        FEChannels["Bias"][biased] = self.Columns["Bias"][biased]
+        FEChannels.MarkDirty(biased)
+
+    def ApplyBadFrontEnds(self, FEChannels):
+        self.Require("BadFE")
+        for issue in self.BadFE:
+            row = int(issue["ChannelUID"])
+            FEChannels.get(row, "Issues").append(dict(issue))
+            FEChannels.set(row, "Status", "BAD")
+
+
+def LoadOrCompile(config):
+    """
+    Load the context of a calibration folder, compiling (and saving) it
+    first if it is out of date.
+    """
+    context = CalibrationContext.Load(config)
+    if context is None:
+        print ("Compiling calibration context: %s"%ContextFilename(config))
+        context = CalibrationContext.Compile(config)
+        try:
+            context.Save(config)
+        except (IOError, OSError) as e:
+            print ("Unable to save calibration context: %s"%e)
+    return context
+
+
+if __name__ == "__main__":
+
+    print (module_description)
+
+    config = FECalibrationUtils.LoadCalibrationConfig(sys.argv[1])
+    context = LoadOrCompile(config)
+    print ("Parts: %s"%", ".join("%s %s"%(part, "compiled" if context.Parts[part] else "missing")
+                                 for part, key in Parts))
+    print ("%i channels in the tracker, %i biased, %i bad front end issues"%\
+           (numpy.count_nonzero(context.Columns["InTracker"]),
+            numpy.count_nonzero(~numpy.isnan(context.Columns["Bias"])), len(context.BadFE)))
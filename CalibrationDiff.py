@@ -0,0 +1,236 @@
+#!/usr/bin/env python
+module_description=\
+"""
+Vectorised comparison of two calibrations.
+
+The calibrations are aligned by ChannelUID, or by (bank, channel) for
+MAUS calibration files, then the differences (new - old) of each field,
+outlier masks and summary statistics are array operations:
+
+    diff = CalibrationDiff.CalibrationDiff(OldChannels, NewChannels)
+    peddiff = diff.Delta("ADC_Pedestal")
+    summary = diff.Summary("ADC_Pedestal", tolerance=3.0)
+
+A calibration is a FEChannelTable (or list of FrontEndChannels), or a
+MAUS calibration list (maps of bank, channel, adc_pedestal, adc_gain,
+...). The tables also have the MAUS names (bank, channel, adc_pedestal
+and adc_gain), so either can be compared with the other.
+
+Arguments (test script): old calibration, new calibration, tolerance (optional, default 0.5)
+    Prints a compact report of the differences. The calibrations may be
+    calibration folders, FEChannel lists (.json or .npy) or MAUS
+    calibration files.
+
+The channel tables (and ROOT, through them) are only imported when a
+table is compared or loaded, so MAUS calibration files can be compared
+without ROOT (eg. by the tools scripts).
+"""
+
+import os
+import sys
+import json
+import numpy
+
+# Channels per bank, as FECalibrationUtils:
+CHAN_PER_BANK = 128
+
+# MAUS calibration names of the table columns:
+MAUSNames = {"bank":"BankUID", "channel":"BankChannel",
+             "adc_pedestal":"ADC_Pedestal", "adc_gain":"ADC_Gain"}
+
+# Fields reported by default, where both calibrations have them:
+ReportFields = ["ADC_Pedestal", "ADC_Gain", "ADC_Gain_FFT", "Light_Yield", "Dark_Yield",
+                "noise_1pe_rate", "noise_2pe_rate", "Bias",
+                "adc_pedestal", "adc_gain", "tdc_pedestal", "tdc_gain"]
+
+
+def Columns(calibration):
+    """
+    Dictionary of the column arrays of a calibration.
+    """
+    if isinstance(calibration, dict):
+        return calibration
+
+    # MAUS calibration list:
+    if len(calibration) > 0 and isinstance(calibration[0], dict):
+        names = set(name for Map in calibration for name in Map)
+        return dict((name, numpy.array([Map.get(name, numpy.nan) for Map in calibration], dtype=numpy.float64))
+                    for name in names)
+
+    import FEChannelTable
+    if not isinstance(calibration, FEChannelTable.FEChannelTable):
+        calibration = FEChannelTable.FEChannelTable.FromChannels(calibration)
+    columns = dict((name, calibration[name]) for name in FEChannelTable.ColumnNames)
+    for maus_name, name in MAUSNames.items():
+        columns[maus_name] = columns[name]
+    return columns
+
+
+def Keys(columns, key):
+    """
+    Integer key of every row, key is "ChannelUID" or "BankChannel" (the
+    bank and channel).
+    """
+    if key == "ChannelUID":
+        return columns["ChannelUID"].astype(numpy.int64)
+    return columns["bank"].astype(numpy.int64)*CHAN_PER_BANK \
+         + columns["channel"].astype(numpy.int64)
+
+
+########################################################################
+class CalibrationDiff(object):
+    """
+    Two calibrations aligned by key. Rows of the calibrations are
+    matched (OldRows[i] with NewRows[i]), the keys only in one of them
+    are in Removed and Added, and any keys used by more than one row of
+    a calibration in Duplicates (the last of these rows is matched).
+    """
+
+    def __init__(self, old, new, key=None):
+
+        self.old = Columns(old)
+        self.new = Columns(new)
+        if key is None:
+            key = "ChannelUID" if ("ChannelUID" in self.old and "ChannelUID" in self.new) else "BankChannel"
+        self.key = key
+
+        oldkeys = Keys(self.old, key)
+        newkeys = Keys(self.new, key)
+
+        # Duplicated keys, in either calibration:
+        duplicates = []
+        for keys in (oldkeys, newkeys):
+            keys = numpy.sort(keys)
+            duplicates.append(keys[:-1][numpy.diff(keys) == 0])
+        self.Duplicates = numpy.unique(numpy.concatenate(duplicates))
+
+        # Look up each new key in the sorted old keys:
+        order = numpy.argsort(oldkeys, kind="mergesort")
+        sortedkeys = oldkeys[order]
+        position = numpy.searchsorted(sortedkeys, newkeys, side="right") - 1
+        found = position >= 0
+        found[found] = sortedkeys[position[found]] == newkeys[found]
+
+        self.NewRows = numpy.nonzero(found)[0]
+        self.OldRows = order[position[found]]
+        self.Keys = newkeys[found]
+        self.Added = numpy.unique(newkeys[~found])
+        self.Removed = numpy.setdiff1d(oldkeys, newkeys)
+
+    def __len__(self):
+        return len(self.Keys)
+
+    def Fields(self):
+        """
+        Fields of both calibrations, in report order (without the MAUS
+        names of table columns, where both are tables).
+        """
+        fields = [name for name in ReportFields if name in self.old and name in self.new]
+        return [name for name in fields if not MAUSNames.get(name) in fields]
+
+    def Old(self, field):
+        return self.old[field][self.OldRows]
+
+    def New(self, field):
+        return self.new[field][self.NewRows]
+
+    def Delta(self, field):
+        """
+        Difference, new - old, of a field for every matched row.
+        """
+        return self.New(field).astype(numpy.float64) - self.Old(field)
+
+    def Outliers(self, field, tolerance):
+        """
+        Mask of the matched rows differing by more than tolerance.
+        """
+        return numpy.abs(self.Delta(field)) > tolerance
+
+    def Summary(self, field, tolerance=None, mask=None, window=None):
+        """
+        Summary of the differences of a field, over the matched rows
+        (selected by mask) where the field is set in both:
+            Entries, Changed, Outliers (differences above tolerance),
+            Mean, RMS, Min, Max
+        window limits the Mean and RMS to differences within +-window,
+        as a histogram of that range would.
+        """
+        delta = self.Delta(field)
+        if mask is not None:
+            delta = delta[mask]
+        return Summarise(delta, tolerance, window)
+
+    def Report(self, fields=None, tolerance=0.5, nworst=5):
+        """
+        Print a compact report of the differences, with the channels
+        which differ most for each field with outliers.
+        """
+        if fields is None:
+            fields = self.Fields()
+
+        print ("Matched %i channels by %s: %i only in old, %i only in new, %i duplicated"%\
+               (len(self), self.key, len(self.Removed), len(self.Added), len(self.Duplicates)))
+        print ("%-16s %7s %7s %8s %10s %10s %10s %10s"%\
+               ("Field", "Entries", "Changed", "Outliers", "Mean", "RMS", "Min", "Max"))
+        for field in fields:
+            summary = self.Summary(field, tolerance)
+            print ("%-16s %7i %7i %8i %10.4f %10.4f %10.4f %10.4f"%(field, summary["Entries"],
+                   summary["Changed"], summary["Outliers"], summary["Mean"], summary["RMS"],
+                   summary["Min"], summary["Max"]))
+
+        for field in fields:
+            delta = numpy.nan_to_num(self.Delta(field))
+            worst = numpy.argsort(-numpy.abs(delta), kind="mergesort")[:nworst]
+            worst = worst[numpy.abs(delta[worst]) > tolerance]
+            if len(worst) > 0:
+                print ("%s outliers (%s: old -> new): %s"%(field, self.key, ", ".join(
+                       "%i: %.3f -> %.3f"%(k, o, n) for k, o, n in
+                       zip(self.Keys[worst], self.Old(field)[worst], self.New(field)[worst]))))
+
+
+def Summarise(delta, tolerance=None, window=None):
+    """
+    Summary of an array of differences (see CalibrationDiff.Summary),
+    differences which are not set (NaN) are ignored.
+    """
+    delta = delta[numpy.isfinite(delta)]
+    inside = delta if window is None else delta[numpy.abs(delta) <= window]
+    summary = {"Entries":len(delta),
+               "Changed":int(numpy.count_nonzero(delta)),
+               "Outliers":0 if tolerance is None else int(numpy.count_nonzero(numpy.abs(delta) > tolerance)),
+               "Mean":inside.mean() if len(inside) else 0.0,
+               "RMS":inside.std() if len(inside) else 0.0,
+               "Min":delta.min() if len(delta) else 0.0,
+               "Max":delta.max() if len(delta) else 0.0}
+    return summary
+
+
+def Load(path):
+    """
+    Load a calibration from a calibration folder, a FEChannel list
+    (.json or .npy) or a MAUS calibration file.
+    """
+    if os.path.isdir(path):
+        import FECalibrationUtils
+        config = FECalibrationUtils.LoadCalibrationConfig(path)
+        path = os.path.join(config["path"], config["FECalibrations"])
+
+    # MAUS calibration file:
+    if not path.endswith(".npy"):
+        with open(path, "r") as f:
+            calibration = json.load(f)
+        if not (len(calibration) > 0 and "ClassName" in calibration[0]):
+            return calibration
+
+    import FECalibrationUtils
+    return FECalibrationUtils.LoadFEChannelList(path)
+
+if __name__ == "__main__":
+
+    print (module_description)
+
+    old = Load(sys.argv[1])
+    new = Load(sys.argv[2])
+    tolerance = float(sys.argv[3]) if len(sys.argv) > 3 else 0.5
+
+    CalibrationDiff(old, new).Report(tolerance=tolerance)
@@ -0,0 +1,448 @@
+#!/usr/bin/env python
+module_description=\
+"""
+Array backed results of a bias calibration campaign.
+
+The per channel results of each dataset (bias, LED intensity, channel
+state and the light yield estimates) are held as numpy arrays indexed
+by ChannelID, in place of a list of one dictionary per channel:
+
+    results = dataset["channels"]
+    darkcounts = results.columns["darkcounts"]
+    darkcounts = CampaignResults.Stack(campaign, "darkcounts") # [dataset, channel]
+
+Indexing the results gives a dictionary like view of a channel, with
+the keys of the channel dictionaries it replaces, so existing readers
+(eg. dataset["channels"][ChannelID]["darkcounts"]) are unchanged, and
+assigning a LightYieldEstimator map to a channel stores its results.
+Only the results used by the calibration are kept (the fit parameters
+and peak integrals of the estimator are not).
+
+The datasets of a campaign are indexed by bias and LED state, so the
+dataset matching a bias, or the bias scan of a channel (or of every
+channel, as [dataset, channel] arrays) are lookups (see Index):
+
+    bias, darkcounts, present = CampaignResults.Index(campaign).Scan("darkcounts", False)
+
+The campaign is checkpointed as the campaign json (without the channels)
+and a compressed .npz of the stacked arrays (see SaveCampaign).
+
+Arguments (test script): checkpoint json (eg. stage1.json)
+    Loads a checkpoint, converting a checkpoint of channel dictionaries
+    to the binary checkpoint, and prints a summary of the channel states.
+"""
+
+import os
+import sys
+import json
+import numpy
+
+import FECalibrationUtils
+
+# Result columns of each channel, and their default values:
+Fields = [("bias", numpy.float64, numpy.nan),
+          ("LEDIntensity", numpy.float64, 0.),
+          ("OK", bool, True),
+          ("ChannelState", numpy.int8, 0),
+          ("nPeaks", numpy.int16, 0),
+          ("gain", numpy.float64, 0.),
+          ("offset", numpy.float64, 0.),
+          ("darkcounts", numpy.float64, 0.),
+          ("darkcounts_old", numpy.float64, 0.),
+          ("pe", numpy.float64, 0.),
+          ("RMS", numpy.float64, numpy.nan),
+          ("Mean", numpy.float64, numpy.nan)]
+
+FieldNames = [name for name, dtype, default in Fields]
+
+# Columns which hold the values of the channel dictionaries (ChannelState
+# holds the state codes), so can be read in a bias scan:
+ScanKeys = [name for name in FieldNames if name != "ChannelState"]
+
+# Keys of every channel, and those only set once it is processed:
+SetupKeys = ["ChannelID", "ModuleID", "Module", "Board", "OK", "bias", "LEDIntensity"]
+ProcessedKeys = ["ChannelState", "Peaks", "nPeaks", "gain", "offset", "darkcounts",
+                 "darkcounts_old", "pe", "RMS", "Mean"]
+
+# Peak positions kept in the Peaks array, any more are kept in MorePeaks:
+MAX_PEAKS = 16
+
+CheckpointVersion = 1
+
+# Tolerances of the bias and LED intensity comparisons (as BiasCalibrator):
+cmp_tol = 1E-6
+LED_TOL = 1E-6
+
+# ChannelState codes (the LightYieldEstimator states), any other state
+# is added:
+StateCodes = ["INVALID", "NoData", "Breakdown", "NoPeaks", "NoPEPeaks", "LEDPeakMisMatch", "PEPeaks"]
+
+def StateCode(state):
+    """
+    Code of a ChannelState string in the ChannelState column.
+    """
+    if not state in StateCodes:
+        StateCodes.append(str(state))
+    return StateCodes.index(state)
+
+
+########################################################################
+class CampaignResults(object):
+    """
+    Results of every channel of one dataset: columns (arrays of the
+    Fields), Peaks (peak positions, NaN padded to MAX_PEAKS), MorePeaks
+    (ChannelID: peaks beyond MAX_PEAKS) and Processed (channels with
+    light yield results).
+    """
+
+    def __init__(self, nchannels=None):
+
+        if nchannels is None:
+            nchannels = FECalibrationUtils.NUM_CHANS
+
+        self.columns = dict((name, numpy.full(nchannels, default, dtype=dtype))
+                            for name, dtype, default in Fields)
+        self.Peaks = numpy.full((nchannels, MAX_PEAKS), numpy.nan)
+        self.MorePeaks = {}
+        self.Processed = numpy.zeros(nchannels, dtype=bool)
+
+    @staticmethod
+    def FromMaps(maps):
+        """
+        Results from a list (indexed by ChannelID) of channel
+        dictionaries.
+        """
+        results = CampaignResults(len(maps))
+        for ChannelID, Map in enumerate(maps):
+            results.Store(ChannelID, Map)
+        return results
+
+    def __len__(self):
+        return len(self.Processed)
+
+    def __iter__(self):
+        for ChannelID in range(len(self)):
+            yield ChannelView(self, ChannelID)
+
+    def __getitem__(self, ChannelID):
+        if ChannelID < 0 or ChannelID >= len(self):
+            raise IndexError(ChannelID)
+        return ChannelView(self, ChannelID)
+
+    def __setitem__(self, ChannelID, Map):
+        self.Store(ChannelID, Map)
+
+    def Store(self, ChannelID, Map):
+        """
+        Store a channel dictionary (or LightYieldEstimator map), the
+        channel is processed if the map has a ChannelState.
+        """
+        for name in ("bias", "LEDIntensity", "OK"):
+            if name in Map:
+                self.columns[name][ChannelID] = Map[name]
+
+        self.Processed[ChannelID] = "ChannelState" in Map
+        if not self.Processed[ChannelID]:
+            return
+
+        for name, dtype, default in Fields[4:]:
+            self.columns[name][ChannelID] = Map.get(name, default)
+        self.columns["ChannelState"][ChannelID] = StateCode(Map["ChannelState"])
+
+        peaks = list(Map.get("Peaks", []))
+        self.columns["nPeaks"][ChannelID] = len(peaks)
+        self.Peaks[ChannelID] = numpy.nan
+        self.Peaks[ChannelID, :min(len(peaks), MAX_PEAKS)] = peaks[:MAX_PEAKS]
+        if len(peaks) > MAX_PEAKS:
+            self.MorePeaks[ChannelID] = [float(p) for p in peaks[MAX_PEAKS:]]
+        else:
+            self.MorePeaks.pop(ChannelID, None)
+
+    def Merge(self, results, ChannelIDs):
+        """
+        Copy the results of a list of channels from other results (eg.
+        returned by a worker process).
+        """
+        for name in FieldNames:
+            self.columns[name][ChannelIDs] = results.columns[name][ChannelIDs]
+        self.Peaks[ChannelIDs] = results.Peaks[ChannelIDs]
+        self.Processed[ChannelIDs] = results.Processed[ChannelIDs]
+        for ChannelID in ChannelIDs:
+            self.MorePeaks.pop(ChannelID, None)
+            if ChannelID in results.MorePeaks:
+                self.MorePeaks[ChannelID] = results.MorePeaks[ChannelID]
+
+    def Value(self, ChannelID, key):
+        """
+        Value of a key of a channel dictionary, KeyError if the channel
+        does not have it.
+        """
+        if key == "ChannelID":
+            return ChannelID
+        if key == "ModuleID":
+            return ChannelID//FECalibrationUtils.CHAN_PER_MOD
+        if key == "Module":
+            return (ChannelID//FECalibrationUtils.CHAN_PER_MOD)%FECalibrationUtils.MOD_PER_BOARD
+        if key == "Board":
+            return ChannelID//(FECalibrationUtils.CHAN_PER_MOD*FECalibrationUtils.MOD_PER_BOARD)
+        if key in ProcessedKeys and not self.Processed[ChannelID]:
+            raise KeyError(key)
+        if key == "Peaks":
+            npeaks = int(self.columns["nPeaks"][ChannelID])
+            return [float(p) for p in self.Peaks[ChannelID, :min(npeaks, MAX_PEAKS)]] \
+                   + self.MorePeaks.get(ChannelID, [])
+        if key == "ChannelState":
+            return StateCodes[self.columns["ChannelState"][ChannelID]]
+        if key in self.columns:
+            return self.columns[key][ChannelID].item()
+        raise KeyError(key)
+
+    def Keys(self, ChannelID):
+        return SetupKeys + (ProcessedKeys if self.Processed[ChannelID] else [])
+
+    def StateMask(self, state):
+        """
+        Mask of the processed channels in a ChannelState.
+        """
+        return self.Processed & (self.columns["ChannelState"] == StateCode(state))
+
+
+########################################################################
+class ChannelView(object):
+    """
+    Read only dictionary view of one channel of the results, with the
+    keys of the channel dictionaries (see SetupKeys, ProcessedKeys).
+    """
+
+    def __init__(self, results, ChannelID):
+        self.results = results
+        self.ChannelID = int(ChannelID)
+
+    def __getitem__(self, key):
+        return self.results.Value(self.ChannelID, key)
+
+    def __contains__(self, key):
+        return key in self.results.Keys(self.ChannelID)
+
+    def __iter__(self):
+        return iter(self.results.Keys(self.ChannelID))
+
+    def __len__(self):
+        return len(self.results.Keys(self.ChannelID))
+
+    def get(self, key, default=None):
+        if key in self:
+            return self[key]
+        return default
+
+    def keys(self):
+        return list(self.results.Keys(self.ChannelID))
+
+    def items(self):
+        return [(key, self[key]) for key in self]
+
+    def copy(self):
+        return dict(self.items())
+
+
+########################################################################
+class CampaignIndex(object):
+    """
+    Index of the datasets of a campaign by bias and LED state, built
+    once from the results of each dataset (see Index):
+        DatasetBias, DatasetLED - the bias and LED state of each dataset
+        Order[LEDAvail] - the datasets of an LED state (None for all) in
+                          bias order (ties in campaign order)
+        SortedBias[LEDAvail] - the biases of those datasets
+    Uniform is False where the channels of a dataset do not share one
+    bias and LED state (a bias list per channel); the index then can not
+    be used, and the campaign must be scanned channel by channel.
+    """
+
+    def __init__(self, campaign):
+
+        self.results = [dataset["channels"] for dataset in campaign]
+        ndatasets = len(self.results)
+        bias = numpy.zeros((0, 0))
+        intensity = numpy.zeros((0, 0))
+        if ndatasets > 0:
+            bias = numpy.array([results.columns["bias"] for results in self.results])
+            intensity = numpy.array([results.columns["LEDIntensity"] for results in self.results])
+
+        self.Uniform = bool((bias == bias[:,:1]).all() and (intensity == intensity[:,:1]).all())
+        self.DatasetBias = bias[:,0] if bias.shape[1] > 0 else numpy.zeros(ndatasets)
+        self.DatasetLED = (intensity[:,0] if intensity.shape[1] > 0 else numpy.zeros(ndatasets)) > LED_TOL
+
+        self.Order = {}
+        self.SortedBias = {}
+        self.Ties = {}
+        for LEDAvail in (None, True, False):
+            datasets = numpy.arange(ndatasets)
+            if LEDAvail is not None:
+                datasets = datasets[self.DatasetLED == LEDAvail]
+            order = datasets[numpy.argsort(self.DatasetBias[datasets], kind="mergesort")]
+            self.Order[LEDAvail] = order
+            self.SortedBias[LEDAvail] = self.DatasetBias[order]
+            self.Ties[LEDAvail] = bool((numpy.diff(self.SortedBias[LEDAvail]) == 0).any())
+
+    def Matches(self, campaign):
+        """
+        True if the index is of the current results of the campaign.
+        """
+        return len(campaign) == len(self.results) and \
+               all(dataset["channels"] is results for dataset, results in zip(campaign, self.results))
+
+    def Match(self, bias, LEDAvail):
+        """
+        The first dataset (in campaign order) of an LED state within
+        cmp_tol of a bias, None if there is none.
+        """
+        sortedbias = self.SortedBias[LEDAvail]
+        first = numpy.searchsorted(sortedbias, bias - cmp_tol, side="right")
+        last = numpy.searchsorted(sortedbias, bias + cmp_tol, side="left")
+        if last <= first:
+            return None
+        return int(self.Order[LEDAvail][first:last].min())
+
+    def Scan(self, key, LEDAvail=None):
+        """
+        Bias scan of every channel: the biases of the datasets of an LED
+        state (None for all) in bias order, and arrays, indexed [dataset
+        (in that order), channel], of a column of the results and of the
+        channels which have it.
+        """
+        order = self.Order[LEDAvail]
+        values = numpy.array([self.results[DatasetID].columns[key] for DatasetID in order])
+        if key in ProcessedKeys:
+            present = numpy.array([self.results[DatasetID].Processed for DatasetID in order])
+        else:
+            present = numpy.ones(values.shape, dtype=bool)
+        return self.SortedBias[LEDAvail], values.reshape(len(order), -1), present.reshape(len(order), -1)
+
+    def ChannelScan(self, ChannelID, key, LEDAvail=None):
+        """
+        Bias scan of one channel, as lists of the biases and the values of
+        a column, sorted by bias (then value), for the datasets of an LED
+        state (None for all) where the channel has the key.
+        """
+        order = self.Order[LEDAvail]
+        bias = self.SortedBias[LEDAvail]
+        values = numpy.array([self.results[DatasetID].columns[key][ChannelID] for DatasetID in order])
+        if key in ProcessedKeys:
+            present = numpy.array([self.results[DatasetID].Processed[ChannelID] for DatasetID in order], dtype=bool)
+            bias = bias[present]
+            values = values[present]
+        if self.Ties[LEDAvail]:
+            ties = numpy.lexsort((values, bias))
+            bias = bias[ties]
+            values = values[ties]
+        return bias.tolist(), values.tolist()
+
+
+# Index of the last campaign indexed:
+_index = None
+
+def Index(campaign):
+    """
+    The CampaignIndex of a campaign, built once and rebuilt only when
+    the results of its datasets are replaced.
+    """
+    global _index
+    if _index is None or not _index.Matches(campaign):
+        _index = CampaignIndex(campaign)
+    return _index
+
+
+def Stack(campaign, name):
+    """
+    Array, indexed [dataset, channel], of a column of the results of
+    each dataset of a campaign ("Peaks" gives [dataset, channel, peak],
+    "Processed" the processed channels).
+    """
+    if name == "Peaks":
+        return numpy.array([dataset["channels"].Peaks for dataset in campaign])
+    if name == "Processed":
+        return numpy.array([dataset["channels"].Processed for dataset in campaign])
+    return numpy.array([dataset["channels"].columns[name] for dataset in campaign])
+
+
+def CheckpointFilename(filename):
+    """
+    Name of the binary results file of a campaign checkpoint.
+    """
+    return os.path.splitext(filename)[0] + ".npz"
+
+
+def SaveCampaign(campaign, filename):
+    """
+    Checkpoint a campaign: the datasets (without their channels or
+    histograms) as json, and the stacked results as a compressed .npz.
+    """
+    datasets = [dict((key, value) for key, value in dataset.items() if not key in ("channels", "allpeds"))
+                for dataset in campaign]
+    morepeaks = [[DatasetID, int(ChannelID), peaks] for DatasetID, dataset in enumerate(campaign)
+                 for ChannelID, peaks in dataset["channels"].MorePeaks.items()]
+    header = {"Version":CheckpointVersion, "StateCodes":StateCodes, "MorePeaks":morepeaks}
+    arrays = dict((name, Stack(campaign, name)) for name in FieldNames + ["Peaks", "Processed"])
+    arrays["Header"] = numpy.frombuffer(json.dumps(header).encode("utf-8"), dtype=numpy.uint8)
+
+    with open(filename, "w") as f:
+        json.dump(datasets, f)
+    with open(CheckpointFilename(filename) + ".tmp", "wb") as f:
+        numpy.savez_compressed(f, **arrays)
+    os.rename(CheckpointFilename(filename) + ".tmp", CheckpointFilename(filename))
+
+
+def LoadCampaign(filename):
+    """
+    Load a campaign checkpoint, either binary (see SaveCampaign) or a
+    json of the datasets with lists of channel dictionaries.
+    """
+    with open(filename, "r") as f:
+        campaign = json.load(f)
+
+    if len(campaign) > 0 and "channels" in campaign[0]:
+        for dataset in campaign:
+            dataset["channels"] = CampaignResults.FromMaps(dataset["channels"])
+        return campaign
+
+    with open(CheckpointFilename(filename), "rb") as f:
+        stored = numpy.load(f)
+        header = json.loads(stored["Header"].tobytes().decode("utf-8"))
+        if header["Version"] != CheckpointVersion:
+            raise Exception ("Unknown campaign checkpoint version %s"%header["Version"])
+
+        # Read each stored array once, then split by dataset (codes of the
+        # stored states mapped to this session's StateCodes):
+        arrays = dict((name, stored[name]) for name in FieldNames + ["Peaks", "Processed"])
+        states = numpy.array([StateCode(state) for state in header["StateCodes"]], dtype=numpy.int8)
+        arrays["ChannelState"] = states[arrays["ChannelState"]]
+
+    for DatasetID, dataset in enumerate(campaign):
+        results = CampaignResults(arrays["Processed"].shape[1])
+        for name in FieldNames:
+            results.columns[name] = arrays[name][DatasetID].copy()
+        results.Peaks = arrays["Peaks"][DatasetID].copy()
+        results.Processed = arrays["Processed"][DatasetID].copy()
+        dataset["channels"] = results
+
+    for DatasetID, ChannelID, peaks in header["MorePeaks"]:
+        campaign[DatasetID]["channels"].MorePeaks[ChannelID] = peaks
+    return campaign
+
+
+if __name__ == "__main__":
+
+    print (module_description)
+
+    filename = sys.argv[1]
+    campaign = LoadCampaign(filename)
+    if not os.path.exists(CheckpointFilename(filename)):
+        print ("Converting to binary checkpoint: %s"%CheckpointFilename(filename))
+        SaveCampaign(campaign, filename)
+
+    processed = Stack(campaign, "Processed")
+    states = Stack(campaign, "ChannelState")
+    print ("%i datasets, %i processed channels"%(len(campaign), numpy.count_nonzero(processed)))
+    for code, state in enumerate(StateCodes):
+        print ("%-16s %8i"%(state, numpy.count_nonzero(processed & (states == code))))
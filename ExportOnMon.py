@@ -41,13 +41,12 @@ def ExportOnMonReference(ADCCalibration, output_filename):
     t.Branch( 'adc_pedestal', adc_pedestal, 'adc_pedestal/F' )
     t.Branch( 'adc_gain', adc_gain, 'adc_gain/F' )
     
-    for channel in ADCCalibration.FEChannels:
+    bad = ADCCalibration.FEChannels.IssueIndex().MaxSeverity > 4
+    
+    for row, channel in enumerate(ADCCalibration.FEChannels):
         ChannelUID[0] = channel.ChannelUID
         InTracker[0] =  channel.InTracker
-        Good[0] = 1
-        for issue in channel.Issues:
-            if (issue["Severity"]>4):
-                Good[0] = 0
+        Good[0] = int(not bad[row])
         adc_pedestal[0] = channel.ADC_Pedestal
         adc_gain[0] = channel.ADC_Gain
         t.Fill()
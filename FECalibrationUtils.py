@@ -32,114 +32,188 @@ import tempfile  # For editing data
 import subprocess # For editing data
 
 from FrontEndChannel import FrontEndChannel
+from FEChannelTable import FEChannelTable, StatusCode, PartialLoad
+import numpy
 import TrDAQReader
+import TrackerMapping
 
 
 ########################################################################
 def LoadMappingFile (fname):
     
-    # Map output
-    M = [{} for i in range(8192)]
-
-    # Load Map:
-    with open(fname, "r") as f:
-        for line in f:
-            # Load and split line...
-            words = line.split()
-            board = int(words[0])
-            bank = int(words[1])
-            elchannel = int(words[2])
-            channelUID = board*512 + bank*128 + elchannel
-            # Output Map
-            M[channelUID]["ChannelUID"] = channelUID
-            M[channelUID]["Board"] = board
-            M[channelUID]["Bank"] = bank
-            M[channelUID]["BankChannel"] = elchannel
-            M[channelUID]["Tracker"] = int(words[3])
-            M[channelUID]["Station"] = int(words[4]) -1
-            M[channelUID]["Plane"] = int(words[5])
-            M[channelUID]["PlaneChannel"] = int(words[6])
-
-    return M
+    # Map output, indexed by ChannelUID (see TrackerMapping):
+    return TrackerMapping.Load(fname, NUM_CHANS)
 
 
 ########################################################################
 # Generate FEChannel List
 ########################################################################
-# Generate a list of front end channels, with no mapping applied.
+# Generate a table of front end channels, with no mapping applied.
 def GenerateFEChannelList():
     
     # Channel Definitions:    
-    FEChannels = []
-    
-    for chan in range (NUM_CHANS):
-        
-        FEChan = FrontEndChannel()
-        
-        # Populate electronics numbers.
-        FEChan.ChannelUID = chan
-        FEChan.ModuleUID = chan/CHAN_PER_MOD
-        FEChan.Module = FEChan.ModuleUID % MOD_PER_BOARD
-        FEChan.BankUID = chan/CHAN_PER_BANK
-        FEChan.Bank = FEChan.BankUID % BANK_PER_BOARD
-        FEChan.Board = FEChan.ModuleUID / MOD_PER_BOARD
-        FEChan.ModuleChannel = chan % CHAN_PER_MOD
-        FEChan.BankChannel = chan % CHAN_PER_BANK
-        FEChannels.append( FEChan )
+    FEChannels = FEChannelTable(NUM_CHANS)
+    chan = numpy.arange(NUM_CHANS)
+    
+    # Populate electronics numbers.
+    FEChannels["ChannelUID"] = chan
+    FEChannels["ModuleUID"] = chan//CHAN_PER_MOD
+    FEChannels["Module"] = FEChannels["ModuleUID"] % MOD_PER_BOARD
+    FEChannels["BankUID"] = chan//CHAN_PER_BANK
+    FEChannels["Bank"] = FEChannels["BankUID"] % BANK_PER_BOARD
+    FEChannels["Board"] = FEChannels["ModuleUID"] // MOD_PER_BOARD
+    FEChannels["ModuleChannel"] = chan % CHAN_PER_MOD
+    FEChannels["BankChannel"] = chan % CHAN_PER_BANK
     
     return FEChannels
 
-# Load an existing list:
-def LoadFEChannelList(filename):
+# Load an existing list, either the json list of maps or a binary store
+# (.npy), see FEChannelTable. columns, channels and sidecar select part
+# of a binary store to load. Any changes in the write ahead log are
+# applied.
+def LoadFEChannelList(filename, columns=None, channels=None, sidecar=True):
     
-    with open(filename,"r") as f:
-        channels_dict = json.load(f)
+    if filename.endswith(".npy"):
+        FEChannels = FEChannelTable.Load(filename, columns, channels, sidecar)
+    else:
+        with open(filename,"r") as f:
+            channels_dict = json.load(f)
         
-    return [FrontEndChannel(channel) for channel in channels_dict]
+        if channels is not None:
+            channels_dict = channels_dict[channels]
+            
+        FEChannels = FEChannelTable.FromMaps(channels_dict)
+        FEChannels.partial = PartialLoad(channels=channels)
+    
+    ReplayFEChannelLog(FEChannels, filename, channels)
+    return FEChannels
 
 
-# Load an existing list:
-def SaveFEChannelList(FEChannels, filename):
+# Save a list, compact stores the light yields as rows (always the
+# case for a binary store). The whole list is saved, so any write ahead
+# log of the file is removed, and a partially loaded table is refused:
+def SaveFEChannelList(FEChannels, filename, compact=False):
+    
+    if isinstance(FEChannels, FEChannelTable):
+        FEChannels.CheckWhole()
     
-    with open(filename,"w") as f:
+    if filename.endswith(".npy"):
+        if not isinstance(FEChannels, FEChannelTable):
+            FEChannels = FEChannelTable.FromChannels(FEChannels)
+        FEChannels.Save(filename)
+    else:
+        with open(filename + ".tmp","w") as f:
+            
+            json.dump([C.getMap(compact) for C in FEChannels], f)
         
-        json.dump([C.getMap() for C in FEChannels], f)
+        os.rename(filename + ".tmp", filename)
+    
+    if isinstance(FEChannels, FEChannelTable):
+        FEChannels.ClearDirty()
+    if os.path.exists(LogFilename(filename)):
+        os.remove(LogFilename(filename))
         
     return
        
 
+########################################################################
+# Incremental saves, using a write ahead log of changed channels
+########################################################################
+# Compact the log into the channel file once it holds this many rows:
+WAL_COMPACT_ROWS = 1024
+
+def LogFilename(filename):
+    return filename + ".wal"
+
+# Append the changed (dirty) channels to the log of the channel file,
+# a json map per line:
+def SaveFEChannelChanges(FEChannels, filename, compact=False):
+    
+    FEChannels.CheckWhole()
+    rows = FEChannels.DirtyRows()
+    logname = LogFilename(filename)
+    
+    # Start on a new line, in case the last save was interrupted:
+    newline = False
+    if os.path.exists(logname) and os.path.getsize(logname) > 0:
+        with open(logname, "rb") as f:
+            f.seek(-1, os.SEEK_END)
+            newline = f.read(1) != b"\n"
+    
+    with open(logname, "a") as f:
+        if newline:
+            f.write("\n")
+        for row in rows:
+            f.write(json.dumps({"Row":int(row), "Map":FEChannels[row].getMap(compact)}) + "\n")
+        f.flush()
+        os.fsync(f.fileno())
+    FEChannels.ClearDirty()
+    print ("Saved %i changed channels to: %s"%(len(rows), logname))
+    
+    # Compact a long log:
+    with open(logname, "r") as f:
+        nlogged = sum(1 for line in f)
+    if nlogged > WAL_COMPACT_ROWS:
+        CompactFEChannelLog(filename, compact)
+
+# Apply the log of a channel file to the channels loaded from it,
+# channels is the slice of the file which was loaded:
+def ReplayFEChannelLog(FEChannels, filename, channels=None):
+    
+    logname = LogFilename(filename)
+    if not os.path.exists(logname):
+        return 0
+    
+    with open(logname, "r") as f:
+        entries = []
+        for line in f:
+            if len(line.strip()) == 0:
+                continue
+            try:
+                entries.append(json.loads(line))
+            except ValueError:
+                print ("Skipping incomplete entry in: %s"%logname)
+    
+    # Rows of the file, to rows of the loaded table:
+    nrows = max([entry["Row"] for entry in entries] + [len(FEChannels)-1]) + 1
+    index = range(nrows) if channels is None else range(*channels.indices(nrows))
+    index = dict((stored_row, row) for row, stored_row in enumerate(index))
+    
+    for entry in entries:
+        if entry["Row"] in index:
+            row = index[entry["Row"]]
+            FEChannels.resetRow(row)
+            FEChannels.loadMap(row, entry["Map"])
+    
+    FEChannels.ClearDirty()
+    print ("Applied %i logged changes from: %s"%(len(entries), logname))
+    return len(entries)
+
+# Rewrite the channel file with the logged changes, and remove the
+# log. The channels are reloaded from the file, so unsaved changes
+# are not written:
+def CompactFEChannelLog(filename, compact=False):
+    
+    logname = LogFilename(filename)
+    if not os.path.exists(logname):
+        return
+    
+    SaveFEChannelList(LoadFEChannelList(filename), filename, compact)
+    print ("Compacted %s into: %s"%(logname, filename))
+
+
 ########################################################################
 # Update Tracker Mapping
 ########################################################################
 # Use a mapping object to re-map the internal mapping of the channels.
-def UpdateTrackerMapping(FEChannels, TrackerMapping):
+def UpdateTrackerMapping(FEChannels, Mapping):
     
-    for FEChan in FEChannels:
-        
-        # Identify the map, which links from the channel UID
-        # to internal naming:
-        errors = 0
-        try:
-            Mapping = TrackerMapping[FEChan.ChannelUID]
-            FEChan.Tracker = Mapping["Tracker"]
-            FEChan.Station = Mapping["Station"]
-            FEChan.Plane = Mapping["Plane"]
-            FEChan.PlaneChannel = Mapping["PlaneChannel"]
-        except KeyError:
-            #print "Skipping channel excluded from tracker"
-            FEChan.Tracker = 0
-            FEChan.Station = 0
-            FEChan.Plane = 0
-            FEChan.PlaneChannel = 0
-            FEChan.InTracker = 0
-            errors += 1
-        else:
-            FEChan.InTracker = 1
-            
-        if (errors > 1500):
-            raise Exception ("More than 1500 channels missing from detector, intolerable")
-        
-    return FEChannels
+    # Mapping from a list of maps, indexed by ChannelUID:
+    if not isinstance(Mapping, TrackerMapping.TrackerMapping):
+        Mapping = TrackerMapping.TrackerMapping.FromMaps(Mapping)
+    
+    # Links from the channel UID to internal naming:
+    return Mapping.Apply(FEChannels)
 
             
 ########################################################################
@@ -201,24 +275,72 @@ def SaveCalibrationStatus(status, path):
     return
 
 
+########################################################################
+# Apply per module / bank / channel tables
+########################################################################
+# Levels of the electronics a table row can address: the columns of the
+# row identifying it (board and the module/bank of the board, or the
+# ChannelUID), the number per board and the channels of each.
+TableLevels = {"Module":(("Board", "MCM"), MOD_PER_BOARD, CHAN_PER_MOD),
+               "Bank":(("Board", "Bank"), BANK_PER_BOARD, CHAN_PER_BANK),
+               "Channel":(("ChannelUID",), NUM_CHANS, 1)}
+
+# Read the rows of a csv table, and the first ChannelUID each row
+# addresses. Rows outside the detector are skipped.
+def ReadChannelTable(filename, level):
+    
+    fields, per_board, nchans = TableLevels[level]
+    with open(filename) as csvfile:
+        Rows = list(csv.DictReader(csvfile))
+    
+    index = numpy.array([[int(Row[field]) for field in fields] for Row in Rows], dtype=numpy.int64)
+    index = index.reshape(len(Rows), len(fields))
+    if len(fields) == 2:
+        inside = (index[:,0] >= 0) & (index[:,0] < NUM_BOARDS) & (index[:,1] >= 0) & (index[:,1] < per_board)
+        first = (index[:,0]*per_board + index[:,1])*nchans
+    else:
+        inside = (index[:,0] >= 0) & (index[:,0] < NUM_CHANS)
+        first = index[:,0]
+    
+    for Row, keep in zip(Rows, inside):
+        if not keep:
+            print ("Skipping %s outside the detector in %s: %s"%(level, filename, Row))
+    return [Row for Row, keep in zip(Rows, inside) if keep], first[inside]
+
+# Set a column of every channel addressed by the rows of a table (given
+# as the first ChannelUID of each row), returns the rows set:
+def ApplyChannelTable(FEChannels, first, level, column, values):
+    
+    # Check the channels, UID should be the same as the array index:
+    if len(FEChannels) != NUM_CHANS or \
+       not numpy.array_equal(FEChannels["ChannelUID"], numpy.arange(NUM_CHANS)):
+        raise ValueError("Channel table is not indexed by ChannelUID")
+    
+    nchans = TableLevels[level][2]
+    rows = (first[:,numpy.newaxis] + numpy.arange(nchans)).ravel()
+    FEChannels[column][rows] = numpy.repeat(values, nchans)
+    FEChannels.MarkDirty(rows)
+    return rows
+
 ########################################################################
 # Apply Bias Data, from an exisitng csv file
 ########################################################################
-# Load a CSV file containing bias data and store to master objects...
+# Load a CSV file containing bias data and store to master objects,
+# reports the modules which have no bias...
 def ApplyBiasData(FEChannels, biases_filename):
-
-    # Read in the CSV data:
-    with open(biases_filename) as csvfile:
-        Biases = csv.DictReader(csvfile)
     
-        # Loop over the biases and apply to the channels:
-        for Bias in Biases:
-            for FEChannel in FEChannels:
-                if FEChannel.Board == int(Bias["Board"]) and\
-                   FEChannel.Module == int(Bias["MCM"]):
-                
-                    # Apply Bias:
-                    FEChannel.Bias = float(Bias["Bias"])
+    # Read in the CSV data, one row per module:
+    Biases, first = ReadChannelTable(biases_filename, "Module")
+    values = numpy.array([float(Bias["Bias"]) for Bias in Biases])
+    rows = ApplyChannelTable(FEChannels, first, "Module", "Bias", values)
+    
+    # Modules without a bias:
+    biased = numpy.zeros(NUM_CHANS//CHAN_PER_MOD, dtype=bool)
+    biased[rows//CHAN_PER_MOD] = True
+    missing = numpy.nonzero(~biased)[0]
+    if len(missing) > 0:
+        print ("No bias for %i modules (board, MCM): %s"%(len(missing), \
+            ", ".join("(%i, %i)"%(m//MOD_PER_BOARD, m%MOD_PER_BOARD) for m in missing)))
     
     return FEChannels
 
@@ -228,27 +350,14 @@ def ApplyBiasData(FEChannels, biases_filename):
 # Load a CSV file containing a list of bad channels, with reasons.
 def ApplyBadChannels(FEChannels, bad_filename):
 
-    # Read in the CSV data:
-    with open(bad_filename) as csvfile:
-        BadChannels = csv.DictReader(csvfile)
+    # Read in the CSV data, one row per channel:
+    BadChannels, first = ReadChannelTable(bad_filename, "Channel")
+    rows = ApplyChannelTable(FEChannels, first, "Channel", "Status", StatusCode("BAD"))
     
-        # Loop over the biases and apply to the channels:
-        for BadChannel in BadChannels:
-            
-            # Look for ChannelUIDs and apply to stack:
-            try:
-                ChannelUID = int(BadChannel["ChannelUID"])
-                FEChannel = FEChannels[ChannelUID]
-                
-                # Check the channel, UID should be the same as the array inex.:
-                assert( FEChannel.ChannelUID == ChannelUID)
-                
-                # Apply the issue to the list:
-                FEChannel.Issues.append(BadChannel)
-                FEChannel.Status = "BAD"
-                
-            except:
-                raise
+    # Apply the issues to the lists:
+    for row, BadChannel in zip(rows, BadChannels):
+        FEChannels.get(row, "Issues").append(BadChannel)
+    FEChannels.MarkDirty(rows)
     
     return FEChannels
 
@@ -368,21 +477,11 @@ def ExportBadChannelsMAUS(FEChannels, output_filename):
     for maus is bank, channel.
     """
     
+    bad = FEChannels.IssueIndex().Channels("MAUSBadChannel")
+    
     with open(output_filename,"w") as f:
-        for FEChannel in FEChannels:
-            
-            # Identify if the channel is bad.
-            bad = False
-            for Issue in FEChannel.Issues:
-                try:
-                    if Issue["Issue"] == "MAUSBadChannel":
-                        bad = True
-                except:
-                    pass
-            
-            # Write the bad channels entry:
-            if bad:
-                f.write('%i %i\n'%(FEChannel.BankUID, FEChannel.BankChannel))
+        for BankUID, BankChannel in zip(FEChannels["BankUID"][bad], FEChannels["BankChannel"][bad]):
+            f.write('%i %i\n'%(BankUID, BankChannel))
                 
     # Done
     
@@ -0,0 +1,748 @@
+#!/usr/bin/env python
+module_description=\
+"""
+Columnar table of the front end channel calibrations.
+
+Every scalar member of the FrontEndChannel (electronics and tracker
+location, status, bias, pedestal, gain, light yields and noise rates)
+is stored as one numpy column for the whole detector, so whole
+detector operations can be done with array operations:
+
+    gains = FEChannels["ADC_Gain"]
+    good = FEChannels["Status"] == FEChannelTable.StatusCode("GOOD")
+
+The Issues lists, LightYield records and any other (free form) members
+are kept in ragged side tables, one entry per channel. The issues are
+indexed by channel, type and severity for queries (see IssueIndex):
+
+    bad = FEChannels.IssueIndex().Channels(minseverity=4)
+
+The table behaves like the list of FrontEndChannel objects it replaces:
+iterating or indexing it gives FrontEndChannel row views, which read
+and write the table.
+
+The python type each column value was set with (eg. an int 0 pedestal
+of a channel never calibrated) is kept with the columns, so the maps
+written are the same as those read.
+
+The LightYield records are kept as loaded (map or row) and only parsed
+on first access, and the sidecar of a binary store is only read when
+the side tables are first used, so tools which only use the columns
+never parse them; LazyReport() prints how many were parsed, and the
+time saved.
+
+A derived table (eg. a calibration update starting from an old
+calibration) is made with Snapshot(), which copies the columns and
+shares the side tables with the original; a row's Issues and other
+members are only copied when one of the tables gives them out to be
+changed (through a row view, or the issues and extra side tables). The
+LightYield records stay shared, and are made read only.
+Flatten() copies any rows still shared. Saving always writes the whole
+table, so a partially loaded table (a subset of the columns, channels
+or without the side tables) cannot be saved.
+
+Tables are stored either as the fechannels.json list of maps, or as a
+binary store: a .npy file of the columns (loaded memory mapped, so a
+subset of columns or a range of channels can be read without reading
+the rest), plus a .sidecar.json file holding the side tables.
+
+Arguments (test script): input file, output file
+    Converts between the json list and the binary store, using the
+    file extensions (.json or .npy), and checks the conversion is
+    lossless.
+"""
+
+import os
+import sys
+import copy
+import json
+import time
+import numpy
+
+import FrontEndChannel
+import LightYieldEstimator
+
+# Scalar columns, in order, and their default values (as the members of
+# a new FrontEndChannel, NaN where the member is not set until needed):
+Columns = [("ChannelUID", numpy.int32, 0),
+           ("Module", numpy.int32, 0),
+           ("ModuleUID", numpy.int32, 0),
+           ("Bank", numpy.int32, 0),
+           ("BankUID", numpy.int32, 0),
+           ("Board", numpy.int32, 0),
+           ("ModuleChannel", numpy.int32, 0),
+           ("BankChannel", numpy.int32, 0),
+           ("InTracker", numpy.int32, 0),
+           ("Tracker", numpy.int32, 0),
+           ("Station", numpy.int32, 0),
+           ("Plane", numpy.int32, 0),
+           ("PlaneChannel", numpy.int32, 0),
+           ("Status", numpy.int8, 0),
+           ("Bias", numpy.float64, numpy.nan), # NaN until a bias is applied
+           ("ADC_Pedestal", numpy.float64, 0),
+           ("ADC_Gain", numpy.float64, 0),
+           ("ADC_Gain_FFT", numpy.float64, numpy.nan), # NaN until estimated
+           ("Light_Yield", numpy.float64, 0),
+           ("Dark_Yield", numpy.float64, 0),
+           ("noise_1pe_rate", numpy.float64, 0),
+           ("noise_2pe_rate", numpy.float64, 0)]
+
+ColumnNames = [name for name, dtype, default in Columns]
+ColumnDType = numpy.dtype([(name, dtype) for name, dtype, default in Columns])
+ColumnDefaults = dict((name, default) for name, dtype, default in Columns)
+
+# Columns which are not set (left out of the maps) while NaN:
+UnsetColumns = [name for name, dtype, default in Columns if default != default]
+
+# The python types of the column values are kept as codes, so the maps
+# give back the values as they were set (eg. an int 0 pedestal, or a
+# bool):
+ValueTypes = [bool, int, float]
+
+def TypeCode(value):
+    """
+    Code of the python type of a column value (a float for other types).
+    """
+    if isinstance(value, numpy.generic):
+        value = value.item()
+    for code, pytype in enumerate(ValueTypes):
+        if isinstance(value, pytype):
+            return code
+    return ValueTypes.index(float)
+
+def RestoreType(value, code):
+    """
+    A column value as its python type, where it converts exactly.
+    """
+    pytype = ValueTypes[code]
+    if type(value) != pytype and numpy.isfinite(value) and pytype(value) == value:
+        return pytype(value)
+    return value
+
+TypesDType = numpy.dtype([(name, numpy.int8) for name in ColumnNames])
+TypeDefaults = dict((name, TypeCode(default)) for name, dtype, default in Columns)
+
+# Columns as stored in the binary store (Status as text), with the
+# type codes of the values:
+StoreDType = numpy.dtype([(name, "S32" if name == "Status" else dtype) for name, dtype, default in Columns] +
+                         [("Types", numpy.int8, (len(Columns),))])
+StoreVersion = 2
+
+# Status column codes, any other status read from a file is added:
+StatusCodes = ["NODATA", "GOOD", "BAD"]
+
+def StatusCode(status):
+    """
+    Code of a status string in the Status column.
+    """
+    if not status in StatusCodes:
+        StatusCodes.append(str(status))
+    return StatusCodes.index(status)
+
+
+# Counters of the LightYield records left unparsed when loading, and
+# those parsed on access (with a sample of the parse time, to estimate
+# the time saved):
+LazyStats = {"Deferred":0, "Parsed":0, "ParseSeconds":0.0, "Sampled":0, "SampleSeconds":0.0,
+             "Sidecars":0, "SidecarsRead":0}
+LAZY_SAMPLE = 32
+
+def LazyReport():
+    """
+    Print the LightYield records parsed on access, and the time saved by
+    not parsing the rest.
+    """
+    unparsed = max(LazyStats["Deferred"] - LazyStats["Parsed"], 0)
+    saved = 0.0
+    if LazyStats["Sampled"] > 0:
+        saved = unparsed*LazyStats["SampleSeconds"]/LazyStats["Sampled"]
+    print ("LightYield records: %i loaded, %i parsed on access (%.3f s), %.3f s saved"%\
+           (LazyStats["Deferred"], LazyStats["Parsed"], LazyStats["ParseSeconds"], saved))
+    if LazyStats["Sidecars"] > 0:
+        print ("Binary store sidecars: %i loaded, %i read on access"%\
+               (LazyStats["Sidecars"], LazyStats["SidecarsRead"]))
+
+
+def PartialLoad(columns=None, channels=None, sidecar=True):
+    """
+    Description of what a partial load leaves out of a table (for
+    FEChannelTable.partial), None for a whole table.
+    """
+    missing = []
+    if columns is not None and len(set(ColumnNames) - set(columns)) > 0:
+        missing.append("columns " + ", ".join(name for name in ColumnNames if not name in columns))
+    if channels is not None:
+        missing.append("the channels outside %s"%channels)
+    if not sidecar:
+        missing.append("the issues and light yields")
+    if len(missing) == 0:
+        return None
+    return "; ".join(missing)
+
+
+def SidecarFilename(filename):
+    """
+    Name of the side table file of a binary store.
+    """
+    return os.path.splitext(filename)[0] + ".sidecar.json"
+
+
+########################################################################
+class FEChannelTable(object):
+    """
+    Table of front end channels, one row per channel.
+    """
+
+    ClassName = "FrontEndChannel"
+
+    def __init__(self, nchannels=0):
+
+        self.columns = numpy.zeros(nchannels, dtype=ColumnDType)
+        self.types = numpy.zeros(nchannels, dtype=TypesDType)
+        for name in ColumnNames:
+            self.columns[name] = ColumnDefaults[name]
+            self.types[name] = TypeDefaults[name]
+
+        # Ragged side tables (see loadSidecar):
+        self._sidecar = None
+        self.issues = [[] for i in range(nchannels)]
+        self.lightyields = dict((field, [None]*nchannels) for field in FrontEndChannel.FrontEndChannel.LightYieldFields)
+        self.extra = [{} for i in range(nchannels)]
+
+        self._rows = [None]*nchannels
+
+        # Rows changed since the table was loaded/saved:
+        self.dirty = numpy.zeros(nchannels, dtype=bool)
+
+        self._issueindex = None
+
+        # Rows whose Issues/extra members are shared with a snapshot:
+        self._shared = numpy.zeros(nchannels, dtype=bool)
+
+        # What was left out of a partially loaded table (None if whole):
+        self.partial = None
+
+    @staticmethod
+    def FromMaps(maps):
+        """
+        Build a table from a list of FrontEndChannel maps (as stored in
+        the fechannels.json).
+        """
+        table = FEChannelTable(len(maps))
+        for row, Map in enumerate(maps):
+            table.loadMap(row, Map)
+        table.ClearDirty()
+        table.CountDeferred()
+        return table
+
+    @staticmethod
+    def Load(filename, columns=None, channels=None, sidecar=True):
+        """
+        Load a table from a binary store.
+        
+        columns - list of the column names to load (default: all), the
+                  other columns are left with their default values.
+        channels - slice of the rows (channels) to load (default: all).
+        sidecar - load the Issues, LightYields and other members from
+                  the sidecar file.
+        """
+        stored = numpy.load(filename, mmap_mode="r")
+        if channels is not None:
+            stored = stored[channels]
+        if columns is None:
+            columns = ColumnNames
+        
+        table = FEChannelTable(len(stored))
+        table.partial = PartialLoad(columns, channels, sidecar)
+        for name in columns:
+            if name == "Status":
+                names, inverse = numpy.unique(stored["Status"], return_inverse=True)
+                codes = numpy.array([StatusCode(n.decode("ascii")) for n in names], dtype=numpy.int8)
+                table.columns["Status"] = codes[inverse] if len(names) else 0
+            else:
+                table.columns[name] = stored[name]
+            if "Types" in stored.dtype.names:
+                table.types[name] = stored["Types"][:, ColumnNames.index(name)]
+        
+        # The sidecar is read on first use of the side tables:
+        if sidecar:
+            table._sidecar = (filename, channels)
+            LazyStats["Sidecars"] += 1
+        
+        table.ClearDirty()
+        return table
+
+    def loadSidecar(self):
+        """
+        Read the side tables from the sidecar of the binary store the
+        table was loaded from, if not yet read.
+        """
+        if self._sidecar is None:
+            return
+        filename, channels = self._sidecar
+        self._sidecar = None
+        LazyStats["SidecarsRead"] += 1
+        
+        with open(SidecarFilename(filename), "r") as f:
+            side = json.load(f)
+        rows = range(len(side["Issues"]))
+        if channels is not None:
+            rows = rows[channels]
+        for row, stored_row in enumerate(rows):
+            self._issues[row] = side["Issues"][stored_row]
+            self._extra[row] = side["Extra"][stored_row]
+            for field in self._lightyields:
+                self._lightyields[field][row] = side["LightYields"][field][stored_row]
+        self._issueindex = None
+        self.CountDeferred()
+
+    # Side tables, read from the sidecar on first use. The issues and
+    # extra members are given out through OwnedRows, which copy the rows
+    # shared with a snapshot:
+    @property
+    def issues(self):
+        return OwnedRows(self, self._issuerows)
+
+    @issues.setter
+    def issues(self, value):
+        self._issues = value
+
+    @property
+    def extra(self):
+        return OwnedRows(self, self._extrarows)
+
+    @extra.setter
+    def extra(self, value):
+        self._extra = value
+
+    # The stored rows, for the table's own use:
+    @property
+    def _issuerows(self):
+        self.loadSidecar()
+        return self._issues
+
+    @property
+    def _extrarows(self):
+        self.loadSidecar()
+        return self._extra
+
+    @property
+    def lightyields(self):
+        self.loadSidecar()
+        return self._lightyields
+
+    @lightyields.setter
+    def lightyields(self, value):
+        self._lightyields = value
+
+    
+    def Save(self, filename):
+        """
+        Save the table as a binary store (filename should end .npy), the
+        light yields are stored as compact rows.
+        """
+        self.CheckWhole()
+        stored = numpy.zeros(len(self.columns), dtype=StoreDType)
+        for name in ColumnNames:
+            if name == "Status":
+                stored["Status"] = numpy.array(StatusCodes, dtype="S32")[self.columns["Status"]]
+            else:
+                stored[name] = self.columns[name]
+            stored["Types"][:, ColumnNames.index(name)] = self.types[name]
+        
+        side = {"Version":StoreVersion,
+                "Issues":self._issuerows,
+                "Extra":self._extrarows,
+                "LightYields":{}}
+        for field in self.lightyields:
+            side["LightYields"][field] = [self.storedRecord(field, row, True) for row in range(len(self.columns))]
+        
+        # Write to temporary files, then replace the store:
+        sidecar = SidecarFilename(filename)
+        with open(filename + ".tmp", "wb") as f:
+            numpy.save(f, stored)
+        with open(sidecar + ".tmp", "w") as f:
+            json.dump(side, f)
+        os.rename(sidecar + ".tmp", sidecar)
+        os.rename(filename + ".tmp", filename)
+        
+    def Snapshot(self):
+        """
+        Copy of the table, sharing the side tables with this table until
+        a row is changed (copy on write), so it is cheap to make.
+        """
+        snapshot = FEChannelTable(0)
+        snapshot.partial = self.partial
+        snapshot.columns = self.columns.copy()
+        snapshot.types = self.types.copy()
+        snapshot.issues = list(self._issuerows)
+        snapshot.lightyields = dict((field, list(records)) for field, records in self.lightyields.items())
+        snapshot.extra = list(self._extrarows)
+        snapshot._rows = [None]*len(self.columns)
+        snapshot.dirty = numpy.zeros(len(self.columns), dtype=bool)
+        snapshot._shared = numpy.ones(len(self.columns), dtype=bool)
+        
+        # Rows of this table are shared too, and the records read only:
+        self._shared[:] = True
+        for records in self.lightyields.values():
+            for value in records:
+                if isinstance(value, LightYieldEstimator.LightYieldRecord):
+                    value.Freeze()
+        return snapshot
+
+    def CheckWhole(self):
+        """
+        Raise an exception if the table was partially loaded, before it is
+        written over the file it was loaded from.
+        """
+        if self.partial is not None:
+            raise Exception ("Partially loaded channel table (without %s), not saved"%self.partial)
+
+    def Flatten(self):
+        """
+        Copy any rows still shared with a snapshot, so the table no
+        longer references another table.
+        """
+        for row in numpy.nonzero(self._shared)[0]:
+            self.own(row)
+
+    def own(self, row):
+        # Copy a shared row's Issues and extra members, before a change:
+        if self._shared[row]:
+            self._issuerows[row] = copy.deepcopy(self._issuerows[row])
+            self._extrarows[row] = copy.deepcopy(self._extrarows[row])
+            self._shared[row] = False
+
+    @staticmethod
+    def FromChannels(channels):
+        """
+        Build a table from a list of FrontEndChannel objects.
+        """
+        return FEChannelTable.FromMaps([channel.getMap() for channel in channels])
+
+    ####################################################################
+    # List interface, giving FrontEndChannel row views:
+    ####################################################################
+    def __len__(self):
+        return len(self.columns)
+
+    def __iter__(self):
+        for row in range(len(self.columns)):
+            yield self.row(row)
+
+    def __getitem__(self, key):
+        # Column by name, or row view(s) by index:
+        if isinstance(key, basestring):
+            return self.columns[key]
+        if isinstance(key, slice):
+            return [self.row(row) for row in range(len(self.columns))[key]]
+        return self.row(key)
+
+    def __setitem__(self, key, channel):
+        # Replace a row with the contents of a FrontEndChannel:
+        if isinstance(key, basestring):
+            self.columns[key] = channel
+            self.types[key] = TypeCode(numpy.asarray(channel).dtype.type(0))
+            return
+        row = range(len(self.columns))[key]
+        Map = channel.getMap()
+        self.resetRow(row)
+        self.loadMap(row, Map)
+        self.dirty[row] = True
+
+    def row(self, row):
+        row = range(len(self.columns))[row]
+        if self._rows[row] is None:
+            self._rows[row] = FrontEndChannel.FrontEndChannel(table=self, row=row)
+        return self._rows[row]
+
+    ####################################################################
+    # Change tracking, for incremental saves. Writes through the row
+    # views mark the row, changes made in place (eg. to an Issue) need
+    # to be marked by hand:
+    ####################################################################
+    def MarkDirty(self, rows):
+        self.dirty[rows] = True
+        self._issueindex = None
+
+    def DirtyRows(self):
+        return numpy.nonzero(self.dirty)[0]
+
+    def ClearDirty(self):
+        self.dirty[:] = False
+
+    def IssueIndex(self, rebuild=False):
+        """
+        Index of the Issues of every channel, cached until the issues
+        of a row are read/replaced through a row view or a row is marked
+        dirty. Use rebuild after changing the issues side table directly.
+        """
+        if rebuild or self._issueindex is None:
+            self._issueindex = IssueIndex(self._issuerows)
+        return self._issueindex
+
+    ####################################################################
+    # Access to the members of a row:
+    ####################################################################
+    def get(self, row, name):
+        if name in ColumnDefaults:
+            value = self.columns[name][row].item()
+            if name == "Status":
+                return StatusCodes[value]
+            if name in UnsetColumns and value != value:
+                raise AttributeError(name)
+            return RestoreType(value, self.types[name][row])
+        if name == "Issues":
+            # The list may be changed in place through the view:
+            self._issueindex = None
+            self.own(row)
+            return self._issuerows[row]
+        if name in self.lightyields:
+            return self.record(name, row)
+        if name == "ClassName":
+            return self.ClassName
+        if not name in self._extrarows[row]:
+            raise AttributeError(name)
+        self.own(row)
+        return self._extrarows[row][name]
+
+    def set(self, row, name, value):
+        self.dirty[row] = True
+        if name == "Issues":
+            self._issueindex = None
+        if name in ColumnDefaults:
+            if name == "Status":
+                value = StatusCode(value)
+            else:
+                self.types[name][row] = TypeCode(value)
+            self.columns[name][row] = value
+        elif name == "Issues":
+            self._issuerows[row] = value
+        elif name in self.lightyields:
+            self.lightyields[name][row] = value
+        elif name != "ClassName":
+            self.own(row)
+            self._extrarows[row][name] = value
+
+    def resetRow(self, row):
+        self._issueindex = None
+        for name in ColumnNames:
+            self.columns[name][row] = ColumnDefaults[name]
+            self.types[name][row] = TypeDefaults[name]
+        self._issuerows[row] = []
+        for field in self.lightyields:
+            self.lightyields[field][row] = None
+        self._extrarows[row] = {}
+        self._shared[row] = False
+
+    def getMap(self, row, compact=False):
+        """
+        The members of a row as a (json safe) dictionary, as the
+        FrontEndChannel.getMap. compact stores the light yields as rows.
+        """
+        output = {"ClassName":self.ClassName}
+        values = self.columns[row]
+        types = self.types[row]
+        for name in ColumnNames:
+            value = values[name].item()
+            if name in UnsetColumns and value != value:
+                continue
+            output[name] = RestoreType(value, types[name])
+        output["Status"] = StatusCodes[values["Status"]]
+        output["Issues"] = self._issuerows[row]
+        for field in self.lightyields:
+            output[field] = self.storedRecord(field, row, compact)
+        output.update(self._extrarows[row])
+        return output
+
+    def loadMap(self, row, readdict):
+        # LightYield records are kept as loaded, until accessed:
+        for key in readdict:
+            self.set(row, key, readdict[key])
+
+    ####################################################################
+    # LightYield records, parsed on first access:
+    ####################################################################
+    def record(self, field, row):
+        value = self.lightyields[field][row]
+        if value is None or isinstance(value, LightYieldEstimator.LightYieldRecord):
+            return value
+        start = time.time()
+        value = LightYieldEstimator.LightYieldRecord.Load(value)
+        LazyStats["Parsed"] += 1
+        LazyStats["ParseSeconds"] += time.time() - start
+        self.lightyields[field][row] = value
+        return value
+
+    def storedRecord(self, field, row, compact):
+        # The record as stored: a row if compact, otherwise a map. Records
+        # not yet parsed are copied if already in that format:
+        value = self.lightyields[field][row]
+        if value is None:
+            return None
+        if not isinstance(value, LightYieldEstimator.LightYieldRecord):
+            if LightYieldEstimator.LightYieldRecord.IsRow(value) == compact:
+                return list(value) if compact else dict(value)
+            value = self.record(field, row)
+        return value.ToRow() if compact else value.getMap()
+
+    def CountDeferred(self):
+        """
+        Count the LightYield records not yet parsed, timing the parse of a
+        sample of them (for LazyReport).
+        """
+        deferred = [value for records in self.lightyields.values() for value in records
+                    if not (value is None or isinstance(value, LightYieldEstimator.LightYieldRecord))]
+        LazyStats["Deferred"] += len(deferred)
+        
+        start = time.time()
+        for value in deferred[:LAZY_SAMPLE]:
+            LightYieldEstimator.LightYieldRecord.Load(value)
+        LazyStats["Sampled"] += len(deferred[:LAZY_SAMPLE])
+        LazyStats["SampleSeconds"] += time.time() - start
+
+
+########################################################################
+class OwnedRows(object):
+    """
+    List of the rows of a side table (the Issues or extra members of each
+    channel), which copies a row shared with a snapshot before giving it
+    out, so changes made through it stay in this table.
+    """
+    
+    def __init__(self, table, rows):
+        self._table = table
+        self._rows = rows
+    
+    def __len__(self):
+        return len(self._rows)
+    
+    def __iter__(self):
+        for row in range(len(self._rows)):
+            yield self[row]
+    
+    def __getitem__(self, row):
+        if isinstance(row, slice):
+            return [self[r] for r in range(len(self._rows))[row]]
+        row = range(len(self._rows))[row]
+        # The row may be changed in place:
+        self._table._issueindex = None
+        self._table.own(row)
+        return self._rows[row]
+    
+    def __setitem__(self, row, value):
+        row = range(len(self._rows))[row]
+        self._table._issueindex = None
+        self._table.own(row)
+        self._rows[row] = value
+
+
+########################################################################
+class IssueIndex(object):
+    """
+    Flat, indexed copy of the Issues of every channel, for queries by
+    channel, issue type and severity without looping over the lists.
+    Each issue has its row (channel), type code and (numeric) severity;
+    issues without a numeric severity have a NaN severity.
+    
+    Per channel: MaxSeverity (-inf for no issues) and Accepted (has an
+    "AcceptedBad" issue).
+    """
+    
+    def __init__(self, issues):
+        
+        counts = numpy.array([len(channel_issues) for channel_issues in issues], dtype=numpy.int64)
+        self.issues = [issue for channel_issues in issues for issue in channel_issues]
+        self.rows = numpy.repeat(numpy.arange(len(issues)), counts)
+        self.offsets = numpy.concatenate([[0], numpy.cumsum(counts)])
+        
+        # Issue types:
+        self.types = []
+        type_codes = {}
+        self.typecodes = numpy.empty(len(self.issues), dtype=numpy.int32)
+        self.severities = numpy.empty(len(self.issues), dtype=numpy.float64)
+        for i, issue in enumerate(self.issues):
+            name, severity = IssueFields(issue)
+            if not name in type_codes:
+                type_codes[name] = len(self.types)
+                self.types.append(name)
+            self.typecodes[i] = type_codes[name]
+            self.severities[i] = severity
+        
+        # Per channel summaries:
+        self.MaxSeverity = numpy.full(len(issues), -numpy.inf)
+        numeric = ~numpy.isnan(self.severities)
+        numpy.maximum.at(self.MaxSeverity, self.rows[numeric], self.severities[numeric])
+        self.Accepted = self.HasIssue("AcceptedBad")
+    
+    def Select(self, issue=None, minseverity=None, maxseverity=None, rows=None):
+        """
+        Mask of the issues of a type (name or list of names), with
+        minseverity < Severity <= maxseverity, in the rows (mask).
+        """
+        mask = numpy.ones(len(self.issues), dtype=bool)
+        if issue is not None:
+            names = [issue] if isinstance(issue, basestring) else issue
+            selected = numpy.array([name in names for name in self.types] + [False])
+            mask &= selected[self.typecodes]
+        if minseverity is not None:
+            mask &= self.severities > minseverity
+        if maxseverity is not None:
+            mask &= self.severities <= maxseverity
+        if rows is not None:
+            mask &= numpy.asarray(rows)[self.rows]
+        return mask
+    
+    def Channels(self, issue=None, minseverity=None, maxseverity=None):
+        """
+        Sorted rows (channels) with a matching issue (see Select).
+        """
+        return numpy.unique(self.rows[self.Select(issue, minseverity, maxseverity)])
+    
+    def HasIssue(self, issue=None, minseverity=None, maxseverity=None):
+        """
+        Mask of the rows (channels) with a matching issue (see Select).
+        """
+        mask = numpy.zeros(len(self.MaxSeverity), dtype=bool)
+        mask[self.rows[self.Select(issue, minseverity, maxseverity)]] = True
+        return mask
+    
+    def ByChannel(self, row):
+        """
+        The issues of a row (channel).
+        """
+        return self.issues[self.offsets[row]:self.offsets[row+1]]
+
+
+def IssueFields(issue):
+    """
+    The type and numeric severity of an issue, (None, NaN) where they
+    are missing (eg. old issues stored as plain strings).
+    """
+    try:
+        name = issue["Issue"]
+    except (KeyError, TypeError, IndexError):
+        name = None
+    try:
+        severity = float(issue["Severity"])
+    except (KeyError, TypeError, IndexError, ValueError):
+        severity = numpy.nan
+    return name, severity
+
+
+if __name__ == "__main__":
+    
+    import FECalibrationUtils
+    
+    print (module_description)
+    
+    channels = FECalibrationUtils.LoadFEChannelList(sys.argv[1])
+    FECalibrationUtils.SaveFEChannelList(channels, sys.argv[2])
+    converted = FECalibrationUtils.LoadFEChannelList(sys.argv[2])
+    
+    # Compare the maps, as they would be written to json:
+    mismatched = [a.ChannelUID for a, b in zip(channels, converted)
+                  if json.dumps(a.getMap(), sort_keys=True) != json.dumps(b.getMap(), sort_keys=True)]
+    print ("Converted %i channels, %i mismatched"%(len(channels), len(mismatched)))
+    if len(mismatched) > 0 or len(channels) != len(converted):
+        sys.exit(1)
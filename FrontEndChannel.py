@@ -22,72 +22,72 @@ Should store the following infomation:
 
 #import TrackerMapping
 import LightYieldEstimator
+import FEChannelTable
 
 ########################################################################
 # Class Definition:
 ########################################################################
 
-class FrontEndChannel:
+class FrontEndChannel(object):
+    """
+    A row view of a FEChannelTable, the members are read from and written
+    to the row of the table. Constructed without a table, the channel
+    has its own single row table.
     
+    Members which are not columns of the table are kept in the table's
+    side tables.
+    """
+    
+    # Members holding LightYieldEstimator results, these are stored
+    # as LightYieldRecords (parsed from the file on first access):
+    LightYieldFields = ("LightYieldExtLED", "LightYieldExtNoLED",
+                        "LightYieldIntLED", "LightYieldIntNoLED")
+    
+    __slots__ = ("_table", "_row")
     
     ####################################################################
     # Constructor:
     #   Map is a dict generated from the menber variables which can
     #   be used to initilize the object with, if present.
-    def __init__(self, Map=None):
+    #   table/row is the FEChannelTable row to view.
+    def __init__(self, Map=None, table=None, row=0):
         
         ####################################################################
-        # Member Variables:
+        # Member Variables (see FEChannelTable.Columns):
+        #   ChannelUID - Unique Identfier
+        #   Module, ModuleUID (0 to 127), Bank, BankUID (also geoid, 0 to 63),
+        #   Board, ModuleChannel, BankChannel - Electronics Identifier
+        #   InTracker, Tracker, Station, Plane, PlaneChannel - Tracker Identifier
+        #   Status, Issues - Channel Status
+        #   LightYield*, ADC_Pedestal, ADC_Gain, ADC_Gain_FFT (peak spacing
+        #   estimate, for cross-checks), Light_Yield, Dark_Yield,
+        #   noise_1pe_rate, noise_2pe_rate - Light Yields / ADC calibrations
         ####################################################################
-        self.ClassName = "FrontEndChannel"
-         
-        # Unique Identfier:
-        self.ChannelUID = 0
-        
-        # Electronics Identifier:
-        self.Module = 0
-        self.ModuleUID = 0 # unique identfier (0 to 127)
-        self.Bank = 0
-        self.BankUID = 0 # unique bank (also geoid) - 0 to 63
-        self.Board = 0
-        self.ModuleChannel = 0
-        self.BankChannel = 0
-        
-        # Tracker Identifier:
-        self.InTracker = 0
-        self.Tracker = 0
-        self.Station = 0
-        self.Plane = 0
-        self.PlaneChannel = 0
-        
-        # Channel Status:
-        self.Status = "NODATA"
-        self.Issues = []
-        
-        # Light Yields / ADC calibrations:
-        self.LightYieldExtLED = None
-        self.LightYieldExtNoLED = None
-        self.LightYieldIntLED = None
-        self.LightYieldIntNoLED = None
-        self.ADC_Pedestal = 0
-        self.ADC_Gain = 0
-        self.Light_Yield = 0
-        self.Dark_Yield = 0
-        self.noise_1pe_rate = 0
-        self.noise_2pe_rate = 0
+        if table is None:
+            table = FEChannelTable.FEChannelTable(1)
+        object.__setattr__(self, "_table", table)
+        object.__setattr__(self, "_row", row)
         
         if not (Map is None):
             self.loadMap(Map)
+    
+    def __getattr__(self, name):
+        if name.startswith("_"):
+            raise AttributeError(name)
+        return self._table.get(self._row, name)
+    
+    def __setattr__(self, name, value):
+        if name in self.__slots__:
+            object.__setattr__(self, name, value)
         else:
-            self.Issues = []
+            self._table.set(self._row, name, value)
     
     # getMap - allows the objects members to be extracted as a python
-    # dictionary.
-    def getMap(self):
-        return self.__dict__
+    # dictionary. compact stores the light yields as rows, rather
+    # than maps.
+    def getMap(self, compact=False):
+        return self._table.getMap(self._row, compact)
     
     # loadMap - allows the object to be loaded from a dictoinary.
     def loadMap(self,readdict):
-        for key in readdict:
-            setattr(self, key, readdict[key])
-    
+        self._table.loadMap(self._row, readdict)
@@ -8,7 +8,9 @@ Areguments are : rootdir, path to calibration root directory.
 """
 
 import xml.dom.minidom as dom
+import numpy
 import FECalibrationUtils
+import FEChannelTable
 import ADCCalibrator
 import os
 import sys
@@ -235,21 +237,20 @@ def CalibrationSummary (path):
     tablebad.appendChild(tr)
     
     # Consistency Checks ##################################################:
-    for channel in Calibration.FEChannels:
-        if channel.ADC_Pedestal < 0.1 and channel.InTracker:
-            tr = doc.createElement("tr")
-            AddTextNode(doc, tr, "th", str(channel.ChannelUID))
-            AddTextNode(doc, tr, "th", str(channel.Tracker))
-            AddTextNode(doc, tr, "th", str(channel.Station))
-            AddTextNode(doc, tr, "th", str(channel.Plane))
-            AddTextNode(doc, tr, "th", str(channel.PlaneChannel))
-            
-            txt_issues = doc.createElement("th")
-            for issue in channel.Issues:
-                AddTextNode(doc, txt_issues, "p", str(issue["Comment"]))
-            tr.appendChild(txt_issues)
-            
-            tablebad.appendChild(tr)
+    FEChannels = Calibration.FEChannels
+    Issues = FEChannels.IssueIndex()
+    bad = (FEChannels["ADC_Pedestal"] < 0.1) & (FEChannels["InTracker"] != 0)
+    for row in numpy.nonzero(bad)[0]:
+        tr = doc.createElement("tr")
+        for name in ("ChannelUID", "Tracker", "Station", "Plane", "PlaneChannel"):
+            AddTextNode(doc, tr, "th", str(FEChannels[name][row]))
+        
+        txt_issues = doc.createElement("th")
+        for issue in Issues.ByChannel(row):
+            AddTextNode(doc, txt_issues, "p", str(issue["Comment"]))
+        tr.appendChild(txt_issues)
+        
+        tablebad.appendChild(tr)
     body.appendChild(tablebad)
     
     # save:
@@ -363,4 +364,5 @@ if __name__ == "__main__":
         raise
     
     GenerateIndexSummart(rootpath)
+    FEChannelTable.LazyReport()
     
\ No newline at end of file
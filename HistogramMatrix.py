@@ -0,0 +1,264 @@
+#!/usr/bin/env python
+module_description=\
+"""
+Whole detector histogram matrices.
+
+The raw ADC data is stored as a TH2 of ChannelUID vs ADC counts, which
+is normally projected one channel at a time before the bins are
+integrated. This module copies the TH2 into a numpy matrix once, and
+precomputes the cumulative sums along the ADC axis, so that an
+"integral between thresholds" for every channel becomes a pair of
+array lookups.
+
+Bin numbering follows ROOT: column 0 is the underflow, columns
+1..nbins are the ADC bins and column nbins+1 is the overflow. Row i
+holds the projection of ChannelUID i (ie. TH2 x bin i+1).
+
+Low memory mode ("LowMemoryHistograms" in the config.json) stores the
+counts as uint32 and does the whole matrix arithmetic in float32,
+halving the memory and bandwidth of the float64 matrices. Run
+BatchEstimators.py with a DAQ file to check its accuracy against the
+float64 path.
+"""
+
+import numpy
+
+# Numpy types of the TH2 bin contents (GetArray buffers):
+BufferTypes = [("TH2D", numpy.float64), ("TH2F", numpy.float32),
+               ("TH2I", numpy.int32), ("TH2S", numpy.int16),
+               ("TH2C", numpy.int8)]
+
+# Channels rounded into the uint32 counts at a time:
+ChunkChannels = 512
+
+
+class HistogramMatrix:
+    """
+    Matrix of ADC histograms, one row per channel, with cached
+    cumulative sums for fast integrals.
+    """
+
+    def __init__(self, counts, xmin=-0.5, xmax=255.5, lowmemory=False):
+        """
+        counts - array [channel, bin] including under/overflow bins.
+        xmin, xmax - limits of the ADC axis (as TAxis::GetXmin/GetXmax)
+        lowmemory - store uint32 counts, with float32 work arrays.
+        """
+        self.lowmemory = bool(lowmemory)
+        if self.lowmemory:
+            if numpy.asarray(counts).dtype == numpy.uint32:
+                self.counts = numpy.asarray(counts)
+            else:
+                self.counts = numpy.rint(counts).astype(numpy.uint32)
+            self.dtype = numpy.float32
+        else:
+            self.counts = numpy.asarray(counts, dtype=numpy.float64)
+            self.dtype = numpy.float64
+        self.nbins = self.counts.shape[1] - 2
+        self.xmin = float(xmin)
+        self.xmax = float(xmax)
+        self._cumulative = None
+
+    @staticmethod
+    def FromTH2(hist, lowmemory=False):
+        """
+        Copy a ROOT TH2 (ChannelUID vs ADC) into a histogram matrix.
+        """
+        nx = hist.GetNbinsX()
+        ny = hist.GetNbinsY()
+
+        # View the bin contents in place, in their own type:
+        dtype = numpy.float64
+        for name, buftype in BufferTypes:
+            if hist.InheritsFrom(name):
+                dtype = buftype
+                break
+        buf = hist.GetArray()
+        buf.SetSize(hist.GetSize())
+        flat = numpy.frombuffer(buf, dtype=dtype, count=hist.GetSize())
+
+        # ROOT global bin = binx + (nx+2)*biny, so reshape as [biny, binx]
+        # and transpose, dropping the under/overflow channels.
+        view = flat.reshape(ny+2, nx+2).T[1:nx+1, :]
+
+        # Copy once, straight into the type of the matrix:
+        if lowmemory:
+            counts = numpy.empty(view.shape, dtype=numpy.uint32)
+            for start in range(0, nx, ChunkChannels):
+                counts[start:start+ChunkChannels] = numpy.rint(view[start:start+ChunkChannels])
+        else:
+            counts = numpy.array(view, dtype=numpy.float64, order="C")
+
+        yaxis = hist.GetYaxis()
+        return HistogramMatrix(counts, yaxis.GetXmin(), yaxis.GetXmax(), lowmemory)
+
+    ####################################################################
+    def ZeroBins(self, nbins):
+        """
+        Equivalent of SetBinContent(i, 0.0) for i in range(nbins) on
+        every channel.
+        """
+        self.counts[:, 0:nbins] = 0
+        self._cumulative = None
+
+    def FindBin(self, x):
+        """
+        Vectorised TAxis::FindBin for the (fixed width) ADC axis.
+        """
+        x = numpy.asarray(x, dtype=numpy.float64)
+        width = (self.xmax - self.xmin)/self.nbins
+        bins = numpy.floor((x - self.xmin)/width).astype(numpy.int64) + 1
+        bins = numpy.where(x < self.xmin, 0, bins)
+        bins = numpy.where(x >= self.xmax, self.nbins+1, bins)
+        return bins
+
+    def BinCenter(self, bins):
+        """
+        Vectorised TAxis::GetBinCenter.
+        """
+        width = (self.xmax - self.xmin)/self.nbins
+        return self.xmin + (numpy.asarray(bins, dtype=numpy.float64) - 0.5)*width
+
+    ####################################################################
+    def Cumulative(self):
+        """
+        Cumulative sum along the ADC axis, with a leading zero column, so
+        C[:, b] is the sum of bins 0..b-1.
+        """
+        if self._cumulative is None:
+            C = numpy.zeros((self.counts.shape[0], self.counts.shape[1]+1),
+                            dtype=self.counts.dtype)
+            numpy.cumsum(self.counts, axis=1, out=C[:, 1:])
+            self._cumulative = C
+        return self._cumulative
+
+    def Integral(self, lowbin, highbin, channels=None):
+        """
+        Vectorised TH1::Integral(lowbin, highbin) over every channel.
+        lowbin/highbin may be scalars or one value per channel.
+        """
+        C = self.Cumulative()
+        if channels is None:
+            channels = numpy.arange(C.shape[0])
+
+        low = numpy.clip(numpy.asarray(lowbin), 0, self.nbins+1)
+        high = numpy.clip(numpy.asarray(highbin), 0, self.nbins+1)
+        low = numpy.broadcast_to(low, numpy.shape(channels))
+        high = numpy.broadcast_to(high, numpy.shape(channels))
+
+        # (unsigned differences are only used where high >= low)
+        integral = C[channels, high+1] - C[channels, low]
+        return numpy.where(high < low, 0, integral).astype(self.dtype)
+
+    def Entries(self):
+        """
+        Total entries in each channel (including under/overflow).
+        """
+        return self.Cumulative()[:, -1].astype(self.dtype)
+
+    def Weights(self):
+        """
+        The ADC bins 1..nbins as a work array (float32 in low memory mode).
+        """
+        return self.counts[:, 1:self.nbins+1].astype(self.dtype)
+
+    def Mean(self):
+        """
+        Vectorised TH1::GetMean, computed from bins 1..nbins.
+        """
+        x = self.BinCenter(numpy.arange(1, self.nbins+1)).astype(self.dtype)
+        w = self.Weights()
+        sumw = w.sum(axis=1)
+        with numpy.errstate(invalid="ignore", divide="ignore"):
+            return numpy.where(sumw > 0, w.dot(x)/sumw, 0.0)
+
+    def RMS(self):
+        """
+        Vectorised TH1::GetRMS, computed from bins 1..nbins.
+        """
+        x = self.BinCenter(numpy.arange(1, self.nbins+1)).astype(self.dtype)
+        w = self.Weights()
+        sumw = w.sum(axis=1)
+        with numpy.errstate(invalid="ignore", divide="ignore"):
+            mean = numpy.where(sumw > 0, w.dot(x)/sumw, 0.0)
+            var = numpy.where(sumw > 0, w.dot(x*x)/sumw - mean*mean, 0.0)
+        return numpy.sqrt(numpy.maximum(var, 0.0))
+
+    ####################################################################
+    # Batched equivalents of the LightYieldEstimator integrals:
+    ####################################################################
+    def IntegralAbove(self, thresholds, upperbin=None):
+        """
+        Integral from FindBin(threshold) up to upperbin (default: last
+        ADC bin) for each channel.
+        """
+        if upperbin is None:
+            upperbin = self.nbins
+        return self.Integral(self.FindBin(thresholds), upperbin)
+
+    def DarkCounts(self, peaks):
+        """
+        Batched LightYieldEstimator.getDarkCount: the fraction of entries
+        above the single pe peak. peaks is [channel, npeaks] or the
+        single pe position for each channel.
+        """
+        peaks = numpy.asarray(peaks, dtype=numpy.float64)
+        if peaks.ndim == 2:
+            peaks = peaks[:, 1]
+        above = self.IntegralAbove(peaks)
+        total = self.Integral(1, self.nbins)
+        with numpy.errstate(invalid="ignore", divide="ignore"):
+            return numpy.where(total > 0, above/total, 0.0)
+
+    def PeakIntegrals(self, peaks):
+        """
+        Batched LightYieldEstimator.peakIntegrals. peaks is
+        [channel, npeaks]; returns the integral of each peak as
+        [channel, npeaks], with the same (inclusive) bin edges.
+        """
+        peaks = numpy.asarray(peaks, dtype=numpy.float64)
+        nchan, npeaks = peaks.shape
+
+        lowbins = numpy.empty((nchan, npeaks), dtype=numpy.int64)
+        highbins = numpy.empty((nchan, npeaks), dtype=numpy.int64)
+        lowbins[:, 0] = self.FindBin(0)
+        lowbins[:, 1:] = self.FindBin(peaks[:, :-1])
+        highbins[:, :-1] = self.FindBin(peaks[:, :-1])
+        highbins[:, -1] = self.FindBin(255)
+
+        channels = numpy.repeat(numpy.arange(nchan), npeaks).reshape(nchan, npeaks)
+        return self.Integral(lowbins, highbins, channels)
+
+    def BreakdownRatios(self):
+        """
+        Batched LightYieldEstimator.detectBreakdown ratio, the fraction
+        of entries above ADC 240 or below bin 5. A channel is in
+        breakdown when this is above 0.01.
+        """
+        upper = self.Integral(self.FindBin(240), self.nbins)
+        lower = self.Integral(0, 5)
+        entries = self.Entries()
+        with numpy.errstate(invalid="ignore", divide="ignore"):
+            return numpy.where(entries > 0, (upper + lower)/entries, 0.0)
+
+
+if __name__ == "__main__":
+
+    # Test script, compare with the per channel ROOT integrals:
+    import sys
+    import TrDAQReader
+    from LightYieldEstimator import LightYieldEstimator
+
+    print (module_description)
+
+    allpeds = TrDAQReader.TrDAQRead(sys.argv[1])["RawADCs"]
+    matrix = HistogramMatrix.FromTH2(allpeds)
+    breakdown = matrix.BreakdownRatios()
+
+    lye = LightYieldEstimator()
+    for channel in range(0, matrix.counts.shape[0], 512):
+        ch = allpeds.ProjectionY("th1d_projecty", channel+1, channel+1, "")
+        if ch.GetEntries() < 1:
+            continue
+        ratio = (ch.Integral(ch.FindBin(240), ch.GetNbinsX()) + ch.Integral(0, 5))/ch.GetEntries()
+        print ("channel: %i, breakdown ROOT: %.5f, matrix: %.5f"%(channel, ratio, breakdown[channel]))
@@ -8,16 +8,24 @@ module_description = \
     
     Much of this code was stolen from Adeys LYCalib routine.
     
+    The processing is a chain of named steps, which can be skipped
+    or replaced with the "LightYieldSteps" list in the config.json
+    (see StepChain), timings of each step are printed at the end
+    of the ADCCalibrator and BiasCalibrator runs.
+    
 """
 
 import ROOT
 import sys
+import copy
 #sys.path.insert(0, '/home/ed/tracker/analysis')
 sys.path.insert(0, '/home/ed/MICE/tracker/analysis/')
 from TrDAQReader import TrDAQRead
 import numpy
 import math
 import array
+import time
+import BatchEstimators
 
 #Compare tolerence (for comparing floats)
 cmp_tol = 1E-6
@@ -69,6 +77,9 @@ class LightYieldEstimator:
         
     def getMap(self):
         return self.__dict__
+    
+    def getRecord(self):
+        return LightYieldRecord.FromMap(self.__dict__)
         
     def loadMap(self,readdict):
         for key in readdict:
@@ -76,10 +87,19 @@ class LightYieldEstimator:
         
         
     ####################################################################
-    def process(self, channel_histogram, ledLYE=None, poissonfit=None):
+    def process(self, channel_histogram, ledLYE=None, poissonfit=None, darkcount=None,
+                screen=None):
         """
         Process a histogram to locate each of the photo peaks and
-        then use this to estimate stuff:
+        then use this to estimate stuff, by running each of the steps
+        of the chain (see StepChain) in turn:
+        
+        darkcount - optional batched dark count estimate (see
+                    BatchEstimators.EstimateDarkCounts), used in place
+                    of the estimateDarkCount fit when given.
+        screen - optional pre-screen state of the channel (see
+                 BatchEstimators.PreScreenChannels), used in place of
+                 the empty and breakdown checks when given.
         """
         self.reset();        
         ch = channel_histogram
@@ -88,76 +108,106 @@ class LightYieldEstimator:
         self.RMS = channel_histogram.GetRMS()
         self.Mean = channel_histogram.GetMean()
         
+        context = {"ledLYE":ledLYE, "poissonfit":poissonfit, "darkcount":darkcount,
+                   "screen":screen, "nPeaks":0, "spectrum":None}
+        chain.run(self, ch, context)
+        
+    ####################################################################
+    # Processing steps, each returns False to stop the processing:
+    ####################################################################
+    def stepEmpty(self, ch, context):
         # Check entries for empty histogram:
-        if( ch.GetEntries() == 0):
+        screen = context["screen"]
+        if (screen == BatchEstimators.SCREEN_EMPTY) or \
+           (screen is None and ch.GetEntries() == 0):
             print ("NoData Detected.")
             self.ChannelState = "NoData"
-            return     
+            return False
+        return True
         
+    def stepBreakdown(self, ch, context):
         # If the max bin is set, then the channel is probably in beakdown:
-        if self.detectBreakdown(ch):
+        screen = context["screen"]
+        if (screen == BatchEstimators.SCREEN_BREAKDOWN) or \
+           (screen is None and self.detectBreakdown(ch)):
             print ("Breakdown Detected.")
             self.ChannelState = "Breakdown"
-            return
+            return False
+        return True
         
+    def stepSearch(self, ch, context):
+        poissonfit = context["poissonfit"]
         if poissonfit is not None:
             # Load peaks from poisson fit:
             self.gain = poissonfit["fitpar"]["gain"]
             self.offset = poissonfit["fitpar"]["pedestal"]
             self.Peaks = [self.offset + i*self.gain for i in range(5)]
-            nPeaks = len (self.Peaks)    
-        else:
-            # No poission fitted peaks available, use traditional method:
-            # Using a ROOT TSpectrum, find the PE peaks in this channel's
-            # ADC distribution, then store the positions of the peaks in self.Peaks
-            # 2 = minimum peak sigma, 0.0025  = minimum min:max peak height ratio - see TSpectrum
-            #nPeaks = spectrum.Search(ch, 1.95,"", 0.005 ) # setting for finding peaks on bias calibration sweep.
-            for sigmas,thresholds in zip([3.0,2.0,1.5,1.0,0.5],[0.05,0.05,0.01,0.005,0.005]):
-                spectrum = ROOT.TSpectrum()
-                nPeaks = spectrum.Search(ch, sigmas,"", thresholds) # setting for finding peaks on bias calibration sweep.
-                if nPeaks > 1:
-                    break
-        
-            #nPeaks = 0
-            #nPeaks = spectrum.Search(ch, 1.6,"nobackground,noMarkov", 0.001 )
-            
-            # If one peaks was found, then its probable that things were under biased..
-            if (nPeaks == 0):
-                print ("NoPeaks Detected.")
-                
-                # Try to find something with the hi-res-search?
-                binsx = ch.GetNbinsX()
-                source = array.array( 'f', [0]*binsx)
-                for bin in range(ch.GetNbinsX()):
-                    source[bin] = ch.GetBinContent(bin)
-                
-                dest = array.array( 'f', [0]*binsx )
-                
-                nPeaks = spectrum.Search1HighRes(source, dest, binsx, 1.0, 0.0005, False, 4, True, 3)
-                
-                if (nPeaks == 0):
-                    self.ChannelState = "NoPeaks"
-                    return
-            
-            # Load and re-order the peaks...
-            temp_peaks = spectrum.GetPositionX()
-            for p in range(nPeaks): 
-                    if (temp_peaks[p] > 1.0):
-                        self.Peaks.append(temp_peaks[p])
-            self.Peaks.sort()
-        
-        if (nPeaks == 1):
+            context["nPeaks"] = len (self.Peaks)
+            return True
+        
+        # No poission fitted peaks available, use traditional method:
+        # Using a ROOT TSpectrum, find the PE peaks in this channel's
+        # ADC distribution, then store the positions of the peaks in self.Peaks
+        # 2 = minimum peak sigma, 0.0025  = minimum min:max peak height ratio - see TSpectrum
+        #nPeaks = spectrum.Search(ch, 1.95,"", 0.005 ) # setting for finding peaks on bias calibration sweep.
+        for sigmas,thresholds in zip([3.0,2.0,1.5,1.0,0.5],[0.05,0.05,0.01,0.005,0.005]):
+            spectrum = ROOT.TSpectrum()
+            nPeaks = spectrum.Search(ch, sigmas,"", thresholds) # setting for finding peaks on bias calibration sweep.
+            if nPeaks > 1:
+                break
+        
+        #nPeaks = 0
+        #nPeaks = spectrum.Search(ch, 1.6,"nobackground,noMarkov", 0.001 )
+        context["nPeaks"] = nPeaks
+        context["spectrum"] = spectrum
+        
+        if nPeaks > 0:
+            self.loadSpectrumPeaks(spectrum, nPeaks)
+        return True
+        
+    def stepFallback(self, ch, context):
+        # If one peaks was found, then its probable that things were under biased..
+        if (context["nPeaks"] != 0):
+            return True
+        print ("NoPeaks Detected.")
+        
+        # Try to find something with the hi-res-search?
+        spectrum = context["spectrum"]
+        if spectrum is None:
+            spectrum = ROOT.TSpectrum()
+        binsx = ch.GetNbinsX()
+        source = array.array( 'f', [0]*binsx)
+        for bin in range(ch.GetNbinsX()):
+            source[bin] = ch.GetBinContent(bin)
+        
+        dest = array.array( 'f', [0]*binsx )
+        
+        nPeaks = spectrum.Search1HighRes(source, dest, binsx, 1.0, 0.0005, False, 4, True, 3)
+        context["nPeaks"] = nPeaks
+        
+        if (nPeaks == 0):
+            self.ChannelState = "NoPeaks"
+            return False
+        
+        self.loadSpectrumPeaks(spectrum, nPeaks)
+        return True
+        
+    def stepSinglePeak(self, ch, context):
+        if (context["nPeaks"] == 1):
+            ledLYE = context["ledLYE"]
             #self.darkcounts = self.estimateDarkCount(ch)
             self.ChannelState = "NoPEPeaks"
-            if (ledLYE is None):
-                self.darkcounts = self.estimateDarkCount(ch)
-                return
-            elif( len(ledLYE.Peaks) < 2):
-                self.darkcounts = self.estimateDarkCount(ch)
-                return
-
-        
+            if (ledLYE is None) or ( len(ledLYE.Peaks) < 2):
+                if context["darkcount"] is None:
+                    self.darkcounts = self.estimateDarkCount(ch)
+                else:
+                    self.darkcounts = context["darkcount"]
+                return False
+        return True
+        
+    def stepGain(self, ch, context):
         # If availalbe use LED LYE:
+        ledLYE = context["ledLYE"]
         if not (ledLYE is None):
             # Check for more peaks than LED peaks:
             if ( (len (self.Peaks) > len (ledLYE.Peaks) ) and \
@@ -165,7 +215,7 @@ class LightYieldEstimator:
                 print ("Peak mismatch.. more for noled!")
                 self.ChannelState = "LEDPeakMisMatch"
                 #self.darkcounts = self.estimateDarkCount(ch)
-                return
+                return False
             
             # Copy values LED found:         
             self.gain = ledLYE.gain
@@ -186,8 +236,10 @@ class LightYieldEstimator:
             self.gain = self.gainEstimator()
             self.offset = self.Peaks[0]
         
-            
         self.ChannelState = "PEPeaks"
+        return True
+        
+    def stepDarkCount(self, ch, context):
         # Calculate Dark Count:
         self.darkcounts_old = self.getDarkCount(ch)
         #self.darkcounts = self.estimateDarkCount(ch)
@@ -195,10 +247,21 @@ class LightYieldEstimator:
         
         #self.darkcounts = self.darkcounts_old
         #print ("Gain = %.3f"%self.gain)
-        
-        # Estimate the average npe:
-        self.pe = (ch.GetMean() - self.offset)/self.gain
-        
+        return True
+        
+    def stepPE(self, ch, context):
+        # Estimate the average npe (left 0 without a gain):
+        if self.gain != 0:
+            self.pe = (ch.GetMean() - self.offset)/self.gain
+        return True
+        
+    def loadSpectrumPeaks(self, spectrum, nPeaks):
+        # Load and re-order the peaks...
+        temp_peaks = spectrum.GetPositionX()
+        for p in range(nPeaks): 
+                if (temp_peaks[p] > 1.0):
+                    self.Peaks.append(temp_peaks[p])
+        self.Peaks.sort()
         
 
     ####################################################################
@@ -404,6 +467,246 @@ class LightYieldEstimator:
     
         
     
+########################################################################
+class StepChain:
+    """
+    The chain of named steps run by LightYieldEstimator.process, with
+    cumulative timings and counters for each step.
+    
+    A step is either the name of a LightYieldEstimator step method
+    (stepEmpty -> "Empty"), or the dotted name of a replacement function
+    ("module.function"), called as function(lye, hist, context). Steps
+    are skipped by leaving them out of the list, but not the steps that
+    later steps use the results of (see Requires). A replacement function
+    can list the steps it stands in for in a Provides attribute.
+    """
+    
+    DefaultSteps = ["Empty", "Breakdown", "Search", "Fallback", "SinglePeak",
+                    "Gain", "DarkCount", "PE"]
+    
+    # Steps which must be run before a step (for the peaks, spectrum and
+    # gain they find):
+    Requires = {"Fallback":["Search"], "SinglePeak":["Search"], "Gain":["Search"],
+                "DarkCount":["Gain"], "PE":["Gain"]}
+    
+    def __init__(self, names=None):
+        self.configure(names)
+        
+    def configure(self, names=None):
+        if names is None:
+            names = self.DefaultSteps
+        self.steps = [(name, self.resolve(name)) for name in names]
+        self.check()
+        self.reset()
+        
+    def check(self):
+        # Each step's required steps must come before it:
+        provided = []
+        for name, step in self.steps:
+            for required in self.Requires.get(name, []):
+                if not required in provided:
+                    raise Exception ("Light yield step %s needs the %s step before it"%(name, required))
+            provided.append(name)
+            provided.extend(getattr(step, "Provides", []))
+        
+    @staticmethod
+    def resolve(name):
+        if hasattr(LightYieldEstimator, "step" + name):
+            return getattr(LightYieldEstimator, "step" + name)
+        if "." in name:
+            module_name, function_name = name.rsplit(".", 1)
+            module = __import__(module_name, fromlist=[function_name])
+            return getattr(module, function_name)
+        raise KeyError("Unknown light yield step: %s"%name)
+        
+    def reset(self):
+        # name: [calls, stops, seconds]
+        self.counters = dict((name, [0, 0, 0.0]) for name, step in self.steps)
+        self.states = {}
+        self.channels = 0
+        
+    def run(self, lye, hist, context):
+        self.channels += 1
+        for name, step in self.steps:
+            start = time.time()
+            proceed = step(lye, hist, context)
+            counter = self.counters[name]
+            counter[0] += 1
+            counter[2] += time.time() - start
+            if not proceed:
+                counter[1] += 1
+                break
+        self.states[lye.ChannelState] = self.states.get(lye.ChannelState, 0) + 1
+        
+    def stats(self):
+        """
+        Counters of the chain, to be merged into another (eg. from a
+        worker process).
+        """
+        return {"counters":self.counters, "states":self.states, "channels":self.channels}
+        
+    def merge(self, stats):
+        self.channels += stats["channels"]
+        for name, (calls, stops, seconds) in stats["counters"].items():
+            counter = self.counters.setdefault(name, [0, 0, 0.0])
+            counter[0] += calls
+            counter[1] += stops
+            counter[2] += seconds
+        for state, count in stats["states"].items():
+            self.states[state] = self.states.get(state, 0) + count
+        
+    def report(self):
+        lines = ["Light yield estimator: %i channels processed"%self.channels,
+                 "%-24s %8s %8s %10s %10s"%("step", "calls", "stops", "total [s]", "mean [ms]")]
+        total = 0.0
+        for name, step in self.steps:
+            calls, stops, seconds = self.counters[name]
+            total += seconds
+            lines.append("%-24s %8i %8i %10.2f %10.3f"%\
+                         (name, calls, stops, seconds, 1000.*seconds/calls if calls else 0.))
+        lines.append("%-24s %8s %8s %10.2f"%("total", "", "", total))
+        for state in sorted(self.states):
+            lines.append("  %-22s %8i"%(state, self.states[state]))
+        return "\n".join(lines)
+        
+
+def ConfigureSteps(config):
+    """
+    Set up the processing steps from a configuration, using the
+    "LightYieldSteps" list if it is present.
+    """
+    chain.configure(config.get("LightYieldSteps", None))
+    
+def PrintStepReport():
+    print (chain.report())
+
+# Steps used by LightYieldEstimator.process:
+chain = StepChain()
+
+
+########################################################################
+class LightYieldRecord(object):
+    """
+    Compact, fixed schema copy of the LightYieldEstimator results, as
+    stored in the FrontEndChannel LightYield fields. Reads like the
+    getMap() dictionary (rec["Peaks"], "gain" in rec, ...), so it can be
+    used anywhere the map was, and converts losslessly to and from the
+    map and a compact row (list) format.
+    
+    Keys of the map which are not part of the schema are kept in Extra.
+    
+    Records shared between channel tables (see FEChannelTable.Snapshot)
+    are made read only, Copy() gives a record which can be changed.
+    """
+    
+    # Schema, in row order (Peaks, Integrals and IntegralPeaks are lists):
+    Fields = ("ChannelState", "gain", "offset", "darkcounts", "darkcounts_old",
+              "pe", "RMS", "Mean", "Peaks", "Integrals", "IntegralPeaks")
+    RowTag = "LYR"
+    
+    __slots__ = Fields + ("Extra", "_frozen")
+    
+    def __init__(self):
+        self.Extra = {}
+    
+    def Freeze(self):
+        object.__setattr__(self, "_frozen", True)
+    
+    def Copy(self):
+        return LightYieldRecord.FromMap(copy.deepcopy(self.getMap()))
+    
+    def checkFrozen(self):
+        if getattr(self, "_frozen", False):
+            raise AttributeError("LightYieldRecord is shared and read only, change a Copy()")
+    
+    def __setattr__(self, key, value):
+        self.checkFrozen()
+        object.__setattr__(self, key, value)
+    
+    def __delattr__(self, key):
+        self.checkFrozen()
+        object.__delattr__(self, key)
+    
+    @staticmethod
+    def FromMap(readdict):
+        record = LightYieldRecord()
+        for key in readdict:
+            if key in LightYieldRecord.Fields:
+                setattr(record, key, readdict[key])
+            else:
+                record.Extra[key] = readdict[key]
+        return record
+    
+    def getMap(self):
+        output = {}
+        for key in self.Fields:
+            if hasattr(self, key):
+                output[key] = getattr(self, key)
+        output.update(self.Extra)
+        return output
+    
+    @staticmethod
+    def FromRow(row):
+        record = LightYieldRecord()
+        for key, value in zip(LightYieldRecord.Fields, row[1:-2]):
+            setattr(record, key, value)
+        # Last entries are the list of unset fields, and the extras:
+        for key in row[-2]:
+            delattr(record, key)
+        record.Extra = dict(row[-1])
+        return record
+    
+    def ToRow(self):
+        missing = [key for key in self.Fields if not hasattr(self, key)]
+        return [self.RowTag] + [getattr(self, key, None) for key in self.Fields] + [missing, self.Extra]
+    
+    @staticmethod
+    def IsRow(value):
+        return isinstance(value, list) and len(value) > 0 and value[0] == LightYieldRecord.RowTag
+    
+    @staticmethod
+    def Load(value):
+        """
+        Make a record from a map, row or record (None stays None).
+        """
+        if value is None or isinstance(value, LightYieldRecord):
+            return value
+        if LightYieldRecord.IsRow(value):
+            return LightYieldRecord.FromRow(value)
+        return LightYieldRecord.FromMap(value)
+    
+    # Dictionary style access, matching the map format:
+    def keys(self):
+        return list(self.getMap().keys())
+    
+    def __iter__(self):
+        return iter(self.keys())
+    
+    def __contains__(self, key):
+        return hasattr(self, key) if key in self.Fields else (key in self.Extra)
+    
+    def __getitem__(self, key):
+        if key in self.Fields:
+            try:
+                return getattr(self, key)
+            except AttributeError:
+                raise KeyError(key)
+        return self.Extra[key]
+    
+    def __setitem__(self, key, value):
+        self.checkFrozen()
+        if key in self.Fields:
+            setattr(self, key, value)
+        else:
+            self.Extra[key] = value
+    
+    def get(self, key, default=None):
+        try:
+            return self[key]
+        except KeyError:
+            return default
+    
+    
 if __name__ == "__main__":
     
     #Test script:
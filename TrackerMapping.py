@@ -0,0 +1,214 @@
+#!/usr/bin/env python
+module_description=\
+"""
+Index of the tracker mapping, between the electronics channels
+(ChannelUID) and the tracker channels (Tracker, Station, Plane,
+PlaneChannel), held as integer arrays so both directions are single
+array lookups:
+
+    mapping = TrackerMapping.Load("scifi_mapping_2015-06-18.txt")
+    tracker, station, plane, planechannel = mapping.Location(ChannelUID)
+    ChannelUID = mapping.ChannelUID(tracker, station, plane, planechannel)
+
+Either direction also takes arrays of channels. The mapping is applied
+to a whole FEChannelTable with column operations (see Apply).
+
+Arguments (test script): mapping file
+    Loads and validates the mapping file, listing any duplicated or
+    missing channels.
+"""
+
+import sys
+import numpy
+
+import FECalibrationUtils
+
+# Members of each mapped channel (ChannelUID is the index):
+Fields = ("Board", "Bank", "BankChannel", "Tracker", "Station", "Plane", "PlaneChannel")
+LocationFields = ("Tracker", "Station", "Plane", "PlaneChannel")
+
+
+########################################################################
+class TrackerMapping(object):
+    """
+    Arrays of the mapping of every electronics channel (indexed by
+    ChannelUID, Mapped is False for channels outside the tracker), and
+    the reverse lookup table, indexed by (Tracker, Station, Plane,
+    PlaneChannel), of the ChannelUID (-1 for no channel).
+
+    Where a channel is mapped more than once, the last mapping is used
+    and the earlier ones are kept in Duplicates.
+    """
+
+    def __init__(self, nchannels=None):
+
+        if nchannels is None:
+            nchannels = FECalibrationUtils.NUM_CHANS
+
+        self.Mapped = numpy.zeros(nchannels, dtype=bool)
+        self.columns = dict((name, numpy.zeros(nchannels, dtype=numpy.int32)) for name in Fields)
+        self.Duplicates = []
+        self.reverse = numpy.full((0, 0, 0, 0), -1, dtype=numpy.int32)
+
+    @staticmethod
+    def Load(filename, nchannels=None):
+        """
+        Load a mapping file, lines of:
+            board bank bank_channel tracker station(1-5) plane plane_channel ...
+        """
+        rows = numpy.loadtxt(filename, dtype=numpy.int64, usecols=range(7), ndmin=2)
+        rows[:,4] -= 1 # Stations from 0
+        return TrackerMapping.FromArray(rows, nchannels)
+
+    @staticmethod
+    def FromArray(rows, nchannels=None):
+        """
+        Mapping from an array of rows of the Fields.
+        """
+        mapping = TrackerMapping(nchannels)
+        rows = numpy.asarray(rows, dtype=numpy.int64).reshape(-1, len(Fields))
+
+        # Electronics channel of each row, keeping the last of any
+        # duplicated channels:
+        uids = rows[:,0]*FECalibrationUtils.CHAN_PER_BANK*FECalibrationUtils.BANK_PER_BOARD \
+             + rows[:,1]*FECalibrationUtils.CHAN_PER_BANK + rows[:,2]
+        unique_uids, last = numpy.unique(uids[::-1], return_index=True)
+        last = len(uids) - 1 - last
+        duplicated = numpy.ones(len(uids), dtype=bool)
+        duplicated[last] = False
+        mapping.Duplicates = [dict(zip(("ChannelUID",) + Fields, [int(uid)] + [int(v) for v in row]))
+                              for uid, row in zip(uids[duplicated], rows[duplicated])]
+
+        rows = rows[last]
+        mapping.Mapped[unique_uids] = True
+        for i, name in enumerate(Fields):
+            mapping.columns[name][unique_uids] = rows[:,i]
+
+        mapping.BuildReverse()
+        return mapping
+
+    @staticmethod
+    def FromMaps(maps):
+        """
+        Mapping from a list (indexed by ChannelUID) of maps of the
+        Fields, as made by LoadMappingFile; empty maps are unmapped.
+        """
+        rows = [[Map[name] for name in Fields] for Map in maps if len(Map) > 0]
+        return TrackerMapping.FromArray(rows, len(maps))
+
+    def BuildReverse(self):
+        """
+        Fill the (Tracker, Station, Plane, PlaneChannel) -> ChannelUID
+        lookup table, from the mapped channels.
+        """
+        uids = numpy.nonzero(self.Mapped)[0]
+        location = [self.columns[name][uids] for name in LocationFields]
+        shape = tuple(int(l.max()) + 1 if len(l) > 0 else 0 for l in location)
+
+        self.reverse = numpy.full(shape, -1, dtype=numpy.int32)
+        # Reversed, so the lowest ChannelUID is kept for a shared location:
+        self.reverse[tuple(l[::-1] for l in location)] = uids[::-1]
+
+    def __len__(self):
+        return len(self.Mapped)
+
+    def __getitem__(self, ChannelUID):
+        """
+        Map of the mapping of a channel, KeyError for unmapped channels
+        (as the maps made by LoadMappingFile).
+        """
+        if not self.Mapped[ChannelUID]:
+            raise KeyError(ChannelUID)
+        Map = dict((name, int(self.columns[name][ChannelUID])) for name in Fields)
+        Map["ChannelUID"] = int(ChannelUID)
+        return Map
+
+    def Location(self, ChannelUID):
+        """
+        (Tracker, Station, Plane, PlaneChannel) of channel(s), valid
+        where Mapped.
+        """
+        return tuple(self.columns[name][ChannelUID] for name in LocationFields)
+
+    def ChannelUID(self, tracker, station, plane, planechannel):
+        """
+        ChannelUID(s) of tracker channel(s), -1 for no channel.
+        """
+        location = numpy.broadcast_arrays(tracker, station, plane, planechannel)
+        inside = numpy.ones(location[0].shape, dtype=bool)
+        for l, size in zip(location, self.reverse.shape):
+            inside &= (l >= 0) & (l < size)
+
+        uids = numpy.full(location[0].shape, -1, dtype=numpy.int32)
+        uids[inside] = self.reverse[tuple(l[inside] for l in location)]
+        if uids.ndim == 0:
+            return int(uids)
+        return uids
+
+    def Apply(self, FEChannels):
+        """
+        Set the tracker location of every channel of the table, and
+        InTracker, clearing the location of unmapped channels.
+        """
+        uids = FEChannels["ChannelUID"]
+        mapped = self.Mapped[uids]
+        if not mapped.any():
+            raise Exception ("No channels mapped to the detector, intolerable")
+
+        for name in LocationFields:
+            FEChannels[name] = numpy.where(mapped, self.columns[name][uids], 0)
+        FEChannels["InTracker"] = mapped
+        FEChannels.MarkDirty(slice(None))
+        return FEChannels
+
+    def Validate(self):
+        """
+        Check the mapping for duplicated electronics channels, tracker
+        channels mapped more than once, and gaps in the plane channel
+        numbers of each plane. Returns a list of Issues.
+        """
+        issues = []
+
+        for Map in self.Duplicates:
+            issues.append({"ChannelUID":Map["ChannelUID"], "Severity":10, "Issue":"Mapping",
+                           "Comment":"Channel mapped more than once, last mapping used"})
+
+        # Count of channels at each tracker location:
+        uids = numpy.nonzero(self.Mapped)[0]
+        location = tuple(self.columns[name][uids] for name in LocationFields)
+        flat = numpy.ravel_multi_index(location, self.reverse.shape) if len(uids) > 0 else uids
+        counts = numpy.bincount(flat, minlength=self.reverse.size).reshape(self.reverse.shape)
+
+        for uid, count in zip(uids, counts[location]):
+            if count > 1:
+                issues.append({"ChannelUID":int(uid), "Severity":10, "Issue":"Mapping",
+                               "Comment":"Tracker channel shared by %i channels"%count})
+
+        # Gaps, plane channels below the highest of a plane with no channel:
+        used = counts > 0
+        present = used.any(axis=3)
+        last = used.shape[3] - 1 - numpy.argmax(used[...,::-1], axis=3)
+        below = numpy.arange(used.shape[3]) <= last[...,numpy.newaxis]
+        for tracker, station, plane, planechannel in zip(*numpy.nonzero(below & ~used & present[...,numpy.newaxis])):
+            issues.append({"ChannelUID":-1, "Severity":5, "Issue":"Mapping",
+                           "Comment":"No channel at tracker %i station %i plane %i channel %i"\
+                           %(tracker, station+1, plane, planechannel)})
+
+        return issues
+
+
+def Load(filename, nchannels=None):
+    return TrackerMapping.Load(filename, nchannels)
+
+
+if __name__ == "__main__":
+
+    print (module_description)
+
+    mapping = Load(sys.argv[1])
+    issues = mapping.Validate()
+    for issue in issues:
+        print ("%5i %s"%(issue["ChannelUID"], issue["Comment"]))
+    print ("Mapped %i channels, %i issues"%(numpy.count_nonzero(mapping.Mapped), len(issues)))
+    if len(issues) > 0:
+        sys.exit(1)
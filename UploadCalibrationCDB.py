@@ -16,6 +16,7 @@ import json
 import time
 import ADCCalibrator
 import FECalibrationUtils
+import FEChannelTable
 
 if Upload:
     #from cdb import CalibrationSuperMouse
@@ -204,3 +205,4 @@ if __name__ == "__main__" :
     
     calibpath = sys.argv[1]
     status = UploadCDB(calibpath=calibpath)
+    FEChannelTable.LazyReport()
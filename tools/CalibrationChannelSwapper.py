@@ -4,8 +4,13 @@ Quick Script to swap round banks in the Calibration file
 
 """
 
+import os
+import sys
 import json
 
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+import CalibrationDiff
+
 # Load the existing calibration file:
 input_filename="scifi_calibration_2015-06-18.txt"
 output_filename="scifi_calibration_2015-07-28.txt"
@@ -30,14 +35,11 @@ for c in calibration:
         if s[0] == this_bank:
             c["bank"] = s[1]
             
-# Check the swaps:
-for c in calibration:
-    for o in calibration_old:
-        if o["bank"] == c["bank"] and o["channel"] == c["channel"]:
-            if  abs(o["adc_pedestal"] - c["adc_pedestal"]) > 0.001 and\
-                abs(o["adc_gain"] - c["adc_gain"]) > 0.001:
-                
-                print "Channel changed %i, %i"%(o["bank"],o["channel"])
+# Check the swaps, matching the channels by (bank, channel):
+diff = CalibrationDiff.CalibrationDiff(calibration_old, calibration, "BankChannel")
+changed = diff.Outliers("adc_pedestal", 0.001) & diff.Outliers("adc_gain", 0.001)
+for bank, channel in zip(diff.New("bank")[changed], diff.New("channel")[changed]):
+    print "Channel changed %i, %i"%(bank, channel)
             
 with open (output_filename, "w") as f:
     json.dump(calibration, f)